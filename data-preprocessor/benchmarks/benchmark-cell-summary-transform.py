@@ -0,0 +1,143 @@
+"""
+Micro-benchmark for the CellSummaryRow transform in stage 41.
+
+Compares the old transform (deep copy of each row and gene, then truncate) with
+`transform_cell_summary_row()` (slice first, build the output dicts directly) on the
+rows of a real intermediary file, and checks that both produce the same output.
+
+Usage:
+    python benchmark-cell-summary-transform.py [--file PATH] [--records N] [--repeat N]
+"""
+
+import argparse
+import copy
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).parent.parent / "scripts"
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+from shared import *
+
+# Stage scripts start with a number, so they are loaded by path
+spec = importlib.util.spec_from_file_location(
+    "build_ftu_cell_summaries_jsonld",
+    SCRIPTS_DIR / "41-build-ftu-cell-summaries-jsonld.py",
+)
+stage_41 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(stage_41)
+
+
+def legacy_transform_cell_summary_row(summary: dict, cell_id_curie: str) -> dict:
+    """The transform as it was before rows were built directly, kept for comparison."""
+    transformed_summary = copy.deepcopy(summary)
+    transformed_summary["@type"] = "CellSummaryRow"
+    transformed_summary["genes"] = transformed_summary.pop("gene_expr", [])
+    transformed_summary["cell_id"] = (
+        "http://purl.obolibrary.org/obo/" + cell_id_curie.replace(":", "_")
+    )
+    transformed_summary["cell_label"] = transformed_summary["cell_label"].lower()
+
+    gene_counter = 0
+    keep_genes = []
+    for gene in transformed_summary["genes"]:
+        if gene_counter > 10:
+            break
+
+        gene_counter += 1
+
+        if not isinstance(gene, dict):
+            raise TypeError("Invalid gene format")
+
+        transformed_gene = copy.deepcopy(gene)
+        transformed_gene["@type"] = "GeneExpression"
+        transformed_gene["ensemble_id"] = transformed_gene.pop("ensembl_id")
+        transformed_gene["mean_expression"] = transformed_gene.pop(
+            "mean_gene_expr_value"
+        )
+        keep_genes.append(transformed_gene)
+
+    transformed_summary["genes"] = keep_genes
+    return transformed_summary
+
+
+def direct_transform_cell_summary_row(summary: dict, cell_id_curie: str) -> dict:
+    """The current transform, keeping the same 11 genes as the old one."""
+    genes = stage_41.select_top_genes(summary.get("gene_expr", []), 11, "input_order")
+    return stage_41.transform_cell_summary_row(summary, cell_id_curie, genes)
+
+
+def load_rows(filename: Path, max_records: int) -> list[tuple[dict, str]]:
+    """
+    Read the CellSummaryRows of the first records of an intermediary JSONL file.
+
+    Args:
+        filename (Path): Path to the intermediary file.
+        max_records (int): Number of CellSummary records to read.
+
+    Returns:
+        list[tuple[dict, str]]: (row, cell_id_curie) pairs.
+    """
+    rows = []
+    with open(filename, "rb") as f:
+        for i, line in enumerate(f):
+            if i >= max_records:
+                break
+            if not line.strip():
+                continue
+            for summary in ujson.loads(line).get("summary", []):
+                cell_id_curie = get_id_from_iri(summary.get("cell_id"))
+                if cell_id_curie:
+                    rows.append((summary, cell_id_curie))
+    return rows
+
+
+def time_transform(transform, rows: list[tuple[dict, str]], repeat: int) -> float:
+    """
+    Return the best wall time in seconds of `repeat` passes of `transform` over all rows.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for summary, cell_id_curie in rows:
+            transform(summary, cell_id_curie)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    # Driver code
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--file",
+        type=Path,
+        default=FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME,
+        help="Intermediary JSONL file written by stage 20",
+    )
+    parser.add_argument("--records", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = load_rows(args.file, args.records)
+    genes = sum(len(summary.get("gene_expr", [])) for summary, _ in rows)
+    print(f"📊 Loaded {len(rows)} rows with {genes} genes from {args.file}")
+
+    for summary, cell_id_curie in rows:
+        if legacy_transform_cell_summary_row(
+            summary, cell_id_curie
+        ) != direct_transform_cell_summary_row(summary, cell_id_curie):
+            raise AssertionError(f"Transforms differ for {summary.get('cell_id')}")
+
+    legacy = time_transform(legacy_transform_cell_summary_row, rows, args.repeat)
+    direct = time_transform(direct_transform_cell_summary_row, rows, args.repeat)
+
+    print(f"{'transform':<12}{'seconds':>12}{'rows/s':>14}")
+    for name, seconds in (("deepcopy", legacy), ("direct", direct)):
+        print(f"{name:<12}{seconds:>12.4f}{len(rows) / seconds:>14.0f}")
+    print(f"✅ Speed-up: {legacy / direct:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Benchmark of stages 20, 40 and 41 on synthetic HRApop Universe inputs.
+
+For each scale (number of datasets), generates inputs with `synthetic_universe.py`
+in a throwaway copy of the pipeline, times `filter_raw_data()`,
+`build_ftu_datasets_jsonld()` and `build_ftu_cell_summaries_jsonld()` there with
+`track_performance()`, and reports how their time grows with the input. A scaling
+exponent of 1 is linear: doubling the datasets doubles the time.
+
+The stages use the settings of scripts/config.yaml (e.g. FILTER_WORKERS,
+INTERMEDIARY_FORMAT, GENE_RANKING), so edit it to compare settings.
+
+Usage:
+    python benchmark-stages.py [--scales N ...] [--rows N] [--genes N]
+        [--ftu-fraction F] [--seed N] [--output PATH] [--keep DIR]
+"""
+
+import argparse
+import importlib.util
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).parent
+
+# The stages of a benchmark workspace are imported instead when it runs them
+SCRIPTS_DIR = Path(
+    os.environ.get("BENCHMARK_SCRIPTS_DIR", BENCHMARKS_DIR.parent / "scripts")
+)
+sys.path.insert(0, str(SCRIPTS_DIR))
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+from shared import *
+from synthetic_universe import generate_universe
+
+# Stage functions timed, each as a section of the same name
+BENCHMARKED_FUNCTIONS = (
+    "filter_raw_data",
+    "build_ftu_datasets_jsonld",
+    "build_ftu_cell_summaries_jsonld",
+)
+
+
+def load_stage(filename: str):
+    """
+    Load a stage script as a module (their names start with a number).
+
+    The module is registered, so worker processes can unpickle its functions.
+    """
+    spec = importlib.util.spec_from_file_location(
+        Path(filename).stem.replace("-", "_"), SCRIPTS_DIR / filename
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_stage_functions():
+    """
+    Run the filtering of stage 20 and the builds of stages 40 and 41 on the inputs
+    of the workspace this process was started in, without any download.
+    """
+    stage_20 = load_stage("20-preprocess-hra-pop.py")
+    stage_40 = load_stage("40-build-ftu-datasets-jsonld.py")
+    stage_41 = load_stage("41-build-ftu-cell-summaries-jsonld.py")
+
+    with open(CELL_TYPES_IN_FTUS, "r", encoding="utf-8") as f:
+        cell_types_in_ftus = json.load(f)
+    metadata = pd.read_csv(UNIVERSE_METADATA_FILENAME)
+
+    with track_performance("filter_raw_data"):
+        datasets_of_interest = stage_20.identify_datasets_of_interest(
+            cell_types_in_ftus, metadata
+        )
+        index = FtuIndex(cell_types_in_ftus, datasets_of_interest)
+        if FILTER_BACKEND == "duckdb":
+            stage_20.filter_raw_data_duckdb(index)
+        else:
+            stage_20.filter_raw_data(index)
+
+    index = FtuIndex.from_files(
+        filtered_dataset_metadata_path=FILTERED_DATASET_METADATA_FILENAME
+    )
+    stage_40.build_ftu_datasets_jsonld(
+        metadata=metadata.reset_index(drop=True), index=index
+    )
+    stage_41.build_ftu_cell_summaries_jsonld(index)
+
+
+def benchmark_scale(workspace: Path, datasets: int, args) -> dict:
+    """
+    Generate inputs for one scale in a copy of the pipeline and time the stage functions there.
+
+    Args:
+        workspace (Path): Empty folder for the copy.
+        datasets (int): Number of datasets to generate.
+        args (argparse.Namespace): The generator options.
+
+    Returns:
+        dict: The generated counts, and the 'sections' recorded by track_performance().
+
+    Raises:
+        RuntimeError: If a stage function fails. Its output is in the workspace's log.
+    """
+    preprocessor_dir = workspace / "data-preprocessor"
+    shutil.copytree(
+        SCRIPTS_DIR,
+        preprocessor_dir / "scripts",
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+    (workspace / "docs" / "iftu-testing" / "assets").mkdir(parents=True)
+
+    counts = generate_universe(
+        preprocessor_dir, datasets, args.rows, args.genes, args.ftu_fraction, args.seed
+    )
+
+    perf_file = workspace / "perf.json"
+    log_file = workspace / "benchmark.log"
+    env = {
+        **os.environ,
+        "BENCHMARK_SCRIPTS_DIR": str(preprocessor_dir / "scripts"),
+        "PERF_FILE": str(perf_file),
+        "HTTP_OFFLINE": "1",
+    }
+    with open(log_file, "w", encoding="utf-8") as log:
+        returncode = subprocess.call(
+            [sys.executable, __file__, "--run-stage-functions"],
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    if returncode != 0:
+        print(log_file.read_text(encoding="utf-8")[-3000:])
+        raise RuntimeError(f"Benchmark at {datasets} datasets failed, see {log_file}")
+
+    with open(perf_file, "r", encoding="utf-8") as f:
+        sections = {s["name"]: s for s in json.load(f)["sections"]}
+    return {**counts, "sections": sections}
+
+
+def scaling_exponent(previous: dict, current: dict, name: str) -> float | None:
+    """
+    Return the slope of log(time) over log(CellSummaryRows) between two scales.
+    """
+    t0 = previous["sections"][name]["wall_seconds"]
+    t1 = current["sections"][name]["wall_seconds"]
+    if not (t0 and t1) or previous["rows"] == current["rows"]:
+        return None
+    return math.log(t1 / t0) / math.log(current["rows"] / previous["rows"])
+
+
+def print_scaling(results: list[dict]):
+    """Print the time, throughput and scaling exponent of each function at each scale."""
+    for name in BENCHMARKED_FUNCTIONS:
+        print(f"\n⏱️ {name}")
+        print(
+            f"{'datasets':>10}{'rows':>10}{'MB in':>10}{'seconds':>10}"
+            f"{'rows/s':>12}{'peak MB':>10}{'exponent':>10}"
+        )
+        for i, result in enumerate(results):
+            section = result["sections"][name]
+            seconds = section["wall_seconds"]
+            exponent = scaling_exponent(results[i - 1], result, name) if i else None
+            print(
+                f"{result['datasets']:>10}{result['rows']:>10}"
+                f"{result['bytes'] / 1e6:>10.1f}{seconds:>10.2f}"
+                f"{result['rows'] / seconds if seconds else 0:>12.0f}"
+                f"{section['peak_rss_mb'] or 0:>10.0f}"
+                f"{'' if exponent is None else f'{exponent:.2f}':>10}"
+            )
+
+
+def main():
+    # Driver code
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[50, 100, 200, 400],
+        help="Numbers of datasets to benchmark",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=20, help="CellSummaryRows per CellSummary"
+    )
+    parser.add_argument(
+        "--genes", type=int, default=1000, help="Genes per CellSummaryRow"
+    )
+    parser.add_argument(
+        "--ftu-fraction",
+        type=float,
+        default=0.5,
+        help="Fraction of datasets from organs with FTUs",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=REPORTS_DIR / "perf" / "benchmark-stages.json",
+        help="JSON file for the results",
+    )
+    parser.add_argument(
+        "--keep", type=Path, help="Keep the generated workspaces in this folder"
+    )
+    parser.add_argument(
+        "--run-stage-functions", action="store_true", help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.run_stage_functions:
+        run_stage_functions()
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = args.keep or Path(temp_dir)
+        for datasets in sorted(args.scales):
+            workspace = root / f"datasets-{datasets}"
+            if workspace.exists():
+                shutil.rmtree(workspace)
+            workspace.mkdir(parents=True)
+
+            print(f"📊 Benchmarking {datasets} datasets in {workspace}...")
+            results.append(benchmark_scale(workspace, datasets, args))
+
+    print_scaling(results)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "settings": {
+                    "rows": args.rows,
+                    "genes": args.genes,
+                    "ftu_fraction": args.ftu_fraction,
+                    "seed": args.seed,
+                    "filter_workers": FILTER_WORKERS,
+                    "filter_backend": FILTER_BACKEND,
+                    "intermediary_format": INTERMEDIARY_FORMAT,
+                    "intermediary_shards": INTERMEDIARY_SHARDS,
+                    "intermediary_shard_workers": INTERMEDIARY_SHARD_WORKERS,
+                    "top_n_genes": TOP_N_GENES,
+                    "gene_ranking": GENE_RANKING,
+                },
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+    print(f"\n✅ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
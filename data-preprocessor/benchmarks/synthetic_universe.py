@@ -0,0 +1,224 @@
+"""
+Generator for synthetic HRApop Universe inputs of known size.
+
+Writes the three files stages 20, 40 and 41 read, so the pipeline can be timed
+without downloading the HRApop Universe from Zenodo:
+
+  - `cell-types-in-ftus.json` (normally written by stage 10) to `output/`
+  - the dataset metadata CSV to `input/`
+  - the gzipped CellSummary JSONL file to `raw-data/`
+
+The FTUs, CTs, genes and datasets are made up, but have the shape of the real
+ones: every FTU organ has two FTUs with exclusive CTs and one CT shared by both
+(so stage 41 drops it), and rows also list CTs that are in no FTU.
+
+Usage:
+    python synthetic_universe.py DIR [--datasets N] [--rows N] [--genes N]
+        [--ftu-fraction F] [--seed N]
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import random
+from pathlib import Path
+
+import yaml
+
+# Names of the generated files are read from the pipeline's config
+with open(
+    Path(__file__).parent.parent / "scripts" / "config.yaml", "r", encoding="utf-8"
+) as f:
+    config = yaml.safe_load(f)
+
+CELL_TYPES_IN_FTUS = config["CELL_TYPES_IN_FTUS"]
+UNIVERSE_METADATA_FILENAME = config["UNIVERSE_METADATA_FILENAME"]
+UNIVERSE_10K_FILENAME = config["UNIVERSE_10K_FILENAME"]
+
+# Size of the made-up FTU universe
+FTU_ORGANS = 5
+FTUS_PER_ORGAN = 2
+EXCLUSIVE_CTS_PER_FTU = 8
+OTHER_CTS = 20
+
+# Organ of the datasets that are not of interest
+NON_FTU_ORGAN = "UBERON:9100000"
+
+# Every other dataset has a CellSummary for both methods
+ANNOTATION_METHODS = ("celltypist", "azimuth")
+
+
+def cell_type(number: int) -> dict:
+    """Return a made-up CT as listed in cell-types-in-ftus.json."""
+    return {"ct_label": f"synthetic cell type {number}", "ct_iri": f"CL:9{number:06d}"}
+
+
+def make_cell_types_in_ftus() -> dict:
+    """
+    Build a cell-types-in-ftus.json with FTU_ORGANS organs of FTUS_PER_ORGAN FTUs each.
+
+    Returns:
+        dict: FTU label → FTU, in the format written by stage 10.
+    """
+    cell_types_in_ftus = {}
+    ct_number = 0
+    for organ in range(FTU_ORGANS):
+        # One CT in every FTU of the organ, so it is not unique to one FTU
+        shared_ct = cell_type(ct_number)
+        ct_number += 1
+        for ftu in range(FTUS_PER_ORGAN):
+            cts = [shared_ct]
+            for _ in range(EXCLUSIVE_CTS_PER_FTU):
+                cts.append(cell_type(ct_number))
+                ct_number += 1
+            label = f"synthetic ftu {organ}-{ftu}"
+            cell_types_in_ftus[label] = {
+                "ftu_purl": f"https://purl.humanatlas.io/2d-ftu/synthetic-{organ}-{ftu}",
+                "cts_in_2d_ftu": cts,
+                "cts_in_asctb": cts,
+                "cts_exclusive": cts,
+                "organ_id_short": f"UBERON:9{organ:06d}",
+                "organ_label": f"Synthetic organ {organ}",
+            }
+    return cell_types_in_ftus
+
+
+def generate_universe(
+    directory: Path,
+    datasets: int = 100,
+    rows: int = 20,
+    genes: int = 1000,
+    ftu_fraction: float = 0.5,
+    seed: int = 0,
+) -> dict:
+    """
+    Write synthetic pipeline inputs below a data-preprocessor folder.
+
+    Each dataset gets one or two CellSummaries (see ANNOTATION_METHODS) with
+    `rows` CellSummaryRows of `genes` genes each. The same seed always writes the same files.
+
+    Args:
+        directory (Path): The data-preprocessor folder; `input/`, `output/` and
+            `raw-data/` are created in it.
+        datasets (int, optional): Number of datasets. Defaults to 100.
+        rows (int, optional): CellSummaryRows per CellSummary. Defaults to 20.
+        genes (int, optional): Genes per CellSummaryRow. Defaults to 1000.
+        ftu_fraction (float, optional): Fraction of datasets from organs with FTUs.
+            Defaults to 0.5.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        dict: Counts of the generated 'datasets', 'records', 'rows' and 'genes',
+        and the 'bytes' of the gzipped JSONL file.
+    """
+    rng = random.Random(seed)
+    directory = Path(directory)
+    for folder in ("input", "output", "raw-data"):
+        (directory / folder).mkdir(parents=True, exist_ok=True)
+
+    cell_types_in_ftus = make_cell_types_in_ftus()
+    with open(directory / "output" / CELL_TYPES_IN_FTUS, "w", encoding="utf-8") as f:
+        json.dump(cell_types_in_ftus, f, indent=2)
+
+    # CTs by organ: its FTU CTs plus CTs that are in no FTU
+    other_cts = [cell_type(900_000 + i) for i in range(OTHER_CTS)]
+    cts_by_organ = {NON_FTU_ORGAN: other_cts}
+    for ftu in cell_types_in_ftus.values():
+        organ_cts = cts_by_organ.setdefault(ftu["organ_id_short"], list(other_cts))
+        organ_cts.extend(ct for ct in ftu["cts_exclusive"] if ct not in organ_cts)
+    ftu_organs = sorted(set(cts_by_organ) - {NON_FTU_ORGAN})
+
+    gene_ids = range(max(2 * genes, 1000))
+    counts = {"datasets": datasets, "records": 0, "rows": 0, "genes": 0}
+
+    universe_path = directory / "raw-data" / UNIVERSE_10K_FILENAME
+    with (
+        gzip.open(universe_path, "wt", encoding="utf-8", compresslevel=6) as universe,
+        open(
+            directory / "input" / UNIVERSE_METADATA_FILENAME,
+            "w",
+            newline="",
+            encoding="utf-8",
+        ) as metadata,
+    ):
+        writer = csv.writer(metadata)
+        writer.writerow(["dataset_id", "organ", "handler", "provider_name"])
+
+        for i in range(datasets):
+            dataset_id = f"https://example.org/synthetic/dataset-{i}"
+            organ = (
+                rng.choice(ftu_organs) if rng.random() < ftu_fraction else NON_FTU_ORGAN
+            )
+            writer.writerow([dataset_id, organ, f"dataset-{i}", f"provider-{i % 7}"])
+
+            for method in ANNOTATION_METHODS[: 1 + i % len(ANNOTATION_METHODS)]:
+                cts = rng.sample(
+                    cts_by_organ[organ], min(rows, len(cts_by_organ[organ]))
+                )
+                summary = []
+                for ct in (cts[j % len(cts)] for j in range(rows)):
+                    summary.append(
+                        {
+                            "@type": "CellSummaryRow",
+                            "cell_id": ct["ct_iri"],
+                            "cell_label": ct["ct_label"],
+                            "count": rng.randint(1, 10_000),
+                            "percentage": rng.random(),
+                            "gene_expr": [
+                                {
+                                    "@type": "GeneExpression",
+                                    "ensembl_id": f"ENSG{g:011d}",
+                                    "gene_id": f"HGNC:{g}",
+                                    "gene_label": f"GENE{g}",
+                                    "mean_gene_expr_value": round(rng.random(), 6),
+                                }
+                                for g in rng.sample(gene_ids, genes)
+                            ],
+                        }
+                    )
+                record = {
+                    "@type": "CellSummary",
+                    "cell_source": dataset_id,
+                    "annotation_method": method,
+                    "modality": "sc_transcriptomics",
+                    "summary": summary,
+                }
+                universe.write(json.dumps(record) + "\n")
+                counts["records"] += 1
+                counts["rows"] += rows
+                counts["genes"] += rows * genes
+
+    counts["bytes"] = universe_path.stat().st_size
+    return counts
+
+
+def main():
+    # Driver code
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "directory", type=Path, help="data-preprocessor folder to write to"
+    )
+    parser.add_argument("--datasets", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--genes", type=int, default=1000)
+    parser.add_argument("--ftu-fraction", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = generate_universe(
+        args.directory,
+        args.datasets,
+        args.rows,
+        args.genes,
+        args.ftu_fraction,
+        args.seed,
+    )
+    print(
+        f"✅ Wrote {counts['records']} CellSummaries with {counts['rows']} rows and "
+        f"{counts['genes']} genes ({counts['bytes'] / 1e6:.1f} MB) to {args.directory}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,273 @@
 from shared import *
 
+# Anatomical structures that do not make a CT non-exclusive to an FTU: body proper and
+# generic anatomical terms (the organ, the FTU and what the FTU is part of are added per FTU)
+GENERIC_AS_IDS = {"UBERON:0013702", "FMA:29733", "FMA:62955", "UBERON:0001062"}
 
-def compile_cell_types_per_ftu(query_result: pd.DataFrame):
 
-    result = {}
+def get_asctb_purls(organ_ids: set[str]) -> dict[str, set[str]]:
+    """
+    Look up the PURLs of the ASCT+B tables of the given organs in the HRA KG.
+
+    Args:
+        organ_ids (set[str]): Organ CURIEs, e.g. 'UBERON:0002113'.
+
+    Returns:
+        dict[str, set[str]]: PURL → the given organs the table is of (its `organIds`),
+        in the order of the digital objects, without the anatomical systems table.
+    """
+    digital_objects = fetch_json_concurrently([HRA_DIGITAL_OBJECTS])[
+        HRA_DIGITAL_OBJECTS
+    ]
+
+    asctb_purls = {}
+    for do in digital_objects["@graph"]:
+        if do["doType"] != "asct-b" or "organIds" not in do:
+            continue
+        table_organ_ids = organ_ids & {get_id_from_iri(id_) for id_ in do["organIds"]}
+        if table_organ_ids:
+            purl = do["@id"].replace("lod", "purl")
+            if purl != "https://purl.humanatlas.io/asct-b/anatomical-systems":
+                asctb_purls.setdefault(purl, set()).update(table_organ_ids)
+    return asctb_purls
+
+
+class AsctbTable:
+    """
+    Lookups over one ASCT+B table digital object, built once per table.
+
+    Args:
+        table (dict): The table as served at its PURL.
+    """
+
+    def __init__(self, table: dict):
+        data = table["data"]
+        self.iri = table["iri"]
 
-    for row in query_result.itertuples(index=False):
-        ftu_purl = row.ftu_purl
-        ftu_label = row.ftu_label
-        ct_label = row.ct_label
-        ct_iri = iri_to_curie(row.ct_iri)
-        organ_id_short = iri_to_curie(row.organ_iri)
-        organ_label = row.organ_label
-
-        # Initialize entry if not exists
-        if ftu_label not in result:
-            print(ftu_purl)
-
-            result[ftu_label] = {
-                "ftu_purl": ftu_purl,
-                "cts_in_2d_ftu": [],
-                "cts_in_asctb": [],
-                "cts_exclusive": [],
-                "organ_id_short": organ_id_short,
-                "organ_label": organ_label,
-            }
-
-        # Append based on flags
-        if as_bool(getattr(row, "in_2d_ftu", True)):
-            result[ftu_label]["cts_in_2d_ftu"].append(
-                {"ct_label": ct_label, "ct_iri": ct_iri}
+        # AS ID → AS record
+        self.structures = {
+            get_id_from_iri(as_record["id"]): as_record
+            for as_record in data["anatomical_structures"]
+        }
+
+        # CT ID → IDs of the ASs it is located in
+        self.located_in = defaultdict(set)
+        for ct_record in data["cell_types"]:
+            self.located_in[get_id_from_iri(ct_record["id"])].update(
+                get_id_from_iri(id_) for id_ in ct_record.get("ccf_located_in", [])
             )
 
-        if as_bool(getattr(row, "in_asctb", True)):
-            result[ftu_label]["cts_in_asctb"].append(
-                {"ct_label": ct_label, "ct_iri": ct_iri}
+        # FTU ID → {CT ID: label} of the CTs in its FTU column, in table order
+        self.cts_by_ftu = defaultdict(dict)
+        for record in data["asctb_record"]:
+            ftu_list = record.get("ftu_list")
+            cell_type_list = record.get("cell_type_list")
+            if not (ftu_list and cell_type_list):
+                continue
+            for ftu in ftu_list:
+                ftu_cts = self.cts_by_ftu[get_id_from_iri(ftu.get("source_concept"))]
+                for ct in cell_type_list:
+                    ct_id = get_id_from_iri(ct.get("source_concept"))
+                    if ct_id and ct_id not in ftu_cts:
+                        ftu_cts[ct_id] = ct.get("ccf_pref_label")
+
+    def label(self, as_id: str) -> str | None:
+        """Return the label of an AS in the table, if it is there."""
+        as_record = self.structures.get(as_id, {})
+        return as_record.get("ccf_pref_label") or as_record.get("name")
+
+    def is_exclusive(self, ct_id: str, ftu_id: str, organ_id: str) -> bool:
+        """
+        Return whether a CT is located in no AS but the FTU (or the organ, what the FTU
+        is part of, or a generic AS) according to the table.
+        """
+        ignore = GENERIC_AS_IDS | {organ_id, ftu_id}
+        ignore.update(
+            get_id_from_iri(id_)
+            for id_ in self.structures.get(ftu_id, {}).get("ccf_part_of", [])
+        )
+        return not (self.located_in.get(ct_id, set()) - ignore)
+
+
+@track_performance("build_ftu_query_from_kg")
+def build_ftu_query_from_kg(
+    organs_with_ftus: list, workers: int = KG_FETCH_WORKERS
+) -> pd.DataFrame:
+    """
+    Build the FTU_QUERY table from the 2D FTU and ASCT+B digital objects in the HRA KG.
+
+    All digital objects are fetched concurrently (see `fetch_json_concurrently()`).
+    Every CT in an FTU illustration or in the FTU column of its organ's ASCT+B tables
+    gets one row, with flags for where it was found and whether it is exclusive to
+    the FTU (in the illustration and located in no other AS of the tables).
+
+    The ASCT+B tables of an organ are those whose digital object lists it in its
+    `organIds`, so the result does not depend on the order tables are fetched in. If
+    there are several, they are merged like the archived version of this script did:
+    the FTU column CTs are the union of those of all tables, and the FTU label comes
+    from the first table that has the FTU. Unlike there, where one table was enough, a
+    CT is only exclusive if it is exclusive in every table, since any table that locates
+    it in another AS makes it not exclusive to the FTU.
+
+    Args:
+        organs_with_ftus (list): From `get_organs_with_ftus()`.
+        workers (int, optional): Maximum number of concurrent requests. Defaults to
+            KG_FETCH_WORKERS.
+
+    Returns:
+        pd.DataFrame: With the columns of FTU_QUERY, for `compile_cell_types_per_ftu()`.
+    """
+    organ_ids = {get_id_from_iri(organ["organ_id"]) for organ in organs_with_ftus}
+    ftu_urls = [
+        do["ftu_digital_object"] for organ in organs_with_ftus for do in organ["ftu"]
+    ]
+
+    # The ASCT+B lookup and the FTUs do not depend on each other
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        asctb_purls = pool.submit(get_asctb_purls, organ_ids)
+        ftu_dos = pool.submit(fetch_json_concurrently, ftu_urls, workers)
+        asctb_organs = asctb_purls.result()
+        asctb_jsons = fetch_json_concurrently(list(asctb_organs), workers)
+        asctb_tables = {purl: AsctbTable(asctb_jsons[purl]) for purl in asctb_organs}
+        ftu_dos = ftu_dos.result()
+    print(f"Fetched {len(ftu_dos)} FTUs and {len(asctb_tables)} ASCT+B tables.")
+
+    rows = []
+    for organ in organs_with_ftus:
+        organ_id = get_id_from_iri(organ["organ_id"])
+        tables = [
+            asctb_tables[purl]
+            for purl, table_organ_ids in asctb_organs.items()
+            if organ_id in table_organ_ids
+        ]
+
+        for do in organ["ftu"]:
+            do_json = ftu_dos[do["ftu_digital_object"]]
+            data = do_json["data"][0]
+            ftu_id = get_id_from_iri(data["representation_of"])
+
+            # CT ID → label, once per CT
+            cts_in_2d_ftu = {}
+            for node in data["illustration_node"]:
+                cts_in_2d_ftu.setdefault(
+                    get_id_from_iri(node["representation_of"]), node.get("node_group")
+                )
+            cts_in_asctb = {}
+            for table in tables:
+                for ct_id, ct_label in table.cts_by_ftu.get(ftu_id, {}).items():
+                    cts_in_asctb.setdefault(ct_id, ct_label)
+
+            ftu_label = next(
+                (label for table in tables if (label := table.label(ftu_id))), ftu_id
             )
+            for ct_id in {**cts_in_2d_ftu, **cts_in_asctb}:
+                in_2d_ftu = ct_id in cts_in_2d_ftu
+                rows.append(
+                    {
+                        "organ_iri": organ["organ_id"],
+                        "organ_label": organ["organ_label"],
+                        "ftu_purl": do_json["iri"],
+                        "ftu_label": ftu_label,
+                        "ct_iri": ct_id,
+                        "ct_label": cts_in_2d_ftu.get(ct_id) or cts_in_asctb.get(ct_id),
+                        "in_2d_ftu": in_2d_ftu,
+                        "in_asctb": ct_id in cts_in_asctb,
+                        "exclusive_ct_in_ftu": in_2d_ftu
+                        and bool(tables)
+                        and all(
+                            table.is_exclusive(ct_id, ftu_id, organ_id)
+                            for table in tables
+                        ),
+                    }
+                )
+
+    return pd.DataFrame(rows)
+
 
-        if as_bool(getattr(row, "exclusive_ct_in_ftu", True)):
-            result[ftu_label]["cts_exclusive"].append(
-                {"ct_label": ct_label, "ct_iri": ct_iri}
+@track_performance("compile_cell_types_per_ftu")
+def compile_cell_types_per_ftu(query_result: pd.DataFrame):
+    """
+    Collect the CTs of each FTU from the FTU query table and save them to CELL_TYPES_IN_FTUS.
+
+    The IRIs and flags are normalised column by column, then the CTs of each flag are
+    listed per FTU with one group-by. FTUs are keyed by label, in order of first appearance,
+    and rows without a label form one FTU. A missing flag column counts as True for every row.
+
+    Args:
+        query_result (pd.DataFrame): With the columns ftu_purl, ftu_label, ct_label, ct_iri,
+            organ_iri and organ_label, and optionally in_2d_ftu, in_asctb and
+            exclusive_ct_in_ftu.
+
+    Returns:
+        dict: FTU label → FTU PURL, CTs in the 2D FTU, in the ASCT+B table and exclusive
+        to the FTU, and its organ.
+    """
+    query = query_result.reset_index(drop=True)
+    # Group on codes rather than labels so that rows without a label still form one FTU
+    query["ftu"] = pd.factorize(query["ftu_label"], use_na_sentinel=False)[0]
+
+    for column in ("ct_iri", "organ_iri"):
+        query[column] = iri_to_curie_series(query[column])
+    query["ct"] = [
+        {"ct_label": ct_label, "ct_iri": ct_iri}
+        for ct_label, ct_iri in zip(
+            query["ct_label"].tolist(), query["ct_iri"].tolist()
+        )
+    ]
+
+    # Rows of the CTs of each list, then all lists of all FTUs with one group-by
+    flagged = pd.concat(
+        [
+            query.loc[
+                as_bool_series(query[flag]) if flag in query else slice(None),
+                ["ftu", "ct"],
+            ].assign(key=key)
+            for key, flag in (
+                ("cts_in_2d_ftu", "in_2d_ftu"),
+                ("cts_in_asctb", "in_asctb"),
+                ("cts_exclusive", "exclusive_ct_in_ftu"),
             )
+        ]
+    )
+    ct_lists = flagged.groupby(["ftu", "key"], sort=False)["ct"].agg(list).to_dict()
+
+    result = {}
+    ftus = query.drop_duplicates("ftu")
+    for ftu in ftus.to_dict(orient="records"):
+        result[ftu["ftu_label"]] = {
+            "ftu_purl": ftu["ftu_purl"],
+            **{
+                key: ct_lists.get((ftu["ftu"], key), [])
+                for key in ("cts_in_2d_ftu", "cts_in_asctb", "cts_exclusive")
+            },
+            "organ_id_short": ftu["organ_iri"],
+            "organ_label": ftu["organ_label"],
+        }
+    print(f"Compiled the CTs of {len(result)} FTUs.")
 
     # pprint(result)
 
+    # One write instead of one per JSON token
     with open(CELL_TYPES_IN_FTUS, "w") as f:
-        json.dump(result, f, indent=2)
+        f.write(json.dumps(result, indent=2))
 
     print(f"✅ Saved data to {CELL_TYPES_IN_FTUS}")
 
     return result
 
 
+@track_performance(Path(__file__).stem)
 def main():
     # Driver code
 
-    ftu_query = pd.read_csv(FTU_QUERY)
+    if FTU_SOURCE == "kg":
+        ftu_query = build_ftu_query_from_kg(get_organs_with_ftus())
+    elif FTU_SOURCE == "cdn":
+        response = cached_get(FTU_QUERY)
+        response.raise_for_status()
+        ftu_query = pd.read_csv(StringIO(response.text))
+    else:
+        raise ValueError(f"Unknown FTU_SOURCE {FTU_SOURCE!r}, expected 'cdn' or 'kg'")
 
     result = compile_cell_types_per_ftu(ftu_query)
 
@@ -20,172 +20,469 @@ def download_hra_pop_data_data():
         UNIVERSE_METADATA_FILENAME,
     )
 
+    # Check the HRApop Universe file against the size and MD5 listed on Zenodo
+    try:
+        zenodo_file = get_zenodo_file(hra_pop_zenodo_record, UNIVERSE_10K_FILENAME.name)
+    except (requests.RequestException, ValueError) as e:
+        print(f"⚠️ Could not look up the file on Zenodo ({e}), skipping its checks.")
+        zenodo_file = {}
+
     download_from_url(
-        "https://zenodo.org/records/15786154/files/sc-transcriptomics-cell-summaries.top10k.jsonl.gz?download=1",
+        f"https://zenodo.org/records/{hra_pop_zenodo_record}/files/{UNIVERSE_10K_FILENAME.name}?download=1",
         UNIVERSE_10K_FILENAME,
+        expected_size=zenodo_file.get("size"),
+        checksum=zenodo_file.get("checksum"),
     )
 
 
-def get_organ_from_dataset_metadata(
-    dataset_id_to_check: str, metadata: pd.DataFrame
-) -> str | None:
+def identify_datasets_of_interest(
+    cell_types_in_ftus: dict, metadata: pd.DataFrame
+) -> dict:
     """
-    Get the organ label for a given dataset ID from the metadata.
+    Identify the datasets that come from organs with FTUs.
+
+    Every dataset in the metadata is classified in one pass: the first organ listed
+    for each dataset ID is joined against the organs that have FTUs.
 
     Args:
-        check_dataset_id (str): The dataset ID to look up.
+        cell_types_in_ftus (dict): Cell types in FTUs as loaded from CELL_TYPES_IN_FTUS.
+        metadata (pd.DataFrame): HRApop Universe dataset metadata with 'dataset_id'
+            and 'organ' columns.
 
     Returns:
-        str | None: The corresponding organ label, or None if not found.
+        dict: dataset_id → organ_id_short for every dataset of interest, in the
+        order the datasets first appear in the metadata.
     """
 
-    match = metadata.loc[metadata["dataset_id"] == dataset_id_to_check, "organ"]
-
-    return match.iloc[0] if not match.empty else None
-
+    organs_with_ftus = pd.DataFrame(
+        {
+            "organ": sorted(
+                {
+                    v["organ_id_short"]
+                    for v in cell_types_in_ftus.values()
+                    if "organ_id_short" in v
+                }
+            )
+        }
+    )
 
-def identify_datasets_of_interest(
-    cell_types_in_ftus: list, metadata: pd.DataFrame
-) -> list:
-    """_summary_"""
+    # One row per dataset, keeping the first organ listed for it
+    datasets = metadata.loc[metadata["dataset_id"].notna(), ["dataset_id", "organ"]]
+    datasets = datasets.drop_duplicates(subset="dataset_id", keep="first")
 
-    result = []
+    # Inner join keeps the order of the datasets
+    of_interest = datasets.merge(organs_with_ftus, on="organ", how="inner")
 
-    for dataset_id in metadata["dataset_id"].unique():
-        organ_id = get_organ_from_dataset_metadata(dataset_id, metadata)
-        organ_has_ftus = comes_from_organ_with_ftu(organ_id, cell_types_in_ftus)
+    result = dict(zip(of_interest["dataset_id"], of_interest["organ"]))
 
-        if organ_has_ftus:
-            result.append({dataset_id: organ_id})
-            print(f"Of interest: {dataset_id}")
+    print(f"Of interest: {len(result)} of {len(datasets)} datasets.")
 
     data = {"datasets_of_interest": result}
 
     with open(DATASETS_OF_INTEREST, "w") as f:
         json.dump(data, f, indent=4)
-    return list(result)
+    return result
+
+
+# Numbers of characters to search in line before loading to JSON
+PREFILTER_CHARS = 500
+
+# State shared with worker processes in parallel mode, set by init_filter_worker()
+filter_worker_state = {}
+
+
+def filter_cell_summary_line(
+    line: str,
+    pattern: re.Pattern,
+    unique_dataset_ids_of_interest: set,
+    index: FtuIndex,
+    flatten: bool = False,
+) -> tuple[str, str, list, list | None] | None:
+    """
+    Filter one line of the HRApop Universe file down to the CTs that are exclusive to FTUs.
+
+    This is the per-line work shared by the serial and the parallel path of
+    `filter_raw_data()`, so both write the exact same records.
+
+    Args:
+        line (str): One decoded line of the gzipped JSONL file.
+        pattern (re.Pattern): Precompiled regex matching any dataset ID of interest.
+        unique_dataset_ids_of_interest (set): Dataset IDs from organs with FTUs.
+        index (FtuIndex): Lookups of exclusive CTs per organ and organs per dataset.
+        flatten (bool, optional): Also flatten the kept record into Parquet rows.
+            Defaults to False.
+
+    Returns:
+        tuple[str, str, list, list | None] | None: The serialized record to keep, its dataset
+        ID, the (ct_iri, ftu_purl) matches for its CTs, and its flattened rows (or None),
+        or None if nothing in the line is kept.
+    """
+    # Guard clauses
+    if not line.strip():
+        return None
+    # Quick text pre-filter — skips most lines cheaply
+    if not pattern.search(line[:PREFILTER_CHARS]):
+        return None  # no dataset ID → skip
+
+    try:
+        cell_summary = ujson.loads(line)
+    except ujson.JSONDecodeError as e:
+        tqdm.write(f"⚠️ Skipping invalid JSON line: {e}")
+        return None
+
+    current_dataset_id = cell_summary["cell_source"]
+
+    if current_dataset_id not in unique_dataset_ids_of_interest:
+        return None
+
+    keep_summaries = []
+    dataset_matches = []
+
+    organ_id = index.organ_of(current_dataset_id, "ORGAN NOT FOUND")
+
+    for cell_type in cell_summary.get("summary", []):
+        matches = is_cell_type_exclusive_to_ftu(
+            cell_type.get("cell_id"), organ_id, index
+        )
+
+        if matches:
+            keep_summaries.append(cell_type)
+            dataset_matches.extend(matches)
+
+    if not keep_summaries:
+        return None
+
+    keep_cell_type_population = {
+        k: v for k, v in cell_summary.items() if k != "summary"
+    }
+
+    keep_cell_type_population["summary"] = keep_summaries
+
+    rows = flatten_cell_type_population(keep_cell_type_population) if flatten else None
+
+    return (
+        json.dumps(keep_cell_type_population),
+        current_dataset_id,
+        dataset_matches,
+        rows,
+    )
+
+
+def init_filter_worker(
+    pattern: re.Pattern,
+    unique_dataset_ids_of_interest: set,
+    index: FtuIndex,
+    flatten: bool,
+):
+    """Store the lookup data once per worker process instead of once per batch."""
+    filter_worker_state["args"] = (
+        pattern,
+        unique_dataset_ids_of_interest,
+        index,
+        flatten,
+    )
+
+
+def filter_line_batch(batch: list[bytes]) -> list[tuple]:
+    """Decode, parse and filter a batch of raw lines inside a worker process."""
+    results = []
+    for raw_line in batch:
+        result = filter_cell_summary_line(
+            raw_line.decode("utf-8"), *filter_worker_state["args"]
+        )
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def iterate_line_batches(f, pattern: re.Pattern, batch_size: int):
+    """
+    Group the raw (still undecoded) lines of a binary stream into batches.
 
+    Lines that cannot contain a dataset ID of interest are dropped here already,
+    so they are never sent to a worker process. The byte window is wide enough to
+    hold PREFILTER_CHARS characters of UTF-8, and the workers re-check the exact
+    character window, so this never drops a line the serial path would keep.
+    """
+    batch = []
+    for raw_line in f:
+        if not pattern.search(raw_line[: PREFILTER_CHARS * 4]):
+            continue
+        batch.append(raw_line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iterate_filtered_lines_parallel(
+    f,
+    pattern: re.Pattern,
+    filter_args: tuple,
+    workers: int,
+    batch_size: int,
+):
+    """
+    Filter a binary line stream in a process pool and yield the results in input order.
 
-def filter_raw_data(datasets_of_interest: list, cell_types_in_ftus: list):
+    The main process only decompresses and batches the stream; decoding, JSON parsing
+    and the FTU checks happen in the workers. At most 2 batches per worker are in flight,
+    so memory stays bounded even when decompression outpaces the workers.
+    """
+    byte_pattern = re.compile(pattern.pattern.encode("utf-8"))
+
+    with multiprocessing.Pool(
+        processes=workers, initializer=init_filter_worker, initargs=filter_args
+    ) as pool:
+        pending = deque()
+        for batch in iterate_line_batches(f, byte_pattern, batch_size):
+            pending.append(pool.apply_async(filter_line_batch, (batch,)))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def filter_raw_data(
+    index: FtuIndex,
+    workers: int = FILTER_WORKERS,
+    batch_size: int = FILTER_BATCH_SIZE,
+):
     """
     Stream and filter the massive gzipped JSONL HRApop Universe file (≈36 GB),
     keeping only datasets and cell type populations related to organs that
     have Functional Tissue Units (FTUs).
 
+    With more than one worker, decoding and JSON parsing are spread over a process
+    pool (see `iterate_filtered_lines_parallel()`). Both paths write the same
+    intermediary and dataset metadata files, in the same order.
+
+    With INTERMEDIARY_FORMAT set to "parquet", the kept records are also written to
+    the columnar intermediary for stages 40 and 41. With "shards", they are written to
+    compressed shards instead of one JSONL file (see `ShardedJsonlWriter`).
+
     Shows a live progress bar while processing.
-    """
 
-    # Precompute a fast lookup index that maps (organ_id_short, cell_id) → [ftu_iris]
-    # This should be built once and reused for all subsequent lookups
-    # index = build_ftu_index(cell_types_in_ftus)
+    Args:
+        index (FtuIndex): Lookups built from CELL_TYPES_IN_FTUS and the datasets of interest.
+        workers (int, optional): Number of worker processes. 1 runs serially.
+            Defaults to FILTER_WORKERS from config.yaml.
+        batch_size (int, optional): Number of lines sent to a worker at a time.
+            Defaults to FILTER_BATCH_SIZE from config.yaml.
+    """
 
     # Create a dictionary to hold datasets and confirmed CTs in FTUs from the run
     datasets_with_ftus = {}
 
-    # Perform list comprehension to create a list of unique dataset IDs of interest
-
-    # Remove this and uncomment statement below once testing is done
-    # unique_dataset_ids_of_interest = [
-    #     "https://doi.org/10.1126/science.abl4290#GTEX-1HSMQ-5014-SM-GKSJI"
-    # ]
-
-    unique_dataset_ids_of_interest = set(
-        [list(d.keys())[0] for d in datasets_of_interest]
-    )
-
-    # In the future, use duckdb and https://duckdb.org/docs/stable/data/json/loading_json to read the JSON-lines file?
+    unique_dataset_ids_of_interest = set(index.organ_by_dataset)
 
     # Precompile one regex for all dataset IDs of interest
     pattern = re.compile("|".join(map(re.escape, unique_dataset_ids_of_interest)))
 
-    # Numbers of characters to search in line before loading to JSON
-    N = 500
+    write_parquet = INTERMEDIARY_FORMAT == "parquet"
+
+    filter_args = (pattern, unique_dataset_ids_of_interest, index, write_parquet)
 
     # Stream through the gzipped JSONL file
     with (
-        gzip.open(UNIVERSE_10K_FILENAME, "rt", encoding="utf-8") as f,
-        open(
-            FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME,
-            "w",
-            encoding="utf-8",
-        ) as intermediary_file,
+        gzip.open(UNIVERSE_10K_FILENAME, "rb") as f,
+        open_intermediary_writer() as intermediary_writer,
+        (
+            CellTypePopulationsParquetWriter(
+                FILTERED_FTU_CELL_TYPE_POPULATIONS_PARQUET_FILENAME
+            )
+            if write_parquet
+            else contextlib.nullcontext()
+        ) as parquet_writer,
+        track_performance("filter_raw_data: line loop") as perf,
     ):
         # tqdm with no total (dynamic progress)
-        for line in tqdm(f, desc="Processing JSONL lines", unit="line"):
-            # Guard clauses
-            if not line.strip():
-                continue
-            # Quick text pre-filter — skips most lines cheaply
-            if not pattern.search(line[:N]):
-                continue  # no dataset ID → skip
-
-            try:
-                cell_summary = ujson.loads(line)
-            except ujson.JSONDecodeError as e:
-                tqdm.write(f"⚠️ Skipping invalid JSON line: {e}")
+        lines = tqdm(f, desc="Processing JSONL lines", unit="line")
+
+        if workers > 1:
+            tqdm.write(f"Filtering with {workers} worker processes.")
+            results = iterate_filtered_lines_parallel(
+                lines, pattern, filter_args, workers, batch_size
+            )
+        else:
+            results = (
+                filter_cell_summary_line(raw_line.decode("utf-8"), *filter_args)
+                for raw_line in lines
+            )
+
+        for result in results:
+            if result is None:
                 continue
 
-            current_dataset_id = cell_summary["cell_source"]
+            record, current_dataset_id, matches, rows = result
+
+            if current_dataset_id not in datasets_with_ftus:
+                datasets_with_ftus[current_dataset_id] = []
+                lines.set_postfix(datasets=len(datasets_with_ftus), refresh=False)
+            datasets_with_ftus[current_dataset_id].extend(matches)
+
+            intermediary_writer.write(record, current_dataset_id)
+
+            if parquet_writer is not None:
+                parquet_writer.write_rows(rows)
+
+        perf.records = lines.n
+
+    tqdm.write(
+        f"Kept {intermediary_writer.records} records of {len(datasets_with_ftus)} "
+        "datasets with CTs exclusive to FTUs."
+    )
+
+    with open(FILTERED_DATASET_METADATA_FILENAME, "w") as f:
+        json.dump(datasets_with_ftus, f, indent=4)  # indent=4 makes it pretty
+
+
+def filter_raw_data_duckdb(index: FtuIndex, fetch_size: int = 100):
+    """
+    Filter the HRApop Universe file with one DuckDB query instead of the Python line loop.
+
+    DuckDB reads the gzipped JSONL file with its own parallel reader, unnests each record's
+    `summary`, and joins the cell types against the datasets of interest and the
+    FTU-exclusive CTs from the index. Sorts and aggregations spill to DUCKDB_TEMP_DIRECTORY
+    once DUCKDB_MEMORY_LIMIT is reached.
+
+    Records are read as raw JSON text rather than typed columns, and the query only
+    returns the kept records with the positions of their kept CTs. The summary is cut
+    down in Python, so numbers and nulls are written exactly as `filter_raw_data()`
+    writes them (DuckDB's type detection would turn an int like 1 into 1.0). Lines that
+    are not valid JSON are skipped, as there.
+
+    Writes the same intermediary and dataset metadata files as `filter_raw_data()`, with
+    records in file order, so the two backends can be cross-checked.
+
+    Args:
+        index (FtuIndex): Lookups built from CELL_TYPES_IN_FTUS and the datasets of interest.
+        fetch_size (int, optional): Records fetched from DuckDB at a time. Defaults to 100.
+    """
+    datasets_of_interest = pd.DataFrame(
+        list(index.organ_by_dataset.items()), columns=["dataset_id", "organ_id_short"]
+    )
+    ftu_exclusive_cts = pd.DataFrame(
+        [
+            (organ_id_short, ct_iri, match_index, match["ftu_purl"])
+            for (organ_id_short, ct_iri), matches in index.matches_by_organ_ct.items()
+            for match_index, match in enumerate(matches)
+        ],
+        columns=["organ_id_short", "ct_iri", "match_index", "ftu_purl"],
+    )
 
-            if current_dataset_id in unique_dataset_ids_of_interest:
-                # tqdm.write(
-                #     f"Dataset {current_dataset_id} is of interest, now checking its cell types."
-                # )
-                keep_summaries = []
+    DUCKDB_TEMP_DIRECTORY.mkdir(parents=True, exist_ok=True)
+
+    con = duckdb.connect()
+    con.execute("SET preserve_insertion_order = true")
+    con.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+    con.execute(f"SET temp_directory = '{DUCKDB_TEMP_DIRECTORY.as_posix()}'")
+    if DUCKDB_THREADS:
+        con.execute(f"SET threads = {int(DUCKDB_THREADS)}")
+    con.register("datasets_of_interest", datasets_of_interest)
+    con.register("ftu_exclusive_cts", ftu_exclusive_cts)
+
+    universe = (
+        f"read_json_objects('{UNIVERSE_10K_FILENAME.as_posix()}', "
+        "format = 'newline_delimited', ignore_errors = true, "
+        f"maximum_object_size = {DUCKDB_MAXIMUM_OBJECT_SIZE})"
+    )
 
-                for cell_type in cell_summary.get("summary", []):
-                    organ_id = next(
-                        (
-                            v
-                            for d in datasets_of_interest
-                            for k, v in d.items()
-                            if k == current_dataset_id
-                        ),
-                        "ORGAN NOT FOUND",  # default if not found
-                    )
+    query = f"""
+        WITH universe AS (
+            -- streaming row_number() keeps the position of each line in the file
+            SELECT row_number() OVER () AS record_index, json
+            FROM {universe}
+        ),
+        records AS MATERIALIZED (
+            -- invalid lines are NULL and never join
+            SELECT u.record_index, u.json, d.organ_id_short
+            FROM universe u
+            JOIN datasets_of_interest d ON (u.json ->> '$.cell_source') = d.dataset_id
+        ),
+        cell_types AS (
+            SELECT
+                record_index,
+                organ_id_short,
+                unnest(CAST(json -> '$.summary' AS JSON[])) AS cell_type,
+                generate_subscripts(CAST(json -> '$.summary' AS JSON[]), 1) AS row_index
+            FROM records
+        ),
+        kept_cell_types AS (
+            SELECT
+                c.record_index,
+                c.row_index,
+                list(
+                    {{'ct_iri': e.ct_iri, 'ftu_purl': e.ftu_purl}} ORDER BY e.match_index
+                ) AS matches
+            FROM cell_types c
+            JOIN ftu_exclusive_cts e
+                ON e.organ_id_short = c.organ_id_short
+                AND e.ct_iri = (c.cell_type ->> '$.cell_id')
+            GROUP BY c.record_index, c.row_index
+        ),
+        kept_records AS (
+            SELECT
+                record_index,
+                list(row_index ORDER BY row_index) AS row_indexes,
+                flatten(list(matches ORDER BY row_index)) AS matches
+            FROM kept_cell_types
+            GROUP BY record_index
+        )
+        SELECT r.json, k.row_indexes, k.matches
+        FROM kept_records k
+        JOIN records r USING (record_index)
+        ORDER BY record_index
+    """
 
-                    matches = is_cell_type_exclusive_to_ftu(
-                        cell_type.get("cell_id"), organ_id, cell_types_in_ftus
-                    )
+    datasets_with_ftus = {}
+    write_parquet = INTERMEDIARY_FORMAT == "parquet"
 
-                    if matches:
-                        keep_summaries.append(cell_type)
-                        tqdm.write(
-                            f"{cell_type['cell_id']} is exclusive to FTU. Matches: "
-                        )
-                        tqdm.write(str(matches))
+    print(f"Now filtering {UNIVERSE_10K_FILENAME} with DuckDB.")
 
-                        if current_dataset_id not in datasets_with_ftus:
-                            datasets_with_ftus[current_dataset_id] = []
-                        datasets_with_ftus[current_dataset_id].extend(matches)
+    with (
+        open_intermediary_writer() as intermediary_writer,
+        (
+            CellTypePopulationsParquetWriter(
+                FILTERED_FTU_CELL_TYPE_POPULATIONS_PARQUET_FILENAME
+            )
+            if write_parquet
+            else contextlib.nullcontext()
+        ) as parquet_writer,
+        tqdm(desc="Writing filtered records", unit="record") as pbar,
+        track_performance("filter_raw_data_duckdb: query") as perf,
+    ):
+        con.execute(query)
 
-                if keep_summaries:
-                    tqdm.write(
-                        f"Found {len(datasets_with_ftus[current_dataset_id])} CT(s) in dataset {current_dataset_id} that is exclusive to FTU."
-                    )
+        while batch := con.fetchmany(fetch_size):
+            for line, row_indexes, matches in batch:
+                # Same record as filter_cell_summary_line(): the summary, cut down, goes last
+                record = ujson.loads(line)
+                summary = record.pop("summary")
+                record["summary"] = [summary[i - 1] for i in row_indexes]
+                current_dataset_id = record["cell_source"]
 
-                    keep_cell_type_population = {
-                        k: v for k, v in cell_summary.items() if k != "summary"
-                    }
+                if current_dataset_id not in datasets_with_ftus:
+                    datasets_with_ftus[current_dataset_id] = []
+                datasets_with_ftus[current_dataset_id].extend(matches)
 
-                    keep_cell_type_population["summary"] = keep_summaries
+                intermediary_writer.write(json.dumps(record), current_dataset_id)
 
-                    intermediary_file.write(
-                        json.dumps(keep_cell_type_population) + "\n"
-                    )
+                if parquet_writer is not None:
+                    parquet_writer.write_rows(flatten_cell_type_population(record))
 
-                    tqdm.write("Wrote to file.")
+            pbar.update(len(batch))
 
-                    tqdm.write("")
+        perf.records = pbar.n
 
-                    # tqdm.write(
-                    #     f"Datasets with confirmed FTUs is now: {datasets_with_ftus}."
-                    # )
+    con.close()
 
     with open(FILTERED_DATASET_METADATA_FILENAME, "w") as f:
         json.dump(datasets_with_ftus, f, indent=4)  # indent=4 makes it pretty
 
 
+@track_performance(Path(__file__).stem)
 def main():
     # Driver code
 
@@ -202,8 +499,14 @@ def main():
     # Identify datasets of interest before iterating through big ZIP file
     datasets_of_interest = identify_datasets_of_interest(cell_types_in_ftus, metadata)
 
+    # Precompute the (organ, CT) → FTU and dataset → organ lookups once
+    index = FtuIndex(cell_types_in_ftus, datasets_of_interest)
+
     # Filter raw data with datasets of interest in mind
-    filter_raw_data(datasets_of_interest, cell_types_in_ftus)
+    if FILTER_BACKEND == "duckdb":
+        filter_raw_data_duckdb(index)
+    else:
+        filter_raw_data(index)
 
 
 if __name__ == "__main__":
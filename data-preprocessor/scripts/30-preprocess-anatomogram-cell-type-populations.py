@@ -0,0 +1,448 @@
+from shared import *
+
+MATRIX_SUFFIX = ".aggregated_filtered_normalised_counts.mtx"
+
+# Members of the SCEA zip that are extracted: the matrix is read from the zip instead
+# with ANATOMOGRAM_MTX_FROM_ZIP
+MATRIX_MEMBER_SUFFIXES = (".mtx_rows", ".mtx_cols") + (
+    () if ANATOMOGRAM_MTX_FROM_ZIP else (".mtx",)
+)
+
+# Columns of the SCEA experiment design TSV with the CL term and label of each cell,
+# in order of preference
+CELL_TYPE_COLUMNS = [
+    (
+        "Factor Value Ontology Term[inferred cell type - ontology labels]",
+        "Factor Value[inferred cell type - ontology labels]",
+    ),
+    (
+        "Factor Value Ontology Term[inferred cell type - authors labels]",
+        "Factor Value[inferred cell type - authors labels]",
+    ),
+]
+
+
+def download_and_unzip_anatomogram_data(
+    url_counts: str, url_experiment: str, experiment_name: str, organ_name: str
+):
+    """
+    Download and extract anatomogram dataset files for a specific organ.
+
+    This function downloads a ZIP archive containing normalized count data and a TSV file
+    containing experimental design metadata for a given organ. After downloading, it extracts
+    the matrix files (see MATRIX_MEMBER_SUFFIXES) from the ZIP archive into the organ's
+    raw data directory.
+
+    Args:
+        url_counts (str): URL pointing to the ZIP file with normalized count data.
+        url_experiment (str): URL pointing to the experimental design (TSV) file.
+        experiment_name (str): The base name for the experimental design file (without extension).
+        organ_name (str): The name of the organ (used to create subdirectories and filenames).
+
+    Returns:
+        None
+            The function performs file download and extraction as side effects,
+            saving results under `ANATOMOGRAMN_RAW_DATA / organ_name`.
+
+    Raises:
+        requests.HTTPError: If downloading either file fails due to an HTTP error.
+        OSError: If writing, saving, or extracting files to disk fails.
+    """
+    download_from_url(
+        url_counts, ANATOMOGRAMN_RAW_DATA / organ_name, f"{organ_name}.zip"
+    )
+    download_from_url(
+        url_experiment, ANATOMOGRAMN_RAW_DATA / organ_name, f"{experiment_name}.tsv"
+    )
+    unzip_to_folder(
+        f"{ANATOMOGRAMN_RAW_DATA}/{organ_name}/{organ_name}.zip",
+        f"{ANATOMOGRAMN_RAW_DATA}/{organ_name}",
+        suffixes=MATRIX_MEMBER_SUFFIXES,
+    )
+
+
+def matrix_location(organ_metadata: dict) -> tuple[Path, str | None]:
+    """
+    Return where to read an experiment's normalised counts from, for `iterate_mtx_entries()`.
+
+    Returns:
+        tuple[Path, str | None]: The extracted .mtx file and None, or with
+        ANATOMOGRAM_MTX_FROM_ZIP the zip file and the name of the .mtx file in it.
+    """
+    if not ANATOMOGRAM_MTX_FROM_ZIP:
+        return experiment_file(organ_metadata, MATRIX_SUFFIX), None
+
+    zip_path = (
+        ANATOMOGRAMN_RAW_DATA / organ_metadata["name"] / f"{organ_metadata['name']}.zip"
+    )
+    name = f"{organ_metadata['experiment_id']}{MATRIX_SUFFIX}"
+    with zipfile.ZipFile(zip_path) as archive:
+        member = next((m for m in archive.namelist() if Path(m).name == name), None)
+    if member is None:
+        raise FileNotFoundError(f"No {name} in {zip_path}")
+    return zip_path, member
+
+
+def experiment_file(organ_metadata: dict, suffix: str) -> Path:
+    """Return the path of one of the unzipped files of an organ's SCEA experiment."""
+    return (
+        ANATOMOGRAMN_RAW_DATA
+        / organ_metadata["name"]
+        / f"{organ_metadata['experiment_id']}{suffix}"
+    )
+
+
+def read_genes_and_cells(organ_metadata: dict) -> tuple[pd.DataFrame, pd.Series]:
+    """
+    Read the genes (rows) and cells (columns) of the normalised counts of an experiment.
+
+    Args:
+        organ_metadata (dict): An entry of `anatomogram_files_json`.
+
+    Returns:
+        tuple[pd.DataFrame, pd.Series]: The genes, with 'ensembl_id' and 'gene_label'
+        columns, and the cell (assay) IDs, in matrix order.
+    """
+    genes = pd.read_csv(
+        experiment_file(organ_metadata, MATRIX_SUFFIX + "_rows"),
+        names=["ensembl_id", "gene_label"],
+        sep="\t",
+    )
+    cells = pd.read_csv(
+        experiment_file(organ_metadata, MATRIX_SUFFIX + "_cols"),
+        names=["assay"],
+    )["assay"]
+    return genes, cells
+
+
+def read_cell_annotations(organ_metadata: dict) -> pd.DataFrame:
+    """
+    Map each cell (assay) of an experiment to its dataset and CL cell type.
+
+    Datasets are donors and organ parts, with the same IDs as in the anatomogram
+    dataset metadata. Cells without a CL term are dropped.
+
+    Args:
+        organ_metadata (dict): An entry of `anatomogram_files_json`.
+
+    Returns:
+        pd.DataFrame: One row per annotated cell, indexed by assay, with 'dataset_id',
+        'cell_id' (CURIE) and 'cell_label' columns.
+    """
+    design = pd.read_csv(experiment_file(organ_metadata, ".tsv"), sep="\t")
+
+    ct_iri_column, ct_label_column = next(
+        (
+            columns
+            for columns in CELL_TYPE_COLUMNS
+            if set(columns) <= set(design.columns)
+        ),
+        (None, None),
+    )
+    if ct_iri_column is None:
+        raise ValueError(
+            f"No inferred cell type columns in the design of {organ_metadata['experiment_id']}"
+        )
+
+    annotations = pd.DataFrame(
+        {
+            "dataset_id": organ_metadata["paper_doi"]
+            + "#"
+            + design["Sample Characteristic[individual]"].astype(str)
+            + "$"
+            + design["Sample Characteristic[organism part]"].str.replace(" ", "-"),
+            "cell_id": get_id_from_iri_series(design[ct_iri_column]),
+            "cell_label": design[ct_label_column],
+        }
+    ).set_index(design["Assay"])
+
+    annotations = annotations[
+        annotations["cell_id"].str.startswith("CL:", na=False)
+        & annotations["dataset_id"].notna()
+    ]
+    return annotations[~annotations.index.duplicated(keep="first")]
+
+
+def aggregate_cell_types(
+    mtx_path: Path,
+    group_codes: np.ndarray,
+    group_count: int,
+    gene_count: int,
+    member: str | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count the cells and sum the expression, and its square, of every gene per group of cells.
+
+    The genes × cells Matrix Market file is streamed in blocks of entries (see
+    `iterate_mtx_entries()`), and each block is added to the groups × genes sums
+    with `np.bincount`, so memory does not grow with the number of cells.
+
+    Args:
+        mtx_path (Path): The normalised counts, genes × cells.
+        group_codes (np.ndarray): Group of each cell (column), or -1 to leave it out.
+        group_count (int): Number of groups.
+        gene_count (int): Number of genes (rows).
+        member (str | None, optional): Name of the .mtx file if `mtx_path` is the zip
+            file containing it. Defaults to None.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Cells per group, and the groups ×
+        genes sums and sums of squares.
+
+    Raises:
+        ValueError: If the matrix does not have `gene_count` rows and one column per cell.
+    """
+    shape, entries = iterate_mtx_entries(mtx_path, member=member)
+    if shape != (gene_count, len(group_codes)):
+        raise ValueError(
+            f"{member or mtx_path.name} is {shape[0]} × {shape[1]}, "
+            f"expected {gene_count} genes × {len(group_codes)} cells"
+        )
+
+    cell_counts = np.bincount(group_codes[group_codes >= 0], minlength=group_count)
+    size = group_count * gene_count
+    sums = np.zeros(size)
+    sums_of_squares = np.zeros(size)
+
+    for rows, cols, values in entries:
+        groups = group_codes[cols]
+        in_group = groups >= 0
+        # Index of (group, gene) in the flattened groups × genes arrays
+        flat = groups[in_group].astype(np.int64) * gene_count + rows[in_group]
+        values = values[in_group].astype(np.float64)
+        sums += np.bincount(flat, weights=values, minlength=size)
+        sums_of_squares += np.bincount(flat, weights=values * values, minlength=size)
+
+    return (
+        cell_counts,
+        sums.reshape(group_count, gene_count),
+        sums_of_squares.reshape(group_count, gene_count),
+    )
+
+
+def build_cell_summaries(
+    organ_metadata: dict, top_n: int = ANATOMOGRAM_TOP_N_GENES
+) -> list[dict]:
+    """
+    Build HRApop-style CellSummaries for the datasets of one SCEA experiment.
+
+    Each CellSummaryRow holds the number and percentage of the dataset's cells of one
+    CL cell type and the mean normalised expression of its `top_n` most expressed genes.
+
+    Args:
+        organ_metadata (dict): An entry of `anatomogram_files_json`.
+        top_n (int, optional): Genes kept per cell type. Defaults to ANATOMOGRAM_TOP_N_GENES.
+
+    Returns:
+        list[dict]: One CellSummary per dataset.
+    """
+    genes, cells = read_genes_and_cells(organ_metadata)
+    annotations = read_cell_annotations(organ_metadata)
+
+    # One group per (dataset, cell type), for each cell of the matrix
+    cell_annotations = annotations.reindex(cells)
+    groups = (
+        cell_annotations.dropna(subset=["cell_id"])
+        .groupby(["dataset_id", "cell_id"], sort=True)["cell_label"]
+        .first()
+        .reset_index()
+    )
+    group_index = pd.MultiIndex.from_frame(groups[["dataset_id", "cell_id"]])
+    group_codes = group_index.get_indexer(
+        pd.MultiIndex.from_frame(cell_annotations[["dataset_id", "cell_id"]])
+    )
+
+    mtx_path, member = matrix_location(organ_metadata)
+    cell_counts, sums, _ = aggregate_cell_types(
+        mtx_path, group_codes, len(groups), len(genes), member
+    )
+    print(
+        f"{organ_metadata['name']}: {int(cell_counts.sum())} of {len(cells)} cells in "
+        f"{len(groups)} cell types of {groups['dataset_id'].nunique()} datasets"
+    )
+
+    ensembl_ids = genes["ensembl_id"].to_numpy()
+    gene_labels = genes["gene_label"].to_numpy()
+    cells_per_dataset = (
+        pd.Series(cell_counts).groupby(groups["dataset_id"].to_numpy()).sum()
+    )
+
+    summaries = {}
+    for g, group in enumerate(groups.itertuples(index=False)):
+        gene_rows = np.flatnonzero(sums[g])
+        means = sums[g, gene_rows] / cell_counts[g]
+
+        # Top genes by mean expression, ties in gene order
+        order = np.argsort(-means, kind="stable")[:top_n]
+
+        summaries.setdefault(group.dataset_id, []).append(
+            {
+                "@type": "CellSummaryRow",
+                "cell_id": group.cell_id,
+                "cell_label": group.cell_label,
+                "count": int(cell_counts[g]),
+                "percentage": float(
+                    cell_counts[g] / cells_per_dataset[group.dataset_id]
+                ),
+                "gene_expr": [
+                    {
+                        "@type": "GeneExpression",
+                        "ensembl_id": ensembl_ids[gene_rows[i]],
+                        "gene_label": gene_labels[gene_rows[i]],
+                        "mean_gene_expr_value": float(means[i]),
+                    }
+                    for i in order
+                ],
+            }
+        )
+
+    return [
+        {
+            "@type": "CellSummary",
+            "cell_source": dataset_id,
+            "annotation_method": "sc_experiment_atlas",
+            "modality": "sc_transcriptomics",
+            "summary": summary,
+        }
+        for dataset_id, summary in summaries.items()
+    ]
+
+
+def write_organ_cell_summaries(organ_metadata: dict) -> int:
+    """
+    Build the CellSummaries of one organ and write them to a gzipped JSONL file of its own.
+
+    Runs in a worker process of `extract_cell_type_populations()`.
+
+    Args:
+        organ_metadata (dict): An entry of `anatomogram_files_json`.
+
+    Returns:
+        int: Number of CellSummaries written.
+    """
+    # Built before the file is opened, so an organ that fails leaves no file behind
+    cell_summaries = build_cell_summaries(organ_metadata)
+
+    output_file = experiment_file(organ_metadata, ".cell-summaries.jsonl.gz")
+    tmp_path = output_file.with_name(output_file.name + ".tmp")
+    record_counter = 0
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for cell_summary in cell_summaries:
+            f.write(ujson.dumps(cell_summary, ensure_ascii=False) + "\n")
+            record_counter += 1
+    os.replace(tmp_path, output_file)
+    return record_counter
+
+
+@track_performance("extract_cell_type_populations")
+def extract_cell_type_populations(
+    organs: list,
+    output_file: Path,
+    download_workers: int = ANATOMOGRAM_DOWNLOAD_WORKERS,
+    workers: int = ANATOMOGRAM_WORKERS,
+) -> dict:
+    """
+    Download, unzip and aggregate the anatomogram organs in parallel, and combine their
+    CellSummaries into one gzipped JSONL file.
+
+    Downloads and unzipping run in a thread pool. As soon as an organ's files are
+    there, its aggregation is handed to a process pool. An organ that fails is
+    reported and does not stop the others. The combined file is only written if
+    every organ succeeded; the CellSummaries of each organ are also kept next to
+    its files.
+
+    Args:
+        organs (list): Entries of `anatomogram_files_json`.
+        output_file (Path): The combined gzipped JSONL file, in the order of `organs`.
+        download_workers (int, optional): Threads for downloads and unzipping.
+            Defaults to ANATOMOGRAM_DOWNLOAD_WORKERS from config.yaml.
+        workers (int, optional): Processes for the aggregation. Defaults to
+            ANATOMOGRAM_WORKERS from config.yaml.
+
+    Returns:
+        dict: Organ name → error, for every organ that failed.
+    """
+    failed = {}
+    record_counts = {}
+
+    def report_failure(organ_metadata: dict, step: str, error: Exception):
+        failed[organ_metadata["name"]] = error
+        print(f"❌ {organ_metadata['name']}: {step} failed: {error!r}")
+
+    with (
+        ThreadPoolExecutor(max_workers=download_workers) as download_pool,
+        ProcessPoolExecutor(max_workers=workers) as aggregation_pool,
+    ):
+        downloads = {
+            download_pool.submit(
+                download_and_unzip_anatomogram_data,
+                organ["url_counts"],
+                organ["url_experimental_design"],
+                organ["experiment_id"],
+                organ["name"],
+            ): organ
+            for organ in organs
+        }
+        aggregations = {}
+        for future in as_completed(downloads):
+            organ = downloads[future]
+            try:
+                future.result()
+            except Exception as e:
+                report_failure(organ, "download", e)
+                continue
+            aggregations[aggregation_pool.submit(write_organ_cell_summaries, organ)] = (
+                organ
+            )
+
+        for future in as_completed(aggregations):
+            organ = aggregations[future]
+            try:
+                record_counts[organ["name"]] = future.result()
+            except Exception as e:
+                report_failure(organ, "aggregation", e)
+                continue
+            print(f"✅ {organ['name']}: {record_counts[organ['name']]} CellSummaries")
+
+    track_performance("extract_cell_type_populations").records = sum(
+        record_counts.values()
+    )
+    if failed:
+        return failed
+
+    # Gzip files can be concatenated as they are
+    tmp_path = output_file.with_name(output_file.name + ".tmp")
+    with open(tmp_path, "wb") as out:
+        for organ in organs:
+            with open(
+                experiment_file(organ, ".cell-summaries.jsonl.gz"), "rb"
+            ) as organ_file:
+                shutil.copyfileobj(organ_file, out)
+    os.replace(tmp_path, output_file)
+
+    print(f"✅ Saved {sum(record_counts.values())} CellSummaries to {output_file}")
+    return failed
+
+
+@track_performance(Path(__file__).stem)
+def main():
+    # Driver code
+
+    failed = extract_cell_type_populations(
+        anatomogram_files_json, ANATOMOGRAM_CELL_SUMMARIES
+    )
+    if failed:
+        print(
+            f"❌ Not saving {ANATOMOGRAM_CELL_SUMMARIES}, failed: {', '.join(failed)}"
+        )
+        sys.exit(1)
+
+
+# You may want to use/crib off of the summary generator in the DCTA workflow:
+# https://github.com/hubmapconsortium/hra-workflows/blob/main/containers/extract-summary/context/main.py#L95
+
+# Also the gene expression container might be useful too
+# https://github.com/hubmapconsortium/hra-workflows/blob/main/containers/gene-expression/context/main.py
+
+if __name__ == "__main__":
+    main()
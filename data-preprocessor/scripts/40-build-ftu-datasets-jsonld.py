@@ -1,7 +1,13 @@
 from shared import *
 
 
-def build_ftu_datasets_jsonld(metadata: pd.DataFrame):
+def read_cell_sources(path: Path, compression: str) -> list[str]:
+    """Return the dataset ID of each record of one intermediary shard (in a worker process)."""
+    return [record["cell_source"] for record in iterate_shard(path, compression)]
+
+
+@track_performance("build_ftu_datasets_jsonld")
+def build_ftu_datasets_jsonld(metadata: pd.DataFrame, index: FtuIndex):
     """_summary_"""
     out_json_ld = copy.deepcopy(context_template)
 
@@ -24,18 +30,8 @@ def build_ftu_datasets_jsonld(metadata: pd.DataFrame):
         "authors": [],  # Creator(s)?
     }
 
-    ftu_to_datasets = defaultdict(set)
-
-    with open(FILTERED_DATASET_METADATA_FILENAME, "r") as f:
-        data = json.load(f)
-
-        for dataset_id, cts in data.items():
-            for ct in cts:
-                ftu = ct["ftu_purl"]
-                ftu_to_datasets[ftu].add(dataset_id)
-
-        # convert sets → lists
-        ftu_to_datasets = {k: list(v) for k, v in ftu_to_datasets.items()}
+    # FTU → datasets, precomputed from the filtered dataset metadata
+    ftu_to_datasets = index.datasets_by_ftu
 
     # save to file
     with open(FTU_TO_DATASETS, "w") as output:
@@ -51,20 +47,23 @@ def build_ftu_datasets_jsonld(metadata: pd.DataFrame):
         ["handler", "provider_name"]
     ].to_dict("index")
 
-    # Invert: dataset_id -> [ftu1, ftu2, ...]
-    dataset_to_ftus = defaultdict(list)
-    for ftu, dataset_ids in ftu_to_datasets.items():
-        for dataset_id in dataset_ids:
-            dataset_to_ftus[dataset_id].append(ftu)
-
     # Collect which dataset_ids belong to which FTU in one pass
     ftu_to_dataset_ids = defaultdict(set)
 
-    for obj in iterate_through_json_lines(
-        FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME
-    ):
-        dataset_id = obj["cell_source"]
-        for ftu in dataset_to_ftus.get(dataset_id, ()):
+    if INTERMEDIARY_FORMAT == "shards":
+        dataset_ids = (
+            dataset_id
+            for shard_dataset_ids in map_intermediary_shards(read_cell_sources)
+            for dataset_id in shard_dataset_ids
+        )
+    else:
+        dataset_ids = (
+            obj["cell_source"]
+            for obj in iterate_cell_type_populations(columns=["cell_source"])
+        )
+
+    for dataset_id in dataset_ids:
+        for ftu in index.ftus_for_dataset(dataset_id):
             ftu_to_dataset_ids[ftu].add(dataset_id)
 
     graph_list = []
@@ -100,12 +99,17 @@ def build_ftu_datasets_jsonld(metadata: pd.DataFrame):
         json.dump(out_json_ld, f, ensure_ascii=False, indent=4)
 
 
+@track_performance(Path(__file__).stem)
 def main():
     # Driver code
 
     metadata = pd.read_csv(UNIVERSE_METADATA_FILENAME).reset_index(drop=True)
 
-    build_ftu_datasets_jsonld(metadata=metadata)
+    index = FtuIndex.from_files(
+        filtered_dataset_metadata_path=FILTERED_DATASET_METADATA_FILENAME
+    )
+
+    build_ftu_datasets_jsonld(metadata=metadata, index=index)
 
 
 if __name__ == "__main__":
@@ -1,139 +1,259 @@
 from shared import *
 
+GENE_RANKINGS = ("mean_expression", "specificity", "input_order")
+
+
+def transform_gene(gene: dict) -> dict:
+    """
+    Build a GeneExpression node from one `gene_expr` entry of an HRApop CellSummaryRow.
+
+    The output dict is built directly from the input, which is left untouched.
+
+    Args:
+        gene (dict): A gene with 'ensembl_id' and 'mean_gene_expr_value' keys.
+
+    Returns:
+        dict: The gene with 'ensemble_id' and 'mean_expression' keys and @type GeneExpression.
+
+    Raises:
+        TypeError: If the gene is not a dict.
+    """
+    if not isinstance(gene, dict):
+        tqdm.write(f"{Fore.YELLOW}WARNING: something went wrong!{Style.RESET_ALL}")
+        tqdm.write(f"Expected gene dict, got {type(gene)}: {gene}")
+        tqdm.write("")
+        raise TypeError("Invalid gene format")
+
+    transformed_gene = {
+        k: v for k, v in gene.items() if k not in ("ensembl_id", "mean_gene_expr_value")
+    }
+    transformed_gene["@type"] = "GeneExpression"
+    transformed_gene["ensemble_id"] = gene["ensembl_id"]
+    transformed_gene["mean_expression"] = gene["mean_gene_expr_value"]
+    return transformed_gene
+
+
+def mean_expression(gene: dict) -> float:
+    """Return the mean_gene_expr_value of a gene, with missing values ranked last."""
+    value = gene.get("mean_gene_expr_value")
+    return float("-inf") if value is None else value
+
+
+def sum_gene_expression(summaries: list) -> dict:
+    """
+    Sum the mean expression of each gene over all CellSummaryRows of one dataset.
+
+    Used to rank genes by specificity: the mean expression of a gene in the other
+    CTs of the dataset is its total minus its own value, divided by the number of
+    other rows. Genes that are not listed for a row count as 0.
+
+    Args:
+        summaries (list): The 'summary' list of a CellSummary.
+
+    Returns:
+        dict: Total mean expression by ensembl_id.
+    """
+    totals = defaultdict(float)
+    for summary in summaries:
+        for gene in summary.get("gene_expr", []):
+            if isinstance(gene, dict) and gene.get("mean_gene_expr_value") is not None:
+                totals[gene.get("ensembl_id")] += gene["mean_gene_expr_value"]
+    return totals
+
+
+def select_top_genes(
+    genes: list,
+    top_n: int = TOP_N_GENES,
+    ranking: str = GENE_RANKING,
+    expression_totals: dict | None = None,
+    row_count: int = 1,
+) -> list:
+    """
+    Select the top-N genes of a CellSummaryRow.
+
+    Uses a heap of size `top_n` (`heapq.nlargest`), so the up to 10k genes of a row
+    are never fully sorted. Ties keep their input order.
+
+    Args:
+        genes (list): The 'gene_expr' list of a CellSummaryRow.
+        top_n (int, optional): Number of genes to keep. Defaults to TOP_N_GENES.
+        ranking (str, optional): One of GENE_RANKINGS. Defaults to GENE_RANKING.
+        expression_totals (dict | None, optional): Output of `sum_gene_expression()` for
+            the dataset of the row, needed for "specificity". Defaults to None.
+        row_count (int, optional): Number of CellSummaryRows in the dataset. Defaults to 1.
+
+    Returns:
+        list: The selected genes, highest ranked first.
+
+    Raises:
+        ValueError: If the ranking is unknown.
+    """
+    if ranking == "input_order":
+        return genes[:top_n]
+
+    if ranking == "mean_expression":
+        return heapq.nlargest(top_n, genes, key=mean_expression)
+
+    if ranking == "specificity":
+        others = max(row_count - 1, 1)
+
+        def specificity(gene: dict) -> float:
+            value = mean_expression(gene)
+            if value == float("-inf"):
+                return value
+            total = expression_totals.get(gene.get("ensembl_id"), 0.0)
+            return value - (total - value) / others
+
+        return heapq.nlargest(top_n, genes, key=specificity)
+
+    raise ValueError(
+        f"Unknown GENE_RANKING {ranking!r}, expected one of {GENE_RANKINGS}"
+    )
+
+
+def transform_cell_summary_row(
+    summary: dict, cell_id_curie: str, genes: list | None = None
+) -> dict:
+    """
+    Build an output CellSummaryRow from an HRApop CellSummaryRow.
+
+    Only the given (already selected) genes are transformed, and no part of the
+    (up to 10k genes long) input is copied.
+
+    Args:
+        summary (dict): A CellSummaryRow with 'cell_label' and 'gene_expr' keys.
+        cell_id_curie (str): The CURIE of the row's cell type, e.g. 'CL:1000768'.
+        genes (list | None, optional): Genes to keep, see `select_top_genes()`. Defaults
+            to the top genes of the row by GENE_RANKING.
+
+    Returns:
+        dict: The row with a full cell_id IRI, a lower-case cell_label and a 'genes' list.
+    """
+    if genes is None:
+        genes = select_top_genes(summary.get("gene_expr", []))
+
+    transformed_summary = {k: v for k, v in summary.items() if k != "gene_expr"}
+    transformed_summary["@type"] = "CellSummaryRow"
+    transformed_summary["cell_id"] = ontology_id_short_to_url(cell_id_curie)
+    transformed_summary["cell_label"] = summary["cell_label"].lower()
+    transformed_summary["genes"] = [transform_gene(gene) for gene in genes]
+    return transformed_summary
+
+
+def transform_cell_summaries(
+    summaries: list,
+    allowed_cts: set[str],
+    top_n: int = TOP_N_GENES,
+    ranking: str = GENE_RANKING,
+    expression_totals: dict | None = None,
+) -> list:
+    """
+    Transform the CellSummaryRows of one dataset whose CT is allowed for an FTU.
+
+    Rows that fail to transform are reported and skipped.
+
+    Args:
+        summaries (list): The 'summary' list of a CellSummary.
+        allowed_cts (set[str]): CURIEs of the CTs to keep.
+        top_n (int, optional): Number of genes to keep per row. Defaults to TOP_N_GENES.
+        ranking (str, optional): One of GENE_RANKINGS. Defaults to GENE_RANKING.
+        expression_totals (dict | None, optional): Output of `sum_gene_expression()`,
+            needed for "specificity". Defaults to None.
+
+    Returns:
+        list: The transformed rows.
+    """
+    keep_summary = []
+    for summary in summaries:
+        try:
+            cell_id_curie = get_id_from_iri(summary.get("cell_id"))
+            if not cell_id_curie or cell_id_curie not in allowed_cts:
+                continue
 
-def build_unique_ct_lookup(cell_types_in_ftus: dict) -> dict[str, set[str]]:
-    """Build FTU -> set(CT CURIE) where CT is unique to exactly one FTU in an organ."""
-    organ_ct_to_ftus = defaultdict(set)
-
-    for ftu in cell_types_in_ftus.values():
-        organ_id = ftu.get("organ_id_short")
-        ftu_purl = ftu.get("ftu_purl")
+            genes = select_top_genes(
+                summary.get("gene_expr", []),
+                top_n,
+                ranking,
+                expression_totals,
+                len(summaries),
+            )
+            keep_summary.append(
+                transform_cell_summary_row(summary, cell_id_curie, genes)
+            )
 
-        if not organ_id or not ftu_purl:
+        except Exception as e:
+            tqdm.write(f"{Fore.YELLOW}Skipping summary due to error{Style.RESET_ALL}")
+            tqdm.write(str(e))
+            tqdm.write("")
+            tqdm.write(
+                f"{Fore.YELLOW}Skippimg summary {summary.get('cell_label', '<unknown>')}{Style.RESET_ALL}"
+            )
+            tqdm.write("")
             continue
 
-        for ct in ftu.get("cts_exclusive", []):
-            ct_curie = get_id_from_iri(ct.get("ct_iri"))
-            if ct_curie:
-                organ_ct_to_ftus[(organ_id, ct_curie)].add(ftu_purl)
-
-    unique_cts_by_ftu = defaultdict(set)
-    for (_, ct_curie), ftus in organ_ct_to_ftus.items():
-        if len(ftus) == 1:
-            unique_cts_by_ftu[next(iter(ftus))].add(ct_curie)
-
-    return unique_cts_by_ftu
-
-
-def build_ftu_cell_summaries_jsonld():
-    """_summary_"""
-
-    # turn into JSONLD files with context
-    out_json_ld = copy.deepcopy(context_template)
-
-    with open(FTU_TO_DATASETS, "r", encoding="utf-8") as f:
-        ftu_to_datasets = json.load(f)
-
-    with open(CELL_TYPES_IN_FTUS, "r", encoding="utf-8") as f:
-        cell_types_in_ftus = json.load(f)
-
-    # Keep only CTs that map to exactly one FTU within an organ.
-    unique_cts_by_ftu = build_unique_ct_lookup(cell_types_in_ftus)
-
-    dataset_to_ftus = defaultdict(set)
-    for ftu_purl, dataset_ids in ftu_to_datasets.items():
-        for dataset_id in dataset_ids:
-            dataset_to_ftus[dataset_id].add(ftu_purl)
-
-    obj_counter = 0
-    for obj in iterate_through_json_lines(
-        FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME
-    ):
-        obj_counter += 1
-        dataset_id = obj.get("cell_source")
-        candidate_ftus = dataset_to_ftus.get(dataset_id, set())
-
-        for ftu in candidate_ftus:
-            suffix = ftu.rsplit("/", 1)[-1]
-            cell_source = f"{dataset_id}#CellSummary_{suffix}"
-            allowed_cts = unique_cts_by_ftu.get(ftu, set())
-
+    return keep_summary
+
+
+def build_cell_summaries(
+    obj: dict,
+    obj_number: int,
+    index: FtuIndex,
+    unique_cts_by_ftu: dict,
+    top_n: int = TOP_N_GENES,
+    ranking: str = GENE_RANKING,
+    verbose: bool = True,
+):
+    """
+    Build the output CellSummaries of one filtered record, one per FTU of its dataset
+    that keeps at least one CellSummaryRow.
+
+    Args:
+        obj (dict): A CellSummary record of the intermediary.
+        obj_number (int): Position of the record, for the log.
+        index (FtuIndex): With the FTUs of each filtered dataset.
+        unique_cts_by_ftu (dict): From `FtuIndex.unique_cts_by_ftu()`.
+        top_n (int, optional): Number of genes to keep per row. Defaults to TOP_N_GENES.
+        ranking (str, optional): One of GENE_RANKINGS. Defaults to GENE_RANKING.
+        verbose (bool, optional): Log each CellSummary. Defaults to True.
+
+    Yields:
+        dict: The CellSummary of each FTU.
+    """
+    dataset_id = obj.get("cell_source")
+    candidate_ftus = index.ftus_for_dataset(dataset_id)
+
+    expression_totals = None
+    if ranking == "specificity" and candidate_ftus:
+        expression_totals = sum_gene_expression(obj.get("summary", []))
+
+    for ftu in candidate_ftus:
+        suffix = ftu.rsplit("/", 1)[-1]
+        cell_source = f"{dataset_id}#CellSummary_{suffix}"
+        allowed_cts = unique_cts_by_ftu.get(ftu, set())
+
+        if verbose:
             tqdm.write("")
-            tqdm.write(f"Now working on cell_source #{obj_counter}: {cell_source}")
+            tqdm.write(f"Now working on cell_source #{obj_number}: {cell_source}")
             tqdm.write("")
 
-            keep_summary = []
-            for summary in obj.get("summary", []):
-                try:
-                    cell_id_curie = get_id_from_iri(summary.get("cell_id"))
-                    if not cell_id_curie or cell_id_curie not in allowed_cts:
-                        continue
-
-                    transformed_summary = copy.deepcopy(summary)
-                    transformed_summary["@type"] = "CellSummaryRow"
-                    transformed_summary["genes"] = transformed_summary.pop("gene_expr", [])
-                    transformed_summary["cell_id"] = (
-                        "http://purl.obolibrary.org/obo/"
-                        + cell_id_curie.replace(":", "_")
-                    )
-                    transformed_summary["cell_label"] = transformed_summary[
-                        "cell_label"
-                    ].lower()
-
-                    gene_counter = 0
-                    keep_genes = []
-                    for gene in transformed_summary["genes"]:
-                        if gene_counter > 10:
-                            break
-
-                        gene_counter += 1
-
-                        if not isinstance(gene, dict):
-                            tqdm.write(
-                                f"{Fore.YELLOW}WARNING: something went wrong!{Style.RESET_ALL}"
-                            )
-                            tqdm.write(f"Expected gene dict, got {type(gene)}: {gene}")
-                            tqdm.write("")
-                            raise TypeError("Invalid gene format")
-
-                        transformed_gene = copy.deepcopy(gene)
-                        transformed_gene["@type"] = "GeneExpression"
-                        transformed_gene["ensemble_id"] = transformed_gene.pop(
-                            "ensembl_id"
-                        )
-                        transformed_gene["mean_expression"] = transformed_gene.pop(
-                            "mean_gene_expr_value"
-                        )
-                        keep_genes.append(transformed_gene)
-
-                    transformed_summary["genes"] = keep_genes
-                    keep_summary.append(transformed_summary)
-
-                except Exception as e:
-                    tqdm.write(
-                        f"{Fore.YELLOW}Skipping summary due to error{Style.RESET_ALL}"
-                    )
-                    tqdm.write(str(e))
-                    tqdm.write("")
-                    tqdm.write(
-                        f"{Fore.YELLOW}Skippimg summary {summary.get('cell_label', '<unknown>')}{Style.RESET_ALL}"
-                    )
-                    tqdm.write("")
-                    continue
+        keep_summary = transform_cell_summaries(
+            obj.get("summary", []),
+            allowed_cts,
+            top_n,
+            ranking,
+            expression_totals,
+        )
 
-            if not keep_summary:
-                continue
+        if not keep_summary:
+            continue
 
-            out_obj = {
-                k: copy.deepcopy(v)
-                for k, v in obj.items()
-                if k not in {"summary", "modality"}
-            }
-            out_obj["cell_source"] = cell_source
-            out_obj["annotation_method"] = "Aggregation"
-            out_obj["biomarker_type"] = "gene"
-            out_obj["summary"] = keep_summary
+        out_obj = {k: v for k, v in obj.items() if k not in {"summary", "modality"}}
+        out_obj["cell_source"] = cell_source
+        out_obj["annotation_method"] = "Aggregation"
+        out_obj["biomarker_type"] = "gene"
+        out_obj["summary"] = keep_summary
 
+        if verbose:
             tqdm.write(
                 f"Done making cell summary for {cell_source} with len = {len(keep_summary)}."
             )
@@ -141,18 +261,164 @@ def build_ftu_cell_summaries_jsonld():
             tqdm.write("======================")
             tqdm.write("")
 
-            out_json_ld["@graph"].append(out_obj)
-
-    # Write to file
-    tqdm.write(f"Now saving to {FTU_CELL_SUMMARIES_OUTPUT}")
-    with open(FTU_CELL_SUMMARIES_OUTPUT, "w", encoding="utf-8") as f:
-        json.dump(out_json_ld, f, ensure_ascii=False, indent=4)
+        yield out_obj
+
+
+# State shared with worker processes in sharded mode, set by init_cell_summaries_worker()
+cell_summaries_worker_state = {}
+
+
+def init_cell_summaries_worker(
+    index: FtuIndex,
+    unique_cts_by_ftu: dict,
+    indent: int | None,
+    top_n: int,
+    ranking: str,
+    parts_dir: Path,
+):
+    """Store the lookup data once per worker process instead of once per shard."""
+    cell_summaries_worker_state["args"] = (index, unique_cts_by_ftu, top_n, ranking)
+    cell_summaries_worker_state["parts_dir"] = Path(parts_dir)
+    # Only used to serialize nodes exactly like the writer of the output
+    cell_summaries_worker_state["serializer"] = JsonLdGraphWriter(
+        FTU_CELL_SUMMARIES_OUTPUT, indent=indent
+    )
+
+
+def build_shard_cell_summaries(path: Path, compression: str) -> tuple[Path, int]:
+    """
+    Build the CellSummaries of the records of one intermediary shard in a worker process.
+
+    The nodes are serialized like `JsonLdGraphWriter.dumps()` does and saved to a part
+    file in the worker's parts folder, each followed by a NUL character (serialized JSON
+    has none).
+
+    Args:
+        path (Path): The shard.
+        compression (str): Its compression, see `open_shard()`.
+
+    Returns:
+        tuple[Path, int]: The part file and the number of records read.
+    """
+    serializer = cell_summaries_worker_state["serializer"]
+    part_path = cell_summaries_worker_state["parts_dir"] / f"{Path(path).name}.part"
+
+    records = 0
+    with open(
+        part_path, "w", encoding="utf-8", buffering=INTERMEDIARY_WRITE_BUFFER
+    ) as f:
+        for records, obj in enumerate(iterate_shard(path, compression), 1):
+            for out_obj in build_cell_summaries(
+                obj, records, *cell_summaries_worker_state["args"], verbose=False
+            ):
+                f.write(serializer.dumps(out_obj) + "\0")
+    return part_path, records
+
+
+def iterate_part_file(path: Path, chunk_size: int = INTERMEDIARY_WRITE_BUFFER):
+    """Yield the serialized nodes of a part file written by `build_shard_cell_summaries()`."""
+    with open(path, "r", encoding="utf-8") as f:
+        rest = ""
+        while chunk := f.read(chunk_size):
+            *nodes, rest = (rest + chunk).split("\0")
+            yield from nodes
+
+
+def build_ftu_cell_summaries_jsonld(
+    index: FtuIndex,
+    indent: int | None = JSONLD_INDENT,
+    top_n: int = TOP_N_GENES,
+    ranking: str = GENE_RANKING,
+):
+    """
+    Build the CellSummaries of each FTU from the filtered intermediary and stream them to
+    FTU_CELL_SUMMARIES_OUTPUT.
+
+    With INTERMEDIARY_FORMAT set to "shards", the shards are processed in parallel (see
+    `map_intermediary_shards()`) and their CellSummaries are written shard by shard, so
+    the @graph has the same nodes as with one JSONL file, in shard order. The workers'
+    part files go to a temporary folder in RAW_DATA_DIR, which is removed even if the
+    build fails.
+
+    Args:
+        index (FtuIndex): With the FTUs of each filtered dataset.
+        indent (int | None, optional): Indentation of the output. Defaults to
+            JSONLD_INDENT.
+        top_n (int, optional): Number of genes to keep per row. Defaults to TOP_N_GENES.
+        ranking (str, optional): One of GENE_RANKINGS. Defaults to GENE_RANKING.
+
+    Raises:
+        ValueError: If the ranking is unknown.
+    """
+
+    if ranking not in GENE_RANKINGS:
+        raise ValueError(
+            f"Unknown GENE_RANKING {ranking!r}, expected one of {GENE_RANKINGS}"
+        )
 
+    # Keep only CTs that map to exactly one FTU within an organ.
+    unique_cts_by_ftu = index.unique_cts_by_ftu()
 
+    # Stream each CellSummary to file as soon as it is built
+    tqdm.write(f"Now saving to {FTU_CELL_SUMMARIES_OUTPUT}")
+    with (
+        track_performance("build_ftu_cell_summaries_jsonld") as perf,
+        JsonLdGraphWriter(FTU_CELL_SUMMARIES_OUTPUT, indent=indent) as writer,
+    ):
+        obj_counter = 0
+
+        if INTERMEDIARY_FORMAT == "shards":
+            # The pool is shut down (closing()) before the folder is removed
+            with (
+                tempfile.TemporaryDirectory(
+                    prefix="ftu-cell-summaries-parts-", dir=RAW_DATA_DIR
+                ) as parts_dir,
+                contextlib.closing(
+                    map_intermediary_shards(
+                        build_shard_cell_summaries,
+                        init_cell_summaries_worker,
+                        (index, unique_cts_by_ftu, indent, top_n, ranking, parts_dir),
+                    )
+                ) as results,
+            ):
+                for part_path, records in results:
+                    for text in iterate_part_file(part_path):
+                        writer.write_serialized(text)
+                    part_path.unlink()
+                    obj_counter += records
+
+        else:
+            # Everything but the modality, which is dropped from the output
+            columns = [c for c in CELL_TYPE_POPULATIONS_SCHEMA.names if c != "modality"]
+
+            # Ranking by input order only needs the first genes of the Parquet intermediary
+            row_filter = None
+            if ranking == "input_order":
+                row_filter = (pc.field("gene_index") < top_n) | pc.field(
+                    "gene_index"
+                ).is_null()
+
+            for obj in iterate_cell_type_populations(
+                columns=columns, row_filter=row_filter
+            ):
+                obj_counter += 1
+                for out_obj in build_cell_summaries(
+                    obj, obj_counter, index, unique_cts_by_ftu, top_n, ranking
+                ):
+                    writer.write(out_obj)
+
+        perf.records = obj_counter
+
+
+@track_performance(Path(__file__).stem)
 def main():
     # Driver code
 
-    build_ftu_cell_summaries_jsonld()
+    index = FtuIndex.from_files(
+        filtered_dataset_metadata_path=FILTERED_DATASET_METADATA_FILENAME
+    )
+
+    build_ftu_cell_summaries_jsonld(index)
 
 
 if __name__ == "__main__":
@@ -60,7 +60,7 @@ def generate_ftu_report():
 
     # Transform values as needed
 
-    df["iri"] = df["iri"].apply(lambda iri: iri.split("/")[len(iri.split("/")) - 1])
+    df["iri"] = df["iri"].str.rsplit("/", n=1).str[-1]
 
     df["cell_types_in_illustration"] = df["cell_types_in_illustration"].apply(len)
     df["cell_types_in_asctb_ftu_column"] = df["cell_types_in_asctb_ftu_column"].apply(
@@ -238,7 +238,7 @@ def visualize_bar_graph():
     ax.bar(x + width, df["shared_count"], width, label="shared_count")
 
     # create short labels by splitting on '/'
-    df['iri_short'] = df['iri'].apply(lambda s: s.rstrip('/').split('/')[-1])
+    df['iri_short'] = df['iri'].str.rstrip('/').str.rsplit('/', n=1).str[-1]
 
     ax.set_xticks(x)
     ax.set_xticklabels(df["iri_short"], rotation=45, ha="right", fontsize=9)
@@ -254,6 +254,7 @@ def visualize_bar_graph():
     plt.show()
 
 
+@track_performance(Path(__file__).stem)
 def main():
     # Driver code
 
@@ -1,7 +1,7 @@
 from shared import *
 
 
-def extract_metadata(organ_metadata: dict):
+def extract_metadata(organ_metadata: dict) -> pd.DataFrame:
     """_summary_"""
 
     # Load metadata TSV
@@ -66,19 +66,21 @@ def extract_metadata(organ_metadata: dict):
     }
 
     # Only keep rows unique dataset IDs
-    export_df = pd.DataFrame(export).drop_duplicates(subset="dataset_id", keep="first")
-
-    # Append to file (no header)
-    with open(ANATOMOGRAMN_METADATA, "a", encoding="utf-8", newline="") as f:
-        export_df.to_csv(f, header=False, index=False)
+    return pd.DataFrame(export).drop_duplicates(subset="dataset_id", keep="first")
 
 
 def main():
     # Driver code
     print("Now making metadata file for anatomogram.")
 
-    for organ in anatomogram_files_json:
-        extract_metadata(organ)
+    # Read the organs' TSVs in parallel, append them in order
+    with ThreadPoolExecutor(max_workers=ANATOMOGRAM_DOWNLOAD_WORKERS) as pool:
+        export_dfs = list(pool.map(extract_metadata, anatomogram_files_json))
+
+    # Append to file (no header)
+    with open(ANATOMOGRAMN_METADATA, "a", encoding="utf-8", newline="") as f:
+        for export_df in export_dfs:
+            export_df.to_csv(f, header=False, index=False)
 
 
 if __name__ == "__main__":
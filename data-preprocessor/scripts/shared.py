@@ -2,18 +2,44 @@
 from pprint import pprint
 import yaml
 import requests
+import urllib3
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import atexit
+import sys
+from datetime import datetime
 import pandas as pd
-from io import StringIO
+from io import BufferedReader, BytesIO, StringIO, TextIOWrapper
 import json
 from pathlib import Path
 import gzip
 from tqdm import tqdm
 import os
 import copy
+import contextlib
 import shutil
+import tempfile
 import ujson
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import re
-from collections import defaultdict
+import heapq
+import hashlib
+import mmap
+import zipfile
+import zlib
+import threading
+import weakref
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import defaultdict, deque
+from functools import lru_cache
+import multiprocessing
+import numpy as np
 import scanpy as sc
 import anndata as ad
 import matplotlib.pyplot as plt
@@ -53,10 +79,22 @@ with open(Path(__file__).parent / "config.yaml", "r", encoding="utf-8") as f:
 # Get HRApop metadata
 hra_pop_version = config["HRA_POP_VERSION"]
 hra_pop_branch = config["HRA_POP_BRANCH"]
+hra_pop_zenodo_record = config["HRA_POP_ZENODO_RECORD"]
 
 # Capture FTU query
 FTU_QUERY = config["FTU_QUERY"]
 
+# Stage 10 reads the cell types in FTUs from FTU_QUERY ("cdn") or builds them from the
+# FTU and ASCT+B digital objects in the HRA KG ("kg"), fetching KG_FETCH_WORKERS at a time
+FTU_SOURCE = config.get("FTU_SOURCE", "cdn")
+HRA_FTU_PARTS_QUERY = config.get(
+    "HRA_FTU_PARTS_QUERY", "https://apps.humanatlas.io/api/grlc/hra/2d-ftu-parts.csv"
+)
+HRA_DIGITAL_OBJECTS = config.get(
+    "HRA_DIGITAL_OBJECTS", "https://apps.humanatlas.io/api/kg/digital-objects"
+)
+KG_FETCH_WORKERS = config.get("KG_FETCH_WORKERS", 8)
+
 # Assign file paths to constants
 CELL_TYPES_IN_FTUS = OUTPUT_DIR / config["CELL_TYPES_IN_FTUS"]
 UNIVERSE_FILE_FILENAME = INPUT_DIR / config["UNIVERSE_FILE_FILENAME"]
@@ -71,6 +109,26 @@ FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME = (
 FILTERED_DATASET_METADATA_FILENAME = (
     OUTPUT_DIR / config["FILTERED_DATASET_METADATA_FILENAME"]
 )
+FILTERED_FTU_CELL_TYPE_POPULATIONS_PARQUET_FILENAME = (
+    RAW_DATA_DIR / config["FILTERED_FTU_CELL_TYPE_POPULATIONS_PARQUET_FILENAME"]
+)
+FILTERED_FTU_CELL_TYPE_POPULATIONS_SHARDS_DIR = RAW_DATA_DIR / config.get(
+    "FILTERED_FTU_CELL_TYPE_POPULATIONS_SHARDS_DIR",
+    "cell_type_populations_intermediary_shards",
+)
+INTERMEDIARY_SHARD_MANIFEST = (
+    FILTERED_FTU_CELL_TYPE_POPULATIONS_SHARDS_DIR / "manifest.json"
+)
+
+# Format of the filtered intermediary read by stages 40 and 41: "jsonl", "parquet" or
+# "shards", see ShardedJsonlWriter
+INTERMEDIARY_FORMAT = config.get("INTERMEDIARY_FORMAT", "jsonl")
+INTERMEDIARY_SHARDS = config.get("INTERMEDIARY_SHARDS", 8)
+INTERMEDIARY_SHARD_COMPRESSION = config.get("INTERMEDIARY_SHARD_COMPRESSION", "gzip")
+INTERMEDIARY_SHARD_WORKERS = config.get("INTERMEDIARY_SHARD_WORKERS", 4)
+
+# Write buffer of the JSONL intermediary
+INTERMEDIARY_WRITE_BUFFER = 1 << 20
 
 FTU_DATASETS = OUTPUT_DIR / config["FTU_DATASETS"]
 FTU_CELL_SUMMARIES = OUTPUT_DIR / config["FTU_CELL_SUMMARIES"]
@@ -81,6 +139,165 @@ ANATOMOGRAMN_METADATA = INPUT_DIR / config["ANATOMOGRAMN_METADATA"]
 ANATOMOGRAMN_RAW_DATA = RAW_DATA_DIR / config["ANATOMOGRAMN_RAW_DATA"]
 DATASETS_OF_INTEREST = OUTPUT_DIR / config["DATASETS_OF_INTEREST"]
 FTU_TO_DATASETS = OUTPUT_DIR / config["FTU_TO_DATASETS"]
+ANATOMOGRAM_CELL_SUMMARIES = RAW_DATA_DIR / config["ANATOMOGRAM_CELL_SUMMARIES"]
+
+# Inputs and outputs of each stage, used by set_up_and_run.py to skip stages that are
+# up to date and to run independent stages in parallel. A stage depends on the earlier
+# stages that write its inputs; URLs are not tracked. Each stage also depends on its
+# own script, on this file and on the values of the config.yaml settings listed under
+# "config" (those that change its outputs; file names change its inputs and outputs
+# instead).
+FILTERED_INTERMEDIARY = {
+    "parquet": FILTERED_FTU_CELL_TYPE_POPULATIONS_PARQUET_FILENAME,
+    "shards": INTERMEDIARY_SHARD_MANIFEST,
+}.get(INTERMEDIARY_FORMAT, FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME)
+STAGES = {
+    "10-identify-cell-types-ftu-only.py": {
+        "inputs": [],
+        "outputs": [CELL_TYPES_IN_FTUS],
+        "config": [
+            "FTU_SOURCE",
+            "FTU_QUERY",
+            "HRA_FTU_PARTS_QUERY",
+            "HRA_DIGITAL_OBJECTS",
+        ],
+    },
+    "20-preprocess-hra-pop.py": {
+        "inputs": [CELL_TYPES_IN_FTUS],
+        "outputs": [
+            UNIVERSE_METADATA_FILENAME,
+            UNIVERSE_10K_FILENAME,
+            DATASETS_OF_INTEREST,
+            FILTERED_DATASET_METADATA_FILENAME,
+            # Shards replace the JSONL intermediary, Parquet comes with it
+            *(
+                [FILTERED_INTERMEDIARY]
+                if INTERMEDIARY_FORMAT == "shards"
+                else [
+                    FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME,
+                    FILTERED_INTERMEDIARY,
+                ]
+            ),
+        ],
+        "config": [
+            "HRA_POP_VERSION",
+            "HRA_POP_BRANCH",
+            "HRA_POP_ZENODO_RECORD",
+            "INTERMEDIARY_FORMAT",
+            "INTERMEDIARY_SHARDS",
+            "INTERMEDIARY_SHARD_COMPRESSION",
+        ],
+    },
+    "30-preprocess-anatomogram-cell-type-populations.py": {
+        "inputs": [],
+        "outputs": [ANATOMOGRAM_CELL_SUMMARIES],
+        "config": ["ANATOMOGRAM_TOP_N_GENES"],
+    },
+    "40-build-ftu-datasets-jsonld.py": {
+        "inputs": [
+            UNIVERSE_METADATA_FILENAME,
+            CELL_TYPES_IN_FTUS,
+            FILTERED_DATASET_METADATA_FILENAME,
+            FILTERED_INTERMEDIARY,
+        ],
+        "outputs": [FTU_TO_DATASETS, FTU_DATASETS_OUTPUT],
+        "config": ["INTERMEDIARY_FORMAT"],
+    },
+    "41-build-ftu-cell-summaries-jsonld.py": {
+        "inputs": [
+            CELL_TYPES_IN_FTUS,
+            FILTERED_DATASET_METADATA_FILENAME,
+            FILTERED_INTERMEDIARY,
+        ],
+        "outputs": [FTU_CELL_SUMMARIES_OUTPUT],
+        "config": [
+            "INTERMEDIARY_FORMAT",
+            "JSONLD_INDENT",
+            "TOP_N_GENES",
+            "GENE_RANKING",
+        ],
+    },
+    "50-run-reports.py": {
+        "inputs": [CELL_TYPES_IN_FTUS],
+        "outputs": [
+            REPORTS_DIR / "cell_types_in_ftu_report.csv",
+            REPORTS_DIR / "upset_cell_type_overlap.png",
+            REPORTS_DIR / "celltype_counts_grouped_bar.png",
+        ],
+        "config": [],
+    },
+}
+
+# Parallel filtering of the HRApop Universe file (1 worker = serial)
+FILTER_WORKERS = config.get("FILTER_WORKERS", 1)
+FILTER_BATCH_SIZE = config.get("FILTER_BATCH_SIZE", 64)
+
+# Backend for filtering the HRApop Universe file in stage 20: "python" or "duckdb"
+FILTER_BACKEND = config.get("FILTER_BACKEND", "python")
+DUCKDB_MEMORY_LIMIT = config.get("DUCKDB_MEMORY_LIMIT", "8GB")
+DUCKDB_THREADS = config.get("DUCKDB_THREADS")  # None = all cores
+DUCKDB_MAXIMUM_OBJECT_SIZE = config.get("DUCKDB_MAXIMUM_OBJECT_SIZE", 256_000_000)
+DUCKDB_TEMP_DIRECTORY = RAW_DATA_DIR / config.get("DUCKDB_TEMP_DIRECTORY", "duckdb-tmp")
+
+# Indentation of the JSON-LD output files (null writes compact JSON)
+JSONLD_INDENT = config.get("JSONLD_INDENT", 4)
+
+# Biomarkers kept per cell type in stage 41 and how they are ranked:
+# "mean_expression", "specificity" or "input_order"
+TOP_N_GENES = config.get("TOP_N_GENES", 100)
+GENE_RANKING = config.get("GENE_RANKING", "mean_expression")
+
+# Genes kept per cell type in the anatomogram cell summaries of stage 30
+ANATOMOGRAM_TOP_N_GENES = config.get("ANATOMOGRAM_TOP_N_GENES", 10_000)
+
+# Anatomogram organs are downloaded and unzipped by ANATOMOGRAM_DOWNLOAD_WORKERS threads
+# and aggregated by ANATOMOGRAM_WORKERS processes
+ANATOMOGRAM_DOWNLOAD_WORKERS = config.get("ANATOMOGRAM_DOWNLOAD_WORKERS", 4)
+ANATOMOGRAM_WORKERS = config.get("ANATOMOGRAM_WORKERS", 2)
+
+# Matrix Market files are parsed in blocks of MTX_BLOCK_SIZE bytes, and their
+# entries cached as .npy files in a folder next to them
+MTX_BLOCK_SIZE = config.get("MTX_BLOCK_SIZE", 64_000_000)
+MTX_CACHE_SUFFIX = ".npy-cache"
+
+# Read the SCEA count matrices from their zip files instead of extracting them
+ANATOMOGRAM_MTX_FROM_ZIP = config.get("ANATOMOGRAM_MTX_FROM_ZIP", False)
+
+# HTTP: all requests go through one pooled session that retries with jittered backoff
+HTTP_TIMEOUT = (10, 60)  # (connect, read) in seconds
+HTTP_RETRIES = config.get("HTTP_RETRIES", 5)
+HTTP_BACKOFF_FACTOR = config.get("HTTP_BACKOFF_FACTOR", 0.5)
+HTTP_BACKOFF_JITTER = config.get("HTTP_BACKOFF_JITTER", 0.5)
+HTTP_POOL_SIZE = config.get("HTTP_POOL_SIZE", 16)
+HTTP_SLOW_REQUEST_SECONDS = config.get("HTTP_SLOW_REQUEST_SECONDS", 10)
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Per-host HTTP stats are written here at exit if set (set_up_and_run.py sets it)
+HTTP_STATS_FILE = os.environ.get("HTTP_STATS_FILE")
+
+# HTTP response cache for API and CSV requests (downloads are not cached). Responses
+# younger than HTTP_CACHE_TTL seconds are used as they are, older ones are revalidated.
+# HTTP_OFFLINE (or the environment variable of the same name) serves only from the cache.
+HTTP_CACHE_DIR = INPUT_DIR / config.get("HTTP_CACHE_DIR", "http-cache")
+HTTP_CACHE_TTL = config.get("HTTP_CACHE_TTL", 86_400)
+HTTP_CACHE_EXPIRE = config.get("HTTP_CACHE_EXPIRE", 30 * 86_400)
+HTTP_CACHE_MAX_SIZE = config.get("HTTP_CACHE_MAX_SIZE", 1_000_000_000)
+HTTP_OFFLINE = str(
+    os.environ.get("HTTP_OFFLINE", config.get("HTTP_OFFLINE", False))
+).lower() in {"true", "1", "yes"}
+
+# Per-section performance records are written here at exit if set (set_up_and_run.py sets it)
+PERF_FILE = os.environ.get("PERF_FILE")
+
+# Downloads: files of at least DOWNLOAD_SEGMENT_MIN_SIZE bytes are fetched in
+# DOWNLOAD_SEGMENTS parallel byte ranges (1 = single stream)
+DOWNLOAD_SEGMENTS = config.get("DOWNLOAD_SEGMENTS", 1)
+DOWNLOAD_SEGMENT_MIN_SIZE = config.get("DOWNLOAD_SEGMENT_MIN_SIZE", 256_000_000)
+DOWNLOAD_MIN_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_STATE_SAVE_INTERVAL = (
+    64 * 1024 * 1024
+)  # bytes between saves of segment progress
 
 # Commonly used HTTP Accept headers for API requests
 accept_json = {"Accept": "application/json"}
@@ -167,25 +384,446 @@ anatomogram_files_json = [
 # 4. Pancreas: https://www.ebi.ac.uk/gxa/sc/experiments/E-MTAB-5061/downloads
 
 
+TRUE_STRINGS = {"true", "t", "1", "yes", "y"}
+
+
 def as_bool(v):
     if pd.isna(v):
         return False
     if isinstance(v, str):
-        return v.strip().lower() in {"true", "t", "1", "yes", "y"}
+        return v.strip().lower() in TRUE_STRINGS
     return bool(v)
 
 
+def as_bool_series(values: pd.Series) -> pd.Series:
+    """
+    Column-wise `as_bool()`: missing values are False, strings are True if they read
+    as true, and anything else is True if it is truthy.
+
+    Args:
+        values (pd.Series): A flag column, e.g. as read from a CSV.
+
+    Returns:
+        pd.Series: A bool Series with the same index.
+    """
+    if pd.api.types.is_bool_dtype(values) and not values.hasnans:
+        return values.astype(bool)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.fillna(0).astype(bool)
+
+    # Anything else (strings, or bools and strings with blanks): as_bool() on each
+    # distinct value, spread back over the rows. Missing values have code -1.
+    codes, uniques = pd.factorize(values)
+    flags = np.array([as_bool(v) for v in uniques] + [False], dtype=bool)
+    return pd.Series(flags[codes], index=values.index)
+
+
+# The same few thousand IRIs are converted over and over, so conversions are memoised
+# and their results interned. See also iri_to_curie_series() for whole columns.
+@lru_cache(maxsize=2**16)
 def iri_to_curie(iri: str) -> str:
-    return iri.rsplit("/", 1)[-1].replace("_", ":")
+    return sys.intern(iri.rsplit("/", 1)[-1].replace("_", ":"))
+
+
+class HttpStats:
+    """
+    Per-host counters of the HTTP requests made through `get_http_session()`.
+
+    For each host, keeps the number of requests, errors (status >= 400 or no
+    response) and retries, the total and maximum latency (time until the response
+    headers arrived) and the bytes received. Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = defaultdict(
+            lambda: {
+                "requests": 0,
+                "errors": 0,
+                "retries": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "bytes": 0,
+            }
+        )
+
+    def record_response(self, response: requests.Response, *args, **kwargs):
+        """Response hook of the session, see `requests` event hooks."""
+        host = urlsplit(response.url).netloc
+        seconds = response.elapsed.total_seconds()
+        retries = getattr(response.raw, "retries", None)
+
+        # Streamed bodies are counted by the reader with `record_bytes()`
+        received = 0 if kwargs.get("stream") else len(response.content)
+
+        with self.lock:
+            stats = self.hosts[host]
+            stats["requests"] += 1
+            stats["errors"] += response.status_code >= 400
+            stats["retries"] += len(retries.history) if retries else 0
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += received
+
+        if seconds > HTTP_SLOW_REQUEST_SECONDS:
+            tqdm.write(
+                f"{Fore.YELLOW}🐢 Slow response from {host}: {seconds:.1f} s for {response.url}{Style.RESET_ALL}"
+            )
+
+    def record_error(self, url: str):
+        """Count a request that failed without a response (e.g. a timeout)."""
+        with self.lock:
+            stats = self.hosts[urlsplit(url).netloc]
+            stats["requests"] += 1
+            stats["errors"] += 1
+
+    def record_bytes(self, url: str, n: int):
+        """Count bytes read from a streamed response."""
+        with self.lock:
+            self.hosts[urlsplit(url).netloc]["bytes"] += n
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {host: dict(stats) for host, stats in self.hosts.items()}
+
+    def save(self, path: str | Path):
+        """Write the stats as JSON, if any request was made."""
+        stats = self.as_dict()
+        if not stats:
+            return
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=4)
+
+
+http_stats = HttpStats()
+
+
+class PooledSession(requests.Session):
+    """A `requests.Session` that applies HTTP_TIMEOUT by default and counts failed requests."""
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        try:
+            return super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            http_stats.record_error(url)
+            raise
+
+
+_http_session = None
+_http_session_pid = None
+
+
+def get_http_session() -> requests.Session:
+    """
+    Return the pooled HTTP session of this process, creating it on first use.
+
+    The session keeps connections alive, retries connection errors and
+    HTTP_RETRY_STATUSES up to HTTP_RETRIES times with jittered exponential backoff
+    (honouring Retry-After), uses HTTP_TIMEOUT unless a timeout is given, and records
+    per-host stats in `http_stats`. Worker processes get their own session.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global _http_session, _http_session_pid
+
+    if _http_session is None or _http_session_pid != os.getpid():
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            backoff_jitter=HTTP_BACKOFF_JITTER,
+            status_forcelist=HTTP_RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry,
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+        )
+        session = PooledSession()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.hooks["response"].append(http_stats.record_response)
+        _http_session, _http_session_pid = session, os.getpid()
+
+    return _http_session
+
+
+def save_http_stats():
+    """Write `http_stats` to HTTP_STATS_FILE at exit, so the pipeline runner can report them."""
+    if HTTP_STATS_FILE:
+        http_stats.save(HTTP_STATS_FILE)
+
+
+atexit.register(save_http_stats)
+
+
+class HttpCache:
+    """
+    Content-addressed on-disk cache of HTTP GET responses.
+
+    Bodies are stored once under `bodies/<sha256 of body>`; `entries/<sha256 of
+    request>.json` holds the URL, the status, the headers needed to use and
+    revalidate the response (Content-Type, ETag, Last-Modified), when it was
+    fetched and when it was last used. Entries not used for `expire` seconds are
+    evicted, then the least recently used ones until the cache fits in `max_size`.
+
+    Args:
+        cache_dir (Path, optional): Folder of the cache. Defaults to HTTP_CACHE_DIR.
+        expire (int, optional): Seconds after its last use that an entry is evicted.
+            Defaults to HTTP_CACHE_EXPIRE.
+        max_size (int, optional): Maximum size of the stored bodies in bytes. Defaults
+            to HTTP_CACHE_MAX_SIZE.
+    """
+
+    kept_headers = ("Content-Type", "ETag", "Last-Modified")
+
+    def __init__(
+        self,
+        cache_dir: Path = HTTP_CACHE_DIR,
+        expire: int = HTTP_CACHE_EXPIRE,
+        max_size: int = HTTP_CACHE_MAX_SIZE,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.entries_dir = self.cache_dir / "entries"
+        self.bodies_dir = self.cache_dir / "bodies"
+        self.expire = expire
+        self.max_size = max_size
+
+    @staticmethod
+    def key(url: str, params: dict | None = None, headers: dict | None = None) -> str:
+        """Hash a request: its URL, query parameters and Accept header."""
+        accept = (headers or {}).get("Accept", "")
+        request = json.dumps([url, sorted((params or {}).items()), accept])
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def write_atomic(path: Path, data: bytes):
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, key: str) -> dict | None:
+        """Return the metadata of an entry, or None if it (or its body) is missing."""
+        try:
+            with open(self.entries_dir / f"{key}.json", "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not (self.bodies_dir / entry["body"]).exists():
+            return None
+        return entry
+
+    def save(self, key: str, entry: dict):
+        self.entries_dir.mkdir(parents=True, exist_ok=True)
+        self.write_atomic(
+            self.entries_dir / f"{key}.json", json.dumps(entry).encode("utf-8")
+        )
+
+    def store(self, key: str, response: requests.Response) -> dict:
+        """Store a 200 response and evict old entries. Returns the new entry."""
+        if not self.cache_dir.exists():
+            self.cache_dir.mkdir(parents=True)
+            # Keep the cache out of git, INPUT_DIR is not ignored
+            (self.cache_dir / ".gitignore").write_text("*\n")
+
+        body = response.content
+        body_hash = hashlib.sha256(body).hexdigest()
+        self.bodies_dir.mkdir(parents=True, exist_ok=True)
+        if not (self.bodies_dir / body_hash).exists():
+            self.write_atomic(self.bodies_dir / body_hash, body)
+
+        now = time.time()
+        entry = {
+            "url": response.url,
+            "status": response.status_code,
+            "headers": {
+                h: response.headers[h]
+                for h in self.kept_headers
+                if h in response.headers
+            },
+            "body": body_hash,
+            "size": len(body),
+            "fetched_at": now,
+            "used_at": now,
+        }
+        self.save(key, entry)
+        self.evict()
+        return entry
+
+    def touch(self, key: str, entry: dict, revalidated: bool = False):
+        """Mark an entry as used (and as fetched now, if it was revalidated)."""
+        entry["used_at"] = time.time()
+        if revalidated:
+            entry["fetched_at"] = entry["used_at"]
+        self.save(key, entry)
+
+    def to_response(self, entry: dict) -> requests.Response:
+        """Build a `requests.Response` from a cache entry."""
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.url = entry["url"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        with open(self.bodies_dir / entry["body"], "rb") as f:
+            response._content = f.read()
+        return response
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones above max_size, then orphaned bodies."""
+        now = time.time()
+        entries = []
+        for path in self.entries_dir.glob("*.json"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                path.unlink(missing_ok=True)
+                continue
+            if now - entry["used_at"] > self.expire:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((entry["used_at"], path, entry))
+
+        entries.sort(key=lambda item: item[0], reverse=True)
+        kept_bodies = set()
+        total = 0
+        for _, path, entry in entries:
+            if entry["body"] not in kept_bodies:
+                if total + entry["size"] > self.max_size:
+                    path.unlink(missing_ok=True)
+                    continue
+                total += entry["size"]
+                kept_bodies.add(entry["body"])
+
+        for body in self.bodies_dir.iterdir():
+            if body.name not in kept_bodies and not body.name.endswith(".tmp"):
+                body.unlink(missing_ok=True)
+
+
+http_cache = HttpCache()
+
+
+def cached_get(
+    url: str,
+    params: dict | None = None,
+    headers: dict | None = None,
+    timeout=HTTP_TIMEOUT,
+    ttl: int = HTTP_CACHE_TTL,
+) -> requests.Response:
+    """
+    GET a URL through `http_cache` and the pooled session.
+
+    A cached response younger than `ttl` seconds is returned without a request. An
+    older one is revalidated with If-None-Match / If-Modified-Since and reused on
+    304 Not Modified. If the server cannot be reached, a cached response is used
+    however old it is. With HTTP_OFFLINE, only the cache is used. Only 200
+    responses are cached; others are returned as they are.
+
+    Args:
+        url (str): The URL to fetch.
+        params (dict | None, optional): Query parameters. Defaults to None.
+        headers (dict | None, optional): Request headers. Defaults to None.
+        timeout (optional): Timeout for the HTTP request. Defaults to HTTP_TIMEOUT.
+        ttl (int, optional): Seconds a cached response is used without revalidation.
+            Defaults to HTTP_CACHE_TTL.
+
+    Returns:
+        requests.Response: The (possibly cached) response.
+
+    Raises:
+        requests.exceptions.ConnectionError: If HTTP_OFFLINE is set and the URL is not cached.
+        requests.exceptions.RequestException: If the request fails and the URL is not cached.
+    """
+    key = http_cache.key(url, params, headers)
+    entry = http_cache.load(key)
+
+    if HTTP_OFFLINE:
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                f"{url} is not in the HTTP cache and HTTP_OFFLINE is set"
+            )
+        http_cache.touch(key, entry)
+        return http_cache.to_response(entry)
+
+    if entry is not None and time.time() - entry["fetched_at"] < ttl:
+        http_cache.touch(key, entry)
+        return http_cache.to_response(entry)
+
+    request_headers = dict(headers or {})
+    if entry is not None:
+        if "ETag" in entry["headers"]:
+            request_headers["If-None-Match"] = entry["headers"]["ETag"]
+        if "Last-Modified" in entry["headers"]:
+            request_headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+
+    try:
+        response = get_http_session().get(
+            url, params=params, headers=request_headers, timeout=timeout
+        )
+    except requests.exceptions.RequestException as e:
+        if entry is None:
+            raise
+        tqdm.write(
+            f"{Fore.YELLOW}⚠️ Could not reach {url} ({e}), using the cached response.{Style.RESET_ALL}"
+        )
+        http_cache.touch(key, entry)
+        return http_cache.to_response(entry)
+
+    if response.status_code == 304 and entry is not None:
+        http_cache.touch(key, entry, revalidated=True)
+        return http_cache.to_response(entry)
+
+    if response.status_code == 200:
+        http_cache.store(key, response)
+
+    return response
+
+
+def fetch_json_concurrently(
+    urls: list[str], workers: int = KG_FETCH_WORKERS, headers: dict = accept_json
+) -> dict:
+    """
+    GET several JSON documents at the same time (through the HTTP cache, see `cached_get()`).
+
+    At most `workers` requests run at once, all over the pooled session.
+
+    Args:
+        urls (list[str]): The URLs; duplicates are fetched once.
+        workers (int, optional): Maximum number of concurrent requests. Defaults to
+            KG_FETCH_WORKERS.
+        headers (dict, optional): Request headers. Defaults to accept_json.
+
+    Returns:
+        dict: URL → parsed JSON, in the order of `urls`.
+
+    Raises:
+        requests.exceptions.RequestException: If a request fails.
+    """
+
+    def fetch(url: str):
+        response = cached_get(url, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    unique_urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        return dict(zip(unique_urls, pool.map(fetch, unique_urls)))
 
 
-def get_csv_pandas(url: str, timeout: int = 10) -> pd.DataFrame:
+def get_csv_pandas(url: str, timeout=HTTP_TIMEOUT) -> pd.DataFrame:
     """
-    Fetch a CSV file from a URL and return it as a pandas DataFrame.
+    Fetch a CSV file from a URL (through the HTTP cache, see `cached_get()`) and
+    return it as a pandas DataFrame.
 
     Args:
         url (str): The URL to the CSV file.
-        timeout (int, optional): Timeout in seconds for the HTTP request. Defaults to 10.
+        timeout (optional): Timeout for the HTTP request. Defaults to HTTP_TIMEOUT.
 
     Returns:
         pd.DataFrame: DataFrame parsed from the CSV content.
@@ -195,7 +833,7 @@ def get_csv_pandas(url: str, timeout: int = 10) -> pd.DataFrame:
         ValueError: If the response cannot be parsed as CSV.
     """
     try:
-        response = requests.get(url, timeout=timeout)
+        response = cached_get(url, timeout=timeout)
         response.raise_for_status()  # Raise HTTPError for bad responses (4xx, 5xx)
 
         # More permissive Content-Type check
@@ -215,24 +853,294 @@ def get_csv_pandas(url: str, timeout: int = 10) -> pd.DataFrame:
         raise ValueError(f"Failed to parse CSV from {url}") from e
 
 
+def adapt_chunk_size(chunk_size: int, elapsed: float) -> int:
+    """
+    Grow or shrink the read size of a download so that each read takes 0.25-1 s.
+
+    Args:
+        chunk_size (int): The current read size in bytes.
+        elapsed (float): Seconds the last read took.
+
+    Returns:
+        int: The next read size, between DOWNLOAD_MIN_CHUNK_SIZE and DOWNLOAD_MAX_CHUNK_SIZE.
+    """
+    if elapsed < 0.25:
+        return min(chunk_size * 2, DOWNLOAD_MAX_CHUNK_SIZE)
+    if elapsed > 1.0:
+        return max(chunk_size // 2, DOWNLOAD_MIN_CHUNK_SIZE)
+    return chunk_size
+
+
+def file_checksum(path: str | Path, algorithm: str = "md5") -> str:
+    """
+    Compute the hex digest of a file, reading it in 8 MB blocks.
+
+    Args:
+        path (str | Path): Path to the file.
+        algorithm (str, optional): Any algorithm known to hashlib. Defaults to "md5".
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while block := f.read(DOWNLOAD_MAX_CHUNK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check_download(
+    path: str | Path, expected_size: int | None = None, checksum: str | None = None
+):
+    """
+    Check a downloaded file against its expected size and checksum.
+
+    Args:
+        path (str | Path): Path to the file.
+        expected_size (int | None, optional): Size in bytes. Defaults to None (not checked).
+        checksum (str | None, optional): Checksum as "<algorithm>:<hex digest>", as listed
+            by Zenodo (e.g. "md5:4d1f..."); a bare digest is taken to be MD5. Defaults to
+            None (not checked).
+
+    Raises:
+        ValueError: If the size or the checksum does not match.
+    """
+    size = Path(path).stat().st_size
+    if expected_size is not None and size != expected_size:
+        raise ValueError(f"{path} has {size} bytes, expected {expected_size}")
+
+    if checksum:
+        algorithm, _, digest = checksum.rpartition(":")
+        actual = file_checksum(path, algorithm or "md5")
+        if actual != digest.lower():
+            raise ValueError(
+                f"{path} has {algorithm or 'md5'} checksum {actual}, expected {digest}"
+            )
+
+
+def probe_download(url: str, timeout=HTTP_TIMEOUT) -> tuple[int | None, bool]:
+    """
+    Ask a server for the size of a file and whether it serves byte ranges.
+
+    Args:
+        url (str): The URL of the file.
+        timeout (optional): Timeout for the HEAD request. Defaults to HTTP_TIMEOUT.
+
+    Returns:
+        tuple[int | None, bool]: The size in bytes (None if unknown) and whether the
+            server accepts Range requests. (None, False) if the HEAD request fails.
+    """
+    try:
+        head = get_http_session().head(
+            url,
+            allow_redirects=True,
+            headers={"Accept-Encoding": "identity"},
+            timeout=timeout,
+        )
+        head.raise_for_status()
+    except requests.RequestException:
+        return None, False
+
+    size = head.headers.get("Content-Length")
+    accepts_ranges = head.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(size) if size is not None else None), accepts_ranges
+
+
+def stream_to_file(
+    url: str,
+    path: Path,
+    start: int = 0,
+    end: int | None = None,
+    on_progress=None,
+    timeout=HTTP_TIMEOUT,
+) -> int:
+    """
+    Stream the bytes `start`-`end` of a URL into a file at the same offset.
+
+    With `end` None, the rest of the file is fetched and the file is truncated at
+    `start` first; if the server ignores the Range header, the download restarts
+    from byte 0. Reads grow or shrink with `adapt_chunk_size()`.
+
+    Args:
+        url (str): The URL of the file.
+        path (Path): The (partial) local file to write into.
+        start (int, optional): First byte to fetch. Defaults to 0.
+        end (int | None, optional): Last byte to fetch (inclusive). Defaults to None (end of file).
+        on_progress (callable, optional): Called with the number of bytes of each write.
+        timeout (optional): Timeout for the GET request. Defaults to HTTP_TIMEOUT.
+
+    Returns:
+        int: The number of bytes written.
+
+    Raises:
+        HTTPError: If the HTTP request fails.
+        RuntimeError: If the server ignores the Range header of a segment.
+    """
+    headers = {"Accept-Encoding": "identity"}
+    if start or end is not None:
+        headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+
+    with get_http_session().get(
+        url, headers=headers, stream=True, timeout=timeout
+    ) as r:
+        # Nothing left to fetch
+        if r.status_code == 416 and end is None:
+            return 0
+        r.raise_for_status()
+
+        if "Range" in headers and r.status_code != 206:
+            if end is not None:
+                raise RuntimeError(f"Server ignored the byte range of {url}")
+            if on_progress:
+                on_progress(-start)
+            start = 0
+
+        written = 0
+        chunk_size = DOWNLOAD_MIN_CHUNK_SIZE
+        with open(path, "r+b" if path.exists() else "wb") as f:
+            f.seek(start)
+            if end is None:
+                f.truncate()
+
+            while True:
+                tick = time.perf_counter()
+                try:
+                    chunk = r.raw.read(chunk_size, decode_content=True)
+                except urllib3.exceptions.HTTPError as e:
+                    raise requests.exceptions.ConnectionError(e) from e
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+                http_stats.record_bytes(url, len(chunk))
+                if on_progress:
+                    on_progress(len(chunk))
+                chunk_size = adapt_chunk_size(chunk_size, time.perf_counter() - tick)
+
+    return written
+
+
+def download_segments(
+    url: str,
+    part_path: Path,
+    total_size: int,
+    segments: int,
+    pbar: tqdm,
+    timeout=HTTP_TIMEOUT,
+):
+    """
+    Download a file as parallel byte ranges into a preallocated `.part` file.
+
+    Progress of each segment is saved to `<part_path>.json`, so an interrupted
+    download resumes each segment where it stopped.
+
+    Args:
+        url (str): The URL of the file.
+        part_path (Path): The partial file to write into.
+        total_size (int): Size of the file in bytes.
+        segments (int): Number of byte ranges fetched at the same time.
+        pbar (tqdm): Progress bar to update.
+        timeout (optional): Timeout for each GET request. Defaults to HTTP_TIMEOUT.
+
+    Raises:
+        HTTPError: If an HTTP request fails.
+        RuntimeError: If the server ignores a byte range.
+    """
+    state_path = part_path.with_name(part_path.name + ".json")
+    state = None
+    if state_path.exists() and part_path.exists():
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("url") != url or state.get("size") != total_size:
+            state = None
+        else:
+            print(f"ℹ️ Resuming segmented download of {part_path.name}")
+
+    if state is None:
+        bounds = [total_size * i // segments for i in range(segments + 1)]
+        state = {
+            "url": url,
+            "size": total_size,
+            "segments": [
+                {"start": bounds[i], "end": bounds[i + 1] - 1, "done": 0}
+                for i in range(segments)
+                if bounds[i + 1] > bounds[i]
+            ],
+        }
+        with open(part_path, "wb") as f:
+            f.truncate(total_size)
+
+    lock = threading.Lock()
+    unsaved = 0
+
+    def save_state():
+        tmp_path = state_path.with_name(state_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def fetch(segment: dict):
+        def on_progress(n: int):
+            nonlocal unsaved
+            with lock:
+                segment["done"] += n
+                pbar.update(n)
+                unsaved += n
+                if unsaved >= DOWNLOAD_STATE_SAVE_INTERVAL:
+                    save_state()
+                    unsaved = 0
+
+        start = segment["start"] + segment["done"]
+        if start <= segment["end"]:
+            stream_to_file(url, part_path, start, segment["end"], on_progress, timeout)
+
+    save_state()
+    pbar.update(sum(segment["done"] for segment in state["segments"]))
+    try:
+        with ThreadPoolExecutor(max_workers=len(state["segments"])) as pool:
+            list(pool.map(fetch, state["segments"]))
+    finally:
+        with lock:
+            save_state()
+
+
 def download_from_url(
-    url: str, base_dir: str | Path = None, output_file: str = ""
+    url: str,
+    base_dir: str | Path = None,
+    output_file: str = "",
+    expected_size: int | None = None,
+    checksum: str | None = None,
+    segments: int = DOWNLOAD_SEGMENTS,
+    timeout=HTTP_TIMEOUT,
 ) -> Path:
     """
     Download a gzipped JSONL file or a CSV and save it locally,
     showing a progress bar while streaming.
 
+    The file is written to `<output_file>.part` and moved into place only once it is
+    complete and matches the expected size and checksum, so an existing file is never
+    a truncated download. An interrupted download resumes from the `.part` file with
+    HTTP Range requests. Files of at least DOWNLOAD_SEGMENT_MIN_SIZE bytes are fetched
+    in `segments` parallel byte ranges if the server supports them.
+
     Args:
         url (str): The URL of the file to download.
         base_dir (str | Path, optional): The base directory where the file should be stored.
             Defaults to INPUT_DIR if not provided. Can be RAW_DIR, INPUT_DIR, or any other folder.
         output_file (str): The filename or relative path to save the downloaded file as.
+        expected_size (int | None, optional): Size in bytes, also checked for an existing
+            file. Defaults to the Content-Length of the server, if any.
+        checksum (str | None, optional): Checksum as "<algorithm>:<hex digest>", e.g. from
+            `get_zenodo_file()`. Defaults to None (not checked).
+        segments (int, optional): Number of parallel byte ranges. Defaults to DOWNLOAD_SEGMENTS.
+        timeout (optional): Timeout of each HTTP request. Defaults to HTTP_TIMEOUT.
 
     Returns:
         Path: The path to the downloaded (or existing) file.
 
     Raises:
         HTTPError: If the HTTP request for the URL fails.
+        ValueError: If the download does not match the expected size or checksum.
         OSError: If writing to the local file path fails.
     """
     base_dir = Path(base_dir or INPUT_DIR)
@@ -241,36 +1149,162 @@ def download_from_url(
     file_path.parent.mkdir(parents=True, exist_ok=True)
 
     if file_path.exists():
-        print(f"ℹ️ File already exists at {file_path}, skipping download.")
-        return file_path
+        try:
+            # Only the size is checked here, the checksum was checked when it was downloaded
+            check_download(file_path, expected_size)
+            print(f"ℹ️ File already exists at {file_path}, skipping download.")
+            return file_path
+        except ValueError as e:
+            print(f"⚠️ {e}, downloading it again.")
+            file_path.unlink()
+
+    if HTTP_OFFLINE:
+        raise requests.exceptions.ConnectionError(
+            f"{file_path} is missing and HTTP_OFFLINE is set"
+        )
 
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        total_size = int(r.headers.get("content-length", 0))
+    part_path = file_path.with_name(file_path.name + ".part")
+    state_path = part_path.with_name(part_path.name + ".json")
 
-        with (
-            open(file_path, "wb") as f,
-            tqdm(
-                total=total_size,
-                unit="B",
-                unit_scale=True,
-                desc=file_path.name,
-                ascii=True,
-            ) as pbar,
-        ):
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    pbar.update(len(chunk))
+    total_size, accepts_ranges = probe_download(url, timeout)
+    total_size = expected_size or total_size
+
+    resume_segments = state_path.exists() and part_path.exists()
+    use_segments = total_size is not None and (
+        resume_segments
+        or (
+            segments > 1
+            and accepts_ranges
+            and total_size >= DOWNLOAD_SEGMENT_MIN_SIZE
+            and not part_path.exists()
+        )
+    )
+
+    # A segmented .part file is preallocated, it cannot be resumed as a single stream
+    if resume_segments and not use_segments:
+        part_path.unlink()
+        state_path.unlink()
+
+    with tqdm(
+        total=total_size,
+        unit="B",
+        unit_scale=True,
+        desc=file_path.name,
+        ascii=True,
+    ) as pbar:
+        if use_segments:
+            download_segments(url, part_path, total_size, segments, pbar, timeout)
+        else:
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            if offset:
+                print(f"ℹ️ Resuming download of {file_path.name} at byte {offset}")
+                pbar.update(offset)
+            stream_to_file(url, part_path, offset, None, pbar.update, timeout)
+
+    try:
+        check_download(part_path, total_size, checksum)
+    except ValueError:
+        # Keep a short .part file to resume from, start over if it is corrupt
+        if total_size is None or part_path.stat().st_size >= total_size:
+            part_path.unlink()
+            state_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(part_path, file_path)
+    state_path.unlink(missing_ok=True)
 
     print(f"✅ File with URL {url} saved to {file_path}")
     return file_path
 
 
+def get_zenodo_file(record_id: str | int, filename: str, timeout=HTTP_TIMEOUT) -> dict:
+    """
+    Look up the size and checksum of a file in a Zenodo record.
+
+    Args:
+        record_id (str | int): The Zenodo record, e.g. 15786154.
+        filename (str): The name of the file in the record.
+        timeout (optional): Timeout for the HTTP request. Defaults to HTTP_TIMEOUT.
+
+    Returns:
+        dict: With 'size' (bytes) and 'checksum' (e.g. "md5:4d1f...") of the file.
+
+    Raises:
+        requests.exceptions.RequestException: If the HTTP request fails.
+        ValueError: If the record has no file with that name.
+    """
+    response = cached_get(
+        f"https://zenodo.org/api/records/{record_id}",
+        headers=accept_json,
+        timeout=timeout,
+    )
+    response.raise_for_status()
+
+    for file in response.json().get("files", []):
+        if file.get("key") == filename:
+            return {"size": file.get("size"), "checksum": file.get("checksum")}
+
+    raise ValueError(f"Zenodo record {record_id} has no file {filename}")
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+
+def open_binary_stream(path_or_url: str | Path) -> BufferedReader:
+    """
+    Open a local file or a URL as one buffered binary stream.
+
+    URLs are fetched with a single streaming GET through the pooled session; any
+    Content-Encoding is decoded. The stream supports `peek()`, so its format can be
+    sniffed without consuming bytes, and can then be handed to gzip or JSON decoding.
+
+    Args:
+        path_or_url (str | Path): Path to a local file or URL.
+
+    Returns:
+        BufferedReader: The open stream. Closing it also closes the HTTP response.
+
+    Raises:
+        OSError: If the local file cannot be opened.
+        requests.RequestException: If the URL cannot be reached.
+    """
+    path_or_url = str(path_or_url)
+    if path_or_url.startswith(("http://", "https://")):
+        response = get_http_session().get(path_or_url, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.RequestException:
+            response.close()
+            raise
+        response.raw.decode_content = True
+        # Keep the response readable through BufferedReader once the body is consumed
+        response.raw.auto_close = False
+        return BufferedReader(response.raw, buffer_size=STREAM_BUFFER_SIZE)
+
+    return open(path_or_url, "rb", buffering=STREAM_BUFFER_SIZE)
+
+
+def stream_is_gzipped(stream: BufferedReader) -> bool:
+    """
+    Check whether a stream starts with the gzip magic number 0x1f 0x8b, without consuming it.
+
+    Args:
+        stream (BufferedReader): A stream from `open_binary_stream()`.
+
+    Returns:
+        bool: True if the stream is gzipped.
+    """
+    return stream.peek(len(GZIP_MAGIC))[: len(GZIP_MAGIC)] == GZIP_MAGIC
+
+
 def open_cell_type_populations(file_path: str):
     """
     Open and parse a cell type population file in JSON or gzipped JSONL format.
 
+    The file (or URL) is opened once: its first bytes are peeked to detect gzip,
+    and the same stream is then decoded.
+
     If the file is gzipped JSONL (.jsonl.gz), the function returns a generator
     that yields one record at a time (streaming, suitable for large files).
 
@@ -278,7 +1312,7 @@ def open_cell_type_populations(file_path: str):
     the entire file into memory and returns it as a Python object (dict or list).
 
     Args:
-        file_path (str): Path to the input file.
+        file_path (str): Path to the input file or URL.
 
     Returns:
         generator: Yields dicts line by line if the file is gzipped JSONL.
@@ -286,34 +1320,32 @@ def open_cell_type_populations(file_path: str):
 
     Raises:
         OSError: If the file cannot be opened.
+        requests.RequestException: If the URL cannot be reached.
         json.JSONDecodeError: If the file contents are not valid JSON.
     """
+    stream = open_binary_stream(file_path)
 
-    if is_gzipped(file_path):
+    if stream_is_gzipped(stream):
 
         def record_generator():
-            with gzip.open(file_path, "rt", encoding="utf-8") as f:
+            with stream, gzip.open(stream, "rt", encoding="utf-8") as f:
                 for line in f:
                     yield json.loads(line)
 
         return record_generator()
     else:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with stream:
+            return json.load(TextIOWrapper(stream, encoding="utf-8"))
 
 
 def is_gzipped(path_or_url: str) -> bool:
     """
     Determine whether a local file or a remote URL is gzipped.
 
-    For local files:
-        - Opens the file in binary mode and inspects the first two bytes.
-        - A gzipped file always begins with the magic number 0x1f 0x8b.
-
-    For URLs:
-        - Checks the Content-Type and Content-Encoding headers for 'gzip'.
-        - If headers are inconclusive, streams the first two bytes and
-          inspects them for the gzip magic number.
+    Opens a single stream (one GET for URLs, no HEAD) and peeks at its first two
+    bytes: a gzipped file always begins with the magic number 0x1f 0x8b. To also
+    read the data, use `open_binary_stream()` and `stream_is_gzipped()` instead,
+    so it is not opened twice.
 
     Args:
         path_or_url (str): Path to a local file or URL to check.
@@ -325,33 +1357,21 @@ def is_gzipped(path_or_url: str) -> bool:
         OSError: If the local file cannot be opened.
         requests.RequestException: If the URL cannot be reached.
     """
-    if path_or_url.startswith(("http://", "https://")):
-        # Try headers first
-        head = requests.head(path_or_url, allow_redirects=True)
-        ctype = head.headers.get("Content-Type", "").lower()
-        cenc = head.headers.get("Content-Encoding", "").lower()
-        if "gzip" in ctype or "gzip" in cenc:
-            return True
-
-        # Fallback: peek at first bytes
-        with requests.get(path_or_url, stream=True) as r:
-            r.raise_for_status()
-            return r.raw.read(2) == b"\x1f\x8b"
-    else:
-        # Local file check
-        file_path = Path(path_or_url)
-        with open(file_path, "rb") as f:
-            return f.read(2) == b"\x1f\x8b"
+    with open_binary_stream(path_or_url) as stream:
+        return stream_is_gzipped(stream)
 
 
-def get_organs_with_ftus():
+def get_organs_with_ftus(query: str = HRA_FTU_PARTS_QUERY):
     """Retrieves a list of FTUs and their parts via the HRA API and a SPARQL query
 
+    Args:
+        query (str, optional): URL of the grlc query. Defaults to HRA_FTU_PARTS_QUERY.
+
     Returns:
         organs_with_ftus (list): A list of organs with their FTUs
     """
 
-    df = get_csv_pandas("https://apps.humanatlas.io/api/grlc/hra/2d-ftu-parts.csv")
+    df = get_csv_pandas(query)
 
     # Ok, on staging, those two would look like:
     # https://apps.humanatlas.io/api/grlc/hra/2d-ftu-parts.csv?endpoint=https://apps.humanatlas.io/api--staging/v1/sparql
@@ -375,102 +1395,148 @@ def get_organs_with_ftus():
     return organs_with_ftus
 
 
-def comes_from_organ_with_ftu(
-    organ_id_to_check: str | None, cell_types_in_ftus: list
-) -> bool:
+class FtuIndex:
     """
-    Determine whether a given organ ID corresponds to an organ that has
-    FTUs (Functional Tissue Units).
+    Precomputed lookups over the cell types in FTUs, built once and reused for every record.
+
+    Replaces the linear scans over all FTUs and all datasets of interest that used to run
+    for every cell summary row. All lookups are dictionary gets.
 
     Args:
-        check_organ_id (str | None): The short organ ID to check. If None, the function returns False.
-        cell_types_in_ftu (list): A list of dictionaries describing cell types in FTUs,
-            where each dictionary is expected to contain an 'organ_id_short' key.
+        cell_types_in_ftus (dict): Cell types in FTUs as loaded from CELL_TYPES_IN_FTUS.
+        datasets_of_interest (dict | list, optional): dataset_id → organ_id_short, either as
+            a dict or as a legacy list of single-key dicts. Defaults to None.
+        filtered_dataset_metadata (dict, optional): dataset_id → list of
+            {"ct_iri", "ftu_purl"} matches as written to FILTERED_DATASET_METADATA_FILENAME.
+            Defaults to None.
 
-    Returns:
-        bool: True if the provided organ ID corresponds to an organ that has FTUs,
-        False otherwise.
+    Example:
+        >>> index = FtuIndex(cell_types_in_ftus, datasets_of_interest)
+        >>> index.exclusive_matches("CL:1000768", index.organ_of(dataset_id))
+        [{'ct_iri': 'CL:1000768', 'ftu_purl': 'https://purl.humanatlas.io/2d-ftu/kidney-nephron'}]
     """
-    if organ_id_to_check is None:
-        return False
-
-    unique_organ_id_short = sorted(
-        {
-            v["organ_id_short"]
-            for v in cell_types_in_ftus.values()
-            if "organ_id_short" in v
-        }
-    )
-
-    return organ_id_to_check in unique_organ_id_short
-
-
-# def build_ftu_index(cell_types_in_ftus):
-#     index = defaultdict(list)
-#     for ftu in cell_types_in_ftus:
-#         organ = ftu["organ_id_short"]
-#         iri = ftu["iri"]
-#         for ct in ftu.get("cell_types_in_ftu_only", ()):
-#             index[(organ, ct["representation_of"])].append(iri)
-#     return index
 
+    def __init__(
+        self,
+        cell_types_in_ftus: dict,
+        datasets_of_interest: dict | list | None = None,
+        filtered_dataset_metadata: dict | None = None,
+    ):
+        self.cell_types_in_ftus = cell_types_in_ftus
+
+        # (organ_id_short, ct_iri) → [{"ct_iri", "ftu_purl"}], in FTU order
+        self.matches_by_organ_ct = defaultdict(list)
+        self.organ_ids = set()
+
+        for ftu in cell_types_in_ftus.values():
+            organ_id = ftu["organ_id_short"]
+            self.organ_ids.add(organ_id)
+            for ct in ftu.get("cts_exclusive", []):
+                self.matches_by_organ_ct[(organ_id, ct["ct_iri"])].append(
+                    {"ct_iri": ct["ct_iri"], "ftu_purl": ftu["ftu_purl"]}
+                )
+
+        # dataset_id → organ_id_short
+        if isinstance(datasets_of_interest, list):
+            datasets_of_interest = {
+                k: v for d in datasets_of_interest for k, v in d.items()
+            }
+        self.organ_by_dataset = dict(datasets_of_interest or {})
+
+        # dataset_id → [ftu_purl] and ftu_purl → [dataset_id], in order of first appearance
+        self.ftus_by_dataset = {}
+        self.datasets_by_ftu = {}
+
+        for dataset_id, matches in (filtered_dataset_metadata or {}).items():
+            ftus = self.ftus_by_dataset.setdefault(dataset_id, [])
+            for match in matches:
+                ftu_purl = match["ftu_purl"]
+                if ftu_purl not in ftus:
+                    ftus.append(ftu_purl)
+                    self.datasets_by_ftu.setdefault(ftu_purl, []).append(dataset_id)
+
+    @classmethod
+    def from_files(
+        cls,
+        cell_types_in_ftus_path: str | Path = CELL_TYPES_IN_FTUS,
+        datasets_of_interest_path: str | Path | None = None,
+        filtered_dataset_metadata_path: str | Path | None = None,
+    ) -> "FtuIndex":
+        """Build an index from the JSON files written by stages 10 and 20."""
+        with open(cell_types_in_ftus_path, "r", encoding="utf-8") as f:
+            cell_types_in_ftus = json.load(f)
+
+        datasets_of_interest = None
+        if datasets_of_interest_path is not None:
+            with open(datasets_of_interest_path, "r", encoding="utf-8") as f:
+                datasets_of_interest = json.load(f)["datasets_of_interest"]
+
+        filtered_dataset_metadata = None
+        if filtered_dataset_metadata_path is not None:
+            with open(filtered_dataset_metadata_path, "r", encoding="utf-8") as f:
+                filtered_dataset_metadata = json.load(f)
+
+        return cls(cell_types_in_ftus, datasets_of_interest, filtered_dataset_metadata)
+
+    def exclusive_matches(self, ct_iri: str | None, organ_id_short: str) -> list[dict]:
+        """Return one {"ct_iri", "ftu_purl"} dict per FTU in the organ the CT is exclusive to."""
+        if ct_iri is None:
+            return []
+        return list(self.matches_by_organ_ct.get((organ_id_short, ct_iri), ()))
+
+    def organ_of(self, dataset_id: str, default: str | None = None) -> str | None:
+        """Return the short organ ID of a dataset of interest."""
+        return self.organ_by_dataset.get(dataset_id, default)
+
+    def has_organ(self, organ_id_short: str | None) -> bool:
+        """Return True if the organ has at least one FTU."""
+        return organ_id_short in self.organ_ids
+
+    def ftus_for_dataset(self, dataset_id: str) -> list[str]:
+        """Return the PURLs of the FTUs a filtered dataset has exclusive CTs for."""
+        return self.ftus_by_dataset.get(dataset_id, [])
+
+    def unique_cts_by_ftu(self) -> dict[str, set[str]]:
+        """Build FTU -> set(CT CURIE) where CT is unique to exactly one FTU in an organ."""
+        organ_ct_to_ftus = defaultdict(set)
+
+        for ftu in self.cell_types_in_ftus.values():
+            organ_id = ftu.get("organ_id_short")
+            ftu_purl = ftu.get("ftu_purl")
+
+            if not organ_id or not ftu_purl:
+                continue
 
-# def is_cell_type_exclusive_to_ftu(cell_id_to_check, organ_id_to_check, index):
-#     """
-#     Retrieve all FTU IRIs where a given cell type is exclusive within a specific organ.
-
-#     Args:
-#         cell_id_to_check (str): The cell type identifier to look up (e.g., a CL or UBERON ID).
-#         organ_id_to_check (str): The short-form organ ID (e.g., 'UBERON:0002107') corresponding
-#             to the organ being checked.
-#         index (dict[tuple[str, str], list[str]]): A precomputed lookup mapping
-#             (organ_id_short, cell_id) tuples to lists of FTU IRIs, typically built by
-#             `build_ftu_index()`.
-
-#     Returns:
-#         list[tuple[str, str]]: A list of (cell_id_to_check, ftu_iri) tuples for all matching FTUs.
-#         Returns an empty list if no matches are found.
-#     """
+            for ct in ftu.get("cts_exclusive", []):
+                ct_curie = get_id_from_iri(ct.get("ct_iri"))
+                if ct_curie:
+                    organ_ct_to_ftus[(organ_id, ct_curie)].add(ftu_purl)
 
-#     return [
-#         (cell_id_to_check, iri)
-#         for iri in index.get((organ_id_to_check, cell_id_to_check), ())
-#     ]
+        unique_cts_by_ftu = defaultdict(set)
+        for (_, ct_curie), ftus in organ_ct_to_ftus.items():
+            if len(ftus) == 1:
+                unique_cts_by_ftu[next(iter(ftus))].add(ct_curie)
 
-# slower alternative:
+        return unique_cts_by_ftu
 
 
 def is_cell_type_exclusive_to_ftu(
-    cell_id_to_check: str | None, organ_id_to_check: str, cell_types_in_ftu: list[dict]
+    cell_id_to_check: str | None, organ_id_to_check: str, index: FtuIndex
 ) -> list:
     """
-    Determine whether a given cell type (by ID) is exclusive to Functional Tissue Units (FTUs).
+    Retrieve all FTUs where a given cell type is exclusive within a specific organ.
 
     Args:
-        cell_id_to_check (str | None): The cell type ID to check. If None, returns False.
-        cell_types_in_ftu (list[dict]): A list of FTU dictionaries, each containing a
-            'cell_types_in_ftu_only' key with a list of cell type dictionaries.
-            Each cell type dictionary must contain a 'representation_of' key.
+        cell_id_to_check (str | None): The cell type ID to check (e.g., 'CL:1000768').
+            If None, returns an empty list.
+        organ_id_to_check (str): The short-form organ ID (e.g., 'UBERON:0002113').
+        index (FtuIndex): The precomputed lookup built once from CELL_TYPES_IN_FTUS.
 
     Returns:
-        bool: True if the given cell type appears in any 'cell_types_in_ftu_only' list,
-        False otherwise.
+        list: One {"ct_iri", "ftu_purl"} dict per matching FTU.
+        Returns an empty list if no matches are found.
     """
-    if cell_id_to_check is None:
-        return []
-
-    # print(f"Now checking {cell_id_to_check} in {organ_id_to_check}.")
-
-    # Iterate over all FTUs
-    matches = [
-        {"ct_iri": ct["ct_iri"], "ftu_purl": ftu["ftu_purl"]}
-        for ftu in cell_types_in_ftu.values()
-        if ftu["organ_id_short"] == organ_id_to_check
-        for ct in ftu.get("cts_exclusive", [])
-        if ct["ct_iri"] == cell_id_to_check
-    ]
-
-    return matches
+    return index.exclusive_matches(cell_id_to_check, organ_id_to_check)
 
 
 def iterate_through_json_lines(filename: str, print_line: bool = False):
@@ -478,7 +1544,8 @@ def iterate_through_json_lines(filename: str, print_line: bool = False):
 
     This function reads a JSONL file line by line, parsing each line into a
     Python dictionary (or list, depending on the JSON content). It uses `tqdm`
-    to display a progress bar and optionally prints each parsed object.
+    to display a progress bar over the bytes consumed, so the file is only read
+    once, and optionally prints each parsed object.
 
     Args:
         filename (str): Path to the JSONL file to read.
@@ -492,16 +1559,23 @@ def iterate_through_json_lines(filename: str, print_line: bool = False):
         >>> for obj in iterate_through_json_lines('data.jsonl'):
         ...     print(obj['id'])
     """
-    total_lines = sum(1 for _ in open(filename, "r", encoding="utf-8"))
+    total_bytes = os.path.getsize(filename)
 
     print(
-        f"Now processing {filename} with {total_lines} lines and printing {'enabled' if print_line else 'not enabled'}."
+        f"Now processing {filename} with {total_bytes} bytes and printing {'enabled' if print_line else 'not enabled'}."
     )
 
-    with open(filename, "r", encoding="utf-8") as f:
-        for line in tqdm(
-            f, total=total_lines, desc="Processing JSONL lines", unit="line"
-        ):
+    with (
+        open(filename, "rb") as f,
+        tqdm(
+            total=total_bytes,
+            desc="Processing JSONL lines",
+            unit="B",
+            unit_scale=True,
+        ) as pbar,
+    ):
+        for line in f:
+            pbar.update(len(line))
             line = line.strip()
             if not line:
                 continue
@@ -510,44 +1584,854 @@ def iterate_through_json_lines(filename: str, print_line: bool = False):
                 pprint(line_json)
             yield line_json
 
-def ontology_id_short_to_url(ontology_id_short:str):
-    return f"http://purl.obolibrary.org/obo/{ontology_id_short.replace(":","_")}"
 
-def get_id_from_iri(iri):
-    # safe, idempotent, handles None/NaN and whitespace
-    if iri is None or (isinstance(iri, float) and pd.isna(iri)):
-        return None
-    s = str(iri).strip()
-    # if full IRI, grab text after last '/', otherwise leave as-is
-    if "/" in s:
-        s = s.rsplit("/", 1)[-1]
-    # normalize separator: CL_0000451 -> CL:0000451
-    return s.replace("_", ":")
+# Columnar layout of the filtered cell type populations: one row per (dataset, cell type, gene).
+# Record-, row- and gene-level keys outside the HRApop CellSummary format are kept as JSON
+# in the *_extra columns, so records can be rebuilt without losing data. So are nulls, and
+# numbers of another type than their column (e.g. "percentage": 1, which would be 1.0).
+CELL_TYPE_POPULATIONS_RECORD_FIELDS = {
+    "@type": "record_type",
+    "cell_source": "cell_source",
+    "annotation_method": "annotation_method",
+    "modality": "modality",
+}
+CELL_TYPE_POPULATIONS_ROW_FIELDS = {
+    "@type": "row_type",
+    "cell_id": "cell_id",
+    "cell_label": "cell_label",
+    "count": "count",
+    "percentage": "percentage",
+}
+CELL_TYPE_POPULATIONS_GENE_FIELDS = {
+    "@type": "gene_type",
+    "ensembl_id": "ensembl_id",
+    "gene_id": "gene_id",
+    "gene_label": "gene_label",
+    "mean_gene_expr_value": "mean_gene_expr_value",
+}
+CELL_TYPE_POPULATIONS_SCHEMA = pa.schema(
+    [
+        ("record_index", pa.int64()),
+        ("record_type", pa.string()),
+        ("cell_source", pa.string()),
+        ("annotation_method", pa.string()),
+        ("modality", pa.string()),
+        ("record_extra", pa.string()),
+        ("row_index", pa.int32()),
+        ("row_type", pa.string()),
+        ("cell_id", pa.string()),
+        ("cell_label", pa.string()),
+        ("count", pa.int64()),
+        ("percentage", pa.float64()),
+        ("row_extra", pa.string()),
+        ("gene_index", pa.int32()),
+        ("gene_type", pa.string()),
+        ("ensembl_id", pa.string()),
+        ("gene_id", pa.string()),
+        ("gene_label", pa.string()),
+        ("mean_gene_expr_value", pa.float64()),
+        ("gene_extra", pa.string()),
+    ]
+)
 
+# Python type of the numeric known fields, as json.loads() returns them
+CELL_TYPE_POPULATIONS_NUMBER_TYPES = {
+    "count": int,
+    "percentage": float,
+    "mean_gene_expr_value": float,
+}
 
-def get_in_asctb(df, ftu_iri, ct_iri):
-    ftu_id = get_id_from_iri(ftu_iri).strip()
-    ct_id = get_id_from_iri(ct_iri).strip()
-    print(f"Received {ftu_id} and {ct_id}")
 
-    row = df.loc[
-        (df["ftu_iri"].apply(get_id_from_iri) == ftu_id)
-        & (df["ct_iri"].apply(get_id_from_iri) == ct_id),
-        "in_asctb",
+def split_known_fields(
+    obj: dict, fields: dict, skip: tuple = ()
+) -> tuple[list, str | None]:
+    """
+    Return the values of the known fields of obj and the remaining keys as JSON (or None).
+
+    Known fields that are null, and numbers of another type than their column, are also
+    kept in the JSON as they are. The column gets the converted number, or None if it does
+    not convert exactly.
+    """
+    values = [obj.get(key) for key in fields]
+    extra = {k: v for k, v in obj.items() if k not in fields and k not in skip}
+    for i, key in enumerate(fields):
+        value = values[i]
+        if value is None:
+            if key in obj:
+                extra[key] = None  # a JSON null rather than a missing key
+            continue
+        number_type = CELL_TYPE_POPULATIONS_NUMBER_TYPES.get(key)
+        if number_type is None or type(value) is number_type:
+            continue
+        extra[key] = value
+        try:
+            values[i] = number_type(value) if number_type(value) == value else None
+        except (TypeError, ValueError):
+            values[i] = None
+    return values, (json.dumps(extra) if extra else None)
+
+
+def flatten_cell_type_population(record: dict) -> list[tuple]:
+    """
+    Flatten one CellSummary record into rows of CELL_TYPE_POPULATIONS_SCHEMA.
+
+    The record_index column is left out; it is added by the writer so that it reflects
+    the order in which records are written.
+
+    Args:
+        record (dict): A CellSummary record with a 'summary' list of CellSummaryRows.
+
+    Returns:
+        list[tuple]: One tuple per gene (or per cell type/record without genes).
+    """
+    record_values, record_extra = split_known_fields(
+        record, CELL_TYPE_POPULATIONS_RECORD_FIELDS, skip=("summary",)
+    )
+    record_part = (*record_values, record_extra)
+    no_row = (None,) * (len(CELL_TYPE_POPULATIONS_ROW_FIELDS) + 2)
+    no_gene = (None,) * (len(CELL_TYPE_POPULATIONS_GENE_FIELDS) + 2)
+
+    rows = []
+    summary = record.get("summary", [])
+    if not summary:
+        rows.append(record_part + no_row + no_gene)
+
+    for row_index, row in enumerate(summary):
+        row_values, row_extra = split_known_fields(
+            row, CELL_TYPE_POPULATIONS_ROW_FIELDS, skip=("gene_expr",)
+        )
+        row_part = (row_index, *row_values, row_extra)
+
+        genes = row.get("gene_expr", [])
+        if not genes:
+            rows.append(record_part + row_part + no_gene)
+
+        for gene_index, gene in enumerate(genes):
+            gene_values, gene_extra = split_known_fields(
+                gene, CELL_TYPE_POPULATIONS_GENE_FIELDS
+            )
+            rows.append(record_part + row_part + (gene_index, *gene_values, gene_extra))
+
+    return rows
+
+
+class CellTypePopulationsParquetWriter:
+    """
+    Write flattened cell type populations to a Parquet file, one row group at a time.
+
+    Args:
+        path (str | Path): Output Parquet file.
+        row_group_size (int, optional): Rows buffered before a row group is written.
+            Defaults to 100_000.
+
+    Example:
+        >>> with CellTypePopulationsParquetWriter(path) as writer:
+        ...     writer.write_rows(flatten_cell_type_population(record))
+    """
+
+    def __init__(self, path: str | Path, row_group_size: int = 100_000):
+        self.path = Path(path)
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.record_index = 0
+        self.writer = None
+
+    def __enter__(self):
+        self.writer = pq.ParquetWriter(self.path, CELL_TYPE_POPULATIONS_SCHEMA)
+        return self
+
+    def write_rows(self, rows: list[tuple]):
+        """Add the flattened rows of the next record."""
+        self.rows.extend((self.record_index, *row) for row in rows)
+        self.record_index += 1
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        self.writer.write_table(
+            pa.table(
+                {
+                    field.name: pa.array(column, type=field.type)
+                    for field, column in zip(CELL_TYPE_POPULATIONS_SCHEMA, columns)
+                },
+                schema=CELL_TYPE_POPULATIONS_SCHEMA,
+            )
+        )
+        self.rows = []
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        self.writer.close()
+
+
+def fill_known_fields(obj: dict, fields: dict, row: dict, extra_column: str):
+    """
+    Copy the non-null known fields of a flat row back into obj, followed by its extras.
+
+    Extras with the name of a known field are its exact value (see `split_known_fields()`)
+    and take its place.
+    """
+    extra = json.loads(row[extra_column]) if row.get(extra_column) else {}
+    for key, column in fields.items():
+        if key in extra:
+            obj[key] = extra.pop(key)
+        elif (value := row.get(column)) is not None:
+            obj[key] = value
+    obj.update(extra)
+
+
+def iterate_cell_type_populations_parquet(
+    filename: str | Path,
+    columns: list[str] | None = None,
+    row_filter: pc.Expression | None = None,
+):
+    """
+    Rebuild CellSummary records from the columnar intermediary, reading only some columns.
+
+    Args:
+        filename (str | Path): Parquet file written by CellTypePopulationsParquetWriter.
+        columns (list[str] | None, optional): Columns of CELL_TYPE_POPULATIONS_SCHEMA to read.
+            The index columns are always read. Defaults to all columns.
+        row_filter (pc.Expression | None, optional): Row filter pushed down to the Parquet
+            reader, e.g. `pc.field("gene_index") < 10`. Defaults to None.
+
+    Yields:
+        dict: One record at a time, with the requested fields only.
+    """
+    index_columns = ["record_index", "row_index", "gene_index"]
+    columns = index_columns + [
+        c
+        for c in (columns or CELL_TYPE_POPULATIONS_SCHEMA.names)
+        if c not in index_columns
     ]
-    
-    print(df["ftu_iri"].apply(get_id_from_iri).unique())
+    with_rows = any(
+        c in columns for c in (*CELL_TYPE_POPULATIONS_ROW_FIELDS.values(), "row_extra")
+    )
+    with_genes = any(
+        c in columns
+        for c in (*CELL_TYPE_POPULATIONS_GENE_FIELDS.values(), "gene_extra")
+    )
 
-    if row.empty:
-        return False
+    # Without row or gene columns, one flat row per record or CT is enough
+    for level, needed in (("gene_index", with_genes), ("row_index", with_rows)):
+        if not needed:
+            first_only = (pc.field(level) == 0) | pc.field(level).is_null()
+            row_filter = first_only if row_filter is None else row_filter & first_only
+
+    dataset = ds.dataset(filename, format="parquet")
+
+    print(
+        f"Now processing {filename} ({dataset.count_rows()} rows, columns: {columns})."
+    )
+
+    record = None
+    record_index = None
+    row = None
+    row_index = None
+
+    with tqdm(desc="Processing Parquet rows", unit="row") as pbar:
+        for batch in dataset.to_batches(columns=columns, filter=row_filter):
+            for flat in batch.to_pylist():
+                if flat["record_index"] != record_index:
+                    if record is not None:
+                        yield record
+                    record_index = flat["record_index"]
+                    record = {}
+                    fill_known_fields(
+                        record,
+                        CELL_TYPE_POPULATIONS_RECORD_FIELDS,
+                        flat,
+                        "record_extra",
+                    )
+                    if with_rows:
+                        record["summary"] = []
+                    row_index = None
+
+                if with_rows and flat["row_index"] is not None:
+                    if flat["row_index"] != row_index:
+                        row_index = flat["row_index"]
+                        row = {}
+                        fill_known_fields(
+                            row, CELL_TYPE_POPULATIONS_ROW_FIELDS, flat, "row_extra"
+                        )
+                        if with_genes:
+                            row["gene_expr"] = []
+                        record["summary"].append(row)
+
+                    if with_genes and flat["gene_index"] is not None:
+                        gene = {}
+                        fill_known_fields(
+                            gene, CELL_TYPE_POPULATIONS_GENE_FIELDS, flat, "gene_extra"
+                        )
+                        row["gene_expr"].append(gene)
+
+            pbar.update(batch.num_rows)
+
+    if record is not None:
+        yield record
+
+
+SHARD_SUFFIXES = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+
+def shard_of(dataset_id: str, shards: int) -> int:
+    """Return the shard of a dataset, from a hash of its ID that is the same in every run."""
+    digest = hashlib.blake2b(dataset_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+def import_zstandard():
+    """Import the optional zstandard package, which only zstd shards need."""
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "INTERMEDIARY_SHARD_COMPRESSION: zstd needs the zstandard package "
+            "(pip install zstandard)"
+        ) from e
+    return zstandard
+
+
+def open_shard(path: str | Path, mode: str = "rt", compression: str = "gzip"):
+    """
+    Open a compressed JSONL shard as text.
+
+    Args:
+        path (str | Path): The shard.
+        mode (str, optional): "rt" or "wt". Defaults to "rt".
+        compression (str, optional): "gzip" or "zstd". zstd needs the zstandard
+            package. Defaults to "gzip".
+
+    Raises:
+        ValueError: If the compression is unknown.
+    """
+    if compression == "gzip":
+        return gzip.open(path, mode, encoding="utf-8", compresslevel=6)
+    if compression == "zstd":
+        return import_zstandard().open(path, mode, encoding="utf-8")
+    raise ValueError(
+        f"Unknown INTERMEDIARY_SHARD_COMPRESSION {compression!r}, "
+        f"expected one of {tuple(SHARD_SUFFIXES)}"
+    )
+
+
+class JsonlWriter:
+    """
+    Write serialized records to one JSONL file through a large write buffer.
+
+    Has the interface of ShardedJsonlWriter, see `open_intermediary_writer()`.
+
+    Args:
+        path (str | Path): The JSONL file.
+        buffer_size (int, optional): Bytes buffered before a write. Defaults to
+            INTERMEDIARY_WRITE_BUFFER.
+    """
+
+    def __init__(self, path: str | Path, buffer_size: int = INTERMEDIARY_WRITE_BUFFER):
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self.records = 0
+
+    def __enter__(self):
+        self.f = open(self.path, "w", encoding="utf-8", buffering=self.buffer_size)
+        return self
+
+    def write(self, record: str, dataset_id: str | None = None):
+        """Append one serialized record."""
+        self.f.write(record + "\n")
+        self.records += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        self.f.close()
+
+
+class ShardedJsonlWriter:
+    """
+    Write serialized records to compressed JSONL shards, by a stable hash of their dataset ID.
+
+    All records of a dataset go to the same shard, in the order they are written. A
+    manifest with the file, record count and size of each shard is written last, and only
+    on success, so an existing manifest always describes complete shards. Shards and
+    manifest of an earlier run are removed first.
+
+    Args:
+        directory (str | Path, optional): Folder of the shards. Defaults to
+            FILTERED_FTU_CELL_TYPE_POPULATIONS_SHARDS_DIR.
+        shards (int, optional): Number of shards. Defaults to INTERMEDIARY_SHARDS.
+        compression (str, optional): "gzip" or "zstd", see `open_shard()`. Defaults to
+            INTERMEDIARY_SHARD_COMPRESSION.
+
+    Example:
+        >>> with ShardedJsonlWriter() as writer:
+        ...     writer.write(json.dumps(record), record["cell_source"])
+    """
+
+    def __init__(
+        self,
+        directory: str | Path = FILTERED_FTU_CELL_TYPE_POPULATIONS_SHARDS_DIR,
+        shards: int = INTERMEDIARY_SHARDS,
+        compression: str = INTERMEDIARY_SHARD_COMPRESSION,
+    ):
+        if compression not in SHARD_SUFFIXES:
+            raise ValueError(
+                f"Unknown INTERMEDIARY_SHARD_COMPRESSION {compression!r}, "
+                f"expected one of {tuple(SHARD_SUFFIXES)}"
+            )
+        if compression == "zstd":
+            import_zstandard()  # fail before the shards of the last run are removed
+        self.directory = Path(directory)
+        self.manifest_path = self.directory / "manifest.json"
+        self.shards = max(shards, 1)
+        self.compression = compression
+        self.names = [
+            f"shard-{i:04d}{SHARD_SUFFIXES[compression]}" for i in range(self.shards)
+        ]
+        self.counts = [0] * self.shards
+        self.records = 0
+
+    def __enter__(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_path.unlink(missing_ok=True)
+        for old_shard in self.directory.glob("shard-*"):
+            old_shard.unlink()
+        self.files = [
+            open_shard(self.directory / name, "wt", self.compression)
+            for name in self.names
+        ]
+        return self
+
+    def write(self, record: str, dataset_id: str):
+        """Append one serialized record to the shard of its dataset."""
+        shard = shard_of(dataset_id, self.shards)
+        self.files[shard].write(record + "\n")
+        self.counts[shard] += 1
+        self.records += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        for f in self.files:
+            f.close()
+        if exc_type is not None:
+            return
+
+        manifest = {
+            "compression": self.compression,
+            "records": self.records,
+            "shards": [
+                {
+                    "file": name,
+                    "records": count,
+                    "bytes": (self.directory / name).stat().st_size,
+                }
+                for name, count in zip(self.names, self.counts)
+            ],
+        }
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def open_intermediary_writer() -> JsonlWriter | ShardedJsonlWriter:
+    """Open the writer of the filtered records for the configured INTERMEDIARY_FORMAT."""
+    if INTERMEDIARY_FORMAT == "shards":
+        return ShardedJsonlWriter()
+    return JsonlWriter(FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME)
+
+
+def read_shard_manifest(
+    manifest_path: str | Path = INTERMEDIARY_SHARD_MANIFEST,
+) -> dict:
+    """
+    Load the manifest written by ShardedJsonlWriter, with each shard's full 'path' added.
+
+    Raises:
+        FileNotFoundError: If there is no manifest, i.e. no complete run of stage 20.
+    """
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    for shard in manifest["shards"]:
+        shard["path"] = manifest_path.parent / shard["file"]
+    return manifest
+
+
+def iterate_shard(path: str | Path, compression: str = "gzip"):
+    """Yield the records of one JSONL shard."""
+    with open_shard(path, "rt", compression) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iterate_intermediary_shards(
+    manifest_path: str | Path = INTERMEDIARY_SHARD_MANIFEST,
+):
+    """
+    Yield the records of all shards, shard by shard, with a progress bar over the record
+    counts of the manifest.
+    """
+    manifest = read_shard_manifest(manifest_path)
+    with tqdm(
+        total=manifest["records"], desc="Processing shards", unit="record"
+    ) as pbar:
+        for shard in manifest["shards"]:
+            for record in iterate_shard(shard["path"], manifest["compression"]):
+                yield record
+                pbar.update(1)
+
+
+def map_intermediary_shards(
+    function,
+    initializer=None,
+    initargs: tuple = (),
+    workers: int = INTERMEDIARY_SHARD_WORKERS,
+    manifest_path: str | Path = INTERMEDIARY_SHARD_MANIFEST,
+):
+    """
+    Run `function(shard_path, compression)` on every shard in a process pool.
+
+    Results are yielded in shard order, and the progress bar advances by the record count
+    of each shard from the manifest. With one worker, everything runs in this process.
+
+    Args:
+        function (Callable): Module-level function, so worker processes can import it.
+        initializer (Callable, optional): Run once per worker process first, e.g. to
+            store lookups. Defaults to None.
+        initargs (tuple, optional): Arguments of the initializer. Defaults to ().
+        workers (int, optional): Number of worker processes. Defaults to
+            INTERMEDIARY_SHARD_WORKERS.
+        manifest_path (str | Path, optional): Defaults to INTERMEDIARY_SHARD_MANIFEST.
+
+    Yields:
+        The result of each shard.
+    """
+    manifest = read_shard_manifest(manifest_path)
+    shards = manifest["shards"]
+
+    with tqdm(
+        total=manifest["records"], desc="Processing shards", unit="record"
+    ) as pbar:
+        if workers <= 1:
+            if initializer is not None:
+                initializer(*initargs)
+            for shard in shards:
+                yield function(shard["path"], manifest["compression"])
+                pbar.update(shard["records"])
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=initializer, initargs=initargs
+        ) as pool:
+            futures = [
+                pool.submit(function, shard["path"], manifest["compression"])
+                for shard in shards
+            ]
+            for shard, future in zip(shards, futures):
+                yield future.result()
+                pbar.update(shard["records"])
+
+
+def iterate_cell_type_populations(columns: list[str] | None = None, **kwargs):
+    """
+    Iterate through the filtered cell type populations in the configured INTERMEDIARY_FORMAT.
+
+    With "parquet", only the given columns are read (see
+    `iterate_cell_type_populations_parquet()`); with "jsonl" and "shards", whole records
+    are parsed and `columns` is ignored. Shards are read one after the other here, see
+    `map_intermediary_shards()` to process them in parallel.
+
+    Args:
+        columns (list[str] | None, optional): Columns needed by the caller. Defaults to all.
+        **kwargs: Passed on to the Parquet reader (e.g. `row_filter`).
+
+    Yields:
+        dict: One CellSummary record at a time.
+    """
+    if INTERMEDIARY_FORMAT == "parquet":
+        yield from iterate_cell_type_populations_parquet(
+            FILTERED_FTU_CELL_TYPE_POPULATIONS_PARQUET_FILENAME, columns, **kwargs
+        )
+    elif INTERMEDIARY_FORMAT == "shards":
+        yield from iterate_intermediary_shards()
+    else:
+        yield from iterate_through_json_lines(
+            FILTERED_FTU_CELL_TYPE_POPULATIONS_INTERMEDIARY_FILENAME
+        )
+
+
+class JsonLdGraphWriter:
+    """
+    Stream a JSON-LD document to disk one `@graph` node at a time.
+
+    Writes the context header first, then each node as it is produced, then closes
+    the array, so memory does not grow with the size of the graph. With the same
+    indent, the output is byte-identical to `json.dump(document, f, indent=indent)`.
+    The file is written under a temporary name and moved into place on success.
+
+    Args:
+        path (str | Path): The JSON-LD file to write.
+        template (dict, optional): Document with an empty "@graph".
+            Defaults to context_template.
+        indent (int | None, optional): Indentation as in json.dump; None writes compact
+            output. Defaults to JSONLD_INDENT from config.yaml.
+        ensure_ascii (bool, optional): As in json.dump. Defaults to False.
+
+    Example:
+        >>> with JsonLdGraphWriter(FTU_CELL_SUMMARIES_OUTPUT) as writer:
+        ...     writer.write(node)
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        template: dict = context_template,
+        indent: int | None = JSONLD_INDENT,
+        ensure_ascii: bool = False,
+    ):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.indent = indent
+        self.ensure_ascii = ensure_ascii
+        self.count = 0
+
+        # Serialize the document with an empty graph and split it where the nodes go
+        document = {k: v for k, v in template.items() if k != "@graph"}
+        document["@graph"] = []
+        text = self.dumps(document)
+        split_at = text.rindex('"@graph": []') + len('"@graph": [')
+        self.head, self.tail = text[:split_at], text[split_at:]
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj, ensure_ascii=self.ensure_ascii, indent=self.indent)
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(self.tmp_path, "w", encoding="utf-8")
+        self.f.write(self.head)
+        return self
+
+    def write(self, node: dict):
+        """Append one node to the `@graph` array."""
+        self.write_serialized(self.dumps(node))
+
+    def write_serialized(self, text: str):
+        """Append one node serialized with `dumps()`, e.g. by a worker process."""
+        if self.indent is None:
+            self.f.write((", " if self.count else "") + text)
+        else:
+            # Nodes sit two levels deep: document → "@graph" → node
+            prefix = "\n" + " " * (2 * self.indent)
+            self.f.write(
+                ("," if self.count else "") + prefix + text.replace("\n", prefix)
+            )
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.count and self.indent is not None:
+            self.f.write("\n" + " " * self.indent)
+        self.f.write(self.tail)
+        self.f.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            self.tmp_path.unlink(missing_ok=True)
+
+
+OBO_PURL_PREFIX = "http://purl.obolibrary.org/obo/"
+
+
+@lru_cache(maxsize=2**16)
+def ontology_id_short_to_url(ontology_id_short: str):
+    return sys.intern(f"{OBO_PURL_PREFIX}{ontology_id_short.replace(':', '_')}")
+
+
+def get_id_from_iri(iri):
+    # safe, idempotent, handles None/NaN and whitespace
+    if iri is None or (isinstance(iri, float) and pd.isna(iri)):
+        return None
+    return _id_from_iri_string(str(iri))
+
+
+@lru_cache(maxsize=2**16)
+def _id_from_iri_string(s: str) -> str:
+    s = s.strip()
+    # if full IRI, grab text after last '/', otherwise leave as-is
+    if "/" in s:
+        s = s.rsplit("/", 1)[-1]
+    # normalize separator: CL_0000451 -> CL:0000451
+    return sys.intern(s.replace("_", ":"))
+
+
+def _map_distinct(values: pd.Series, convert) -> pd.Series:
+    """
+    Apply a conversion of string Series to the distinct non-missing values of a column only,
+    and spread the results back over its rows. Missing values become None.
+    """
+    codes, uniques = pd.factorize(values)
+    converted = convert(pd.Series(uniques, dtype=object).astype(str))
+    result = np.append(converted.to_numpy(dtype=object), None)[codes]
+    return pd.Series(result, index=values.index, dtype=object, name=values.name)
+
+
+def get_id_from_iri_series(iris: pd.Series) -> pd.Series:
+    """
+    Column-wise `get_id_from_iri()`, with the same results for every value (None for
+    missing ones).
+
+    Example:
+        >>> get_id_from_iri_series(pd.Series(["http://purl.obolibrary.org/obo/CL_0000451", None]))
+        0    CL:0000451
+        1          None
+        dtype: object
+    """
+    return _map_distinct(
+        iris,
+        lambda s: s.str.strip().str.rsplit("/", n=1).str[-1].str.replace("_", ":"),
+    )
 
-    return bool(row.iloc[0])
 
-def fetch_grlc_csv_to_df(url, params=None, timeout=30, headers=None):
+def iri_to_curie_series(iris: pd.Series) -> pd.Series:
+    """Column-wise `iri_to_curie()`. Missing values become None instead of raising."""
+    return _map_distinct(
+        iris, lambda s: s.str.rsplit("/", n=1).str[-1].str.replace("_", ":")
+    )
+
+
+def ontology_id_short_to_url_series(ontology_ids_short: pd.Series) -> pd.Series:
+    """Column-wise `ontology_id_short_to_url()`. Missing values become None instead of raising."""
+    return _map_distinct(
+        ontology_ids_short, lambda s: OBO_PURL_PREFIX + s.str.replace(":", "_")
+    )
+
+
+class AsctbIndex:
+    """
+    Precomputed (FTU, CT) → flags lookups over an FTU/ASCT+B query table, built once.
+
+    Replaces the whole-table scans `get_in_asctb()` used to run for every pair. FTUs and
+    CTs may be given as IRIs, PURLs or CURIEs; they are normalised with
+    `get_id_from_iri()`. A missing flag column counts as True for every row (as in stage
+    10), and if a pair has several rows the first one counts.
+
+    Args:
+        table (pd.DataFrame): With a 'ct_iri' column, an 'ftu_iri' or 'ftu_purl' column and
+            any of the flag columns in_2d_ftu, in_asctb and exclusive_ct_in_ftu, e.g.
+            FTU_QUERY.
+        ftu_column (str | None, optional): The FTU column. Defaults to 'ftu_iri' if the
+            table has it, else 'ftu_purl'.
+
+    Example:
+        >>> index = AsctbIndex(ftu_query)
+        >>> index.in_asctb("https://purl.humanatlas.io/2d-ftu/kidney-nephron", "CL:1000768")
+        True
+        >>> index.exclusive(ftu_query["ftu_purl"], ftu_query["ct_iri"])
+        array([ True, False, ...])
+    """
+
+    FLAGS = ("in_2d_ftu", "in_asctb", "exclusive_ct_in_ftu")
+
+    # id(table) → (weakref to the table, its index), see for_table()
+    _by_table = {}
+
+    def __init__(self, table: pd.DataFrame, ftu_column: str | None = None):
+        if ftu_column is None:
+            ftu_column = "ftu_iri" if "ftu_iri" in table else "ftu_purl"
+
+        keys = pd.DataFrame(
+            {
+                "ftu": get_id_from_iri_series(table[ftu_column]),
+                "ct": get_id_from_iri_series(table["ct_iri"]),
+            }
+        )
+        first = ~keys.duplicated().to_numpy()
+
+        # One row per pair, one column per flag; the extra last row answers unknown pairs
+        flags = np.ones((len(table), len(self.FLAGS)), dtype=bool)
+        for i, flag in enumerate(self.FLAGS):
+            if flag in table:
+                flags[:, i] = as_bool_series(table[flag]).to_numpy()
+        self.flags = np.vstack([flags[first], np.zeros(len(self.FLAGS), dtype=bool)])
+
+        self.pairs = pd.MultiIndex.from_frame(keys[first])
+        self.row_by_pair = {pair: row for row, pair in enumerate(self.pairs)}
+
+    @classmethod
+    def for_table(cls, table: pd.DataFrame) -> "AsctbIndex":
+        """
+        Return the index of a table, building it on first use only. Changes to the
+        table after that are not seen.
+        """
+        key = id(table)
+        cached = cls._by_table.get(key)
+        if cached is None or cached[0]() is not table:
+            cached = (
+                weakref.ref(table, lambda _: cls._by_table.pop(key, None)),
+                cls(table),
+            )
+            cls._by_table[key] = cached
+        return cached[1]
+
+    def rows(self, ftus, cts) -> np.ndarray:
+        """Return the flag row of each (FTU, CT) pair of two equally long arrays."""
+        positions = self.pairs.get_indexer(
+            pd.MultiIndex.from_arrays(
+                [
+                    get_id_from_iri_series(pd.Series(ftus, dtype=object)),
+                    get_id_from_iri_series(pd.Series(cts, dtype=object)),
+                ]
+            )
+        )
+        return self.flags[positions]  # -1 (unknown pair) is the all-False last row
+
+    def flag(self, name: str, ftu, ct):
+        """
+        Return one flag of a pair, or a bool array of it for arrays of FTUs and CTs.
+        Unknown pairs are False.
+        """
+        column = self.FLAGS.index(name)
+        if isinstance(ftu, str) or ftu is None:
+            row = self.row_by_pair.get((get_id_from_iri(ftu), get_id_from_iri(ct)), -1)
+            return bool(self.flags[row, column])
+        return self.rows(ftu, ct)[:, column]
+
+    def in_2d_ftu(self, ftu, ct):
+        """Return whether the CT is in the 2D FTU illustration."""
+        return self.flag("in_2d_ftu", ftu, ct)
+
+    def in_asctb(self, ftu, ct):
+        """Return whether the CT is in the FTU column of the ASCT+B table."""
+        return self.flag("in_asctb", ftu, ct)
+
+    def exclusive(self, ftu, ct):
+        """Return whether the CT is exclusive to the FTU."""
+        return self.flag("exclusive_ct_in_ftu", ftu, ct)
+
+
+def get_in_asctb(df: pd.DataFrame | AsctbIndex, ftu_iri, ct_iri) -> bool:
+    """
+    Return whether a CT is in the FTU column of the ASCT+B table.
+
+    Args:
+        df (pd.DataFrame | AsctbIndex): A table with 'ftu_iri', 'ct_iri' and 'in_asctb'
+            columns, indexed on first use (see `AsctbIndex.for_table()`), or its index.
+        ftu_iri (str): IRI or CURIE of the FTU.
+        ct_iri (str): IRI or CURIE of the CT.
+
+    Returns:
+        bool: False if the pair is not in the table.
+    """
+    index = df if isinstance(df, AsctbIndex) else AsctbIndex.for_table(df)
+    return index.in_asctb(ftu_iri, ct_iri)
+
+
+def fetch_grlc_csv_to_df(url, params=None, timeout=HTTP_TIMEOUT, headers=None):
     headers = headers or {}
     # ask for CSV explicitly (GRLC supports CSV/JSON)
     headers.setdefault("Accept", "text/csv")
-    resp = requests.get(url, params=params, headers=headers, timeout=timeout)
+    resp = cached_get(url, params=params, headers=headers, timeout=timeout)
     # defensive checks
     if resp.status_code != 200:
         # include body snippet to help debug servers that return HTML error pages
@@ -574,25 +2458,467 @@ def fetch_grlc_csv_to_df(url, params=None, timeout=30, headers=None):
 # usage
 # df = fetch_grlc_csv_to_df('https://grlc.io/api/.../your_query.csv', params={'param1':'value'})
 
-def unzip_to_folder(file_path: str, target_folder: str):
+
+def unzip_to_folder(
+    file_path: str, target_folder: str, suffixes: tuple[str, ...] | None = None
+):
     """
-    Unzip the file at the specified file_path into target_folder,
-    but only if the folder is empty.
+    Extract the members of a zip file into target_folder, skipping those already extracted.
+
+    Only members whose names end with one of `suffixes` are extracted (all if None),
+    flat into target_folder. Each member is streamed to a `.part` file, checked
+    against the CRC-32 in the zip and then renamed. The size and CRC of every
+    extracted member, and the modification time of its file, are kept in
+    `<zip name>.manifest.json` in target_folder, so an interrupted extraction resumes
+    with the members that are missing, incomplete, modified since or changed in the zip.
 
     Args:
-        file_path (str): Path to the .zip (or other archive) file.
-        target_folder (str): Path where the archive should be extracted.
+        file_path (str): Path to the .zip file.
+        target_folder (str): Path where the members should be extracted.
+        suffixes (tuple[str, ...] | None, optional): Name endings of the members to
+            extract. Defaults to None.
+
+    Raises:
+        zipfile.BadZipFile: If a member does not match its CRC.
     """
     target = Path(target_folder)
+    target.mkdir(parents=True, exist_ok=True)
+    manifest_path = target / f"{Path(file_path).name}.manifest.json"
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    extracted = skipped = 0
+    with zipfile.ZipFile(file_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or (suffixes and not info.filename.endswith(suffixes)):
+                continue
+
+            # Flat, so member paths cannot point outside the target folder
+            name = Path(info.filename).name
+            member_path = target / name
+            entry = {"size": info.file_size, "crc": info.CRC}
+            stat = member_path.stat() if member_path.exists() else None
+            if (
+                stat is not None
+                and stat.st_size == info.file_size
+                and manifest.get(name) == {**entry, "mtime_ns": stat.st_mtime_ns}
+            ):
+                skipped += 1
+                continue
+
+            part_path = member_path.with_name(name + ".part")
+            crc = 0
+            try:
+                with archive.open(info) as src, open(part_path, "wb") as dst:
+                    while chunk := src.read(STREAM_BUFFER_SIZE):
+                        crc = zlib.crc32(chunk, crc)
+                        dst.write(chunk)
+                if crc != info.CRC:
+                    raise zipfile.BadZipFile(
+                        f"CRC mismatch for {info.filename} in {file_path}"
+                    )
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+            os.replace(part_path, member_path)
+            extracted += 1
+
+            manifest[name] = {**entry, "mtime_ns": member_path.stat().st_mtime_ns}
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=4)
+
+    if extracted:
+        print(f"Unzipped {extracted} files from {file_path} → {target}")
+    if skipped:
+        print(f"Skipped: {skipped} files of {file_path} already extracted to {target}")
+
+
+def read_mtx_header(f) -> tuple[tuple[int, int], int, str]:
+    """
+    Read the header of a Matrix Market file, leaving `f` at the first entry.
+
+    Args:
+        f: The file, opened in binary mode.
+
+    Returns:
+        tuple[tuple[int, int], int, str]: The shape, number of entries and field
+        ('real', 'integer' or 'pattern').
 
-    # Exclude the archive itself when checking contents
-    if target.exists() and any(
-        p.is_file() and p.suffix != ".zip" and ".tsv" not in p.name
-        for p in target.iterdir()
+    Raises:
+        ValueError: If the file is not a general coordinate matrix.
+    """
+    banner = f.readline().decode("ascii").split()
+    if (
+        len(banner) != 5
+        or banner[0] != "%%MatrixMarket"
+        or banner[2:5:2] != ["coordinate", "general"]
+        or banner[3] not in {"real", "integer", "pattern"}
     ):
-        print(f"Skipped: {target} already contains extracted files.")
+        raise ValueError(f"Not a general coordinate Matrix Market file: {banner}")
+
+    line = f.readline()
+    while line.startswith(b"%") or not line.strip():
+        line = f.readline()
+    rows, cols, entries = map(int, line.split())
+    return (rows, cols), entries, banner[3]
+
+
+def parse_mtx_entries(f, field: str, block_size: int = MTX_BLOCK_SIZE):
+    """
+    Parse the entries of a Matrix Market file in blocks of about `block_size` bytes.
+
+    Each block ends at a line break and is parsed by the C parser of pandas, so
+    at most one block of text and its arrays are in memory at a time.
+
+    Args:
+        f: The file, opened in binary mode and positioned after the header (see
+            `read_mtx_header()`), e.g. by `open_mtx()`.
+        field (str): The field from the header.
+        block_size (int, optional): Bytes per block. Defaults to MTX_BLOCK_SIZE.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: 0-based rows and columns (int32)
+        and values (float32) of the entries of a block.
+    """
+    columns = ["row", "col"] if field == "pattern" else ["row", "col", "value"]
+    rest = b""
+    while True:
+        chunk = f.read(block_size)
+        block = rest + chunk
+        if chunk:
+            end = block.rfind(b"\n") + 1
+            block, rest = block[:end], block[end:]
+        if block.strip():
+            entries = pd.read_csv(
+                BytesIO(block),
+                sep=r"\s+",
+                header=None,
+                names=columns,
+                dtype={"row": np.int32, "col": np.int32, "value": np.float32},
+                comment="%",
+            )
+            rows = entries["row"].to_numpy() - 1
+            cols = entries["col"].to_numpy() - 1
+            if field == "pattern":
+                values = np.ones(len(entries), dtype=np.float32)
+            else:
+                values = entries["value"].to_numpy()
+            yield rows, cols, values
+        if not chunk:
+            return
+
+
+@contextlib.contextmanager
+def open_mtx(path: Path, member: str | None = None):
+    """Open a Matrix Market file memory-mapped, or stream it from a member of a zip file."""
+    if member is None:
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+        ):
+            yield m
+    else:
+        with zipfile.ZipFile(path) as archive, archive.open(member) as f:
+            yield f
+
+
+def iterate_mtx_entries(
+    path: str | Path, block_size: int = MTX_BLOCK_SIZE, member: str | None = None
+) -> tuple:
+    """
+    Stream the entries of a Matrix Market file in blocks, from its .npy cache if there is one.
+
+    The file is memory-mapped (or, with `member`, decompressed from the zip file at
+    `path` without being extracted) and parsed block by block with
+    `parse_mtx_entries()`. The parsed entries are written to memory-mapped .npy
+    files in a folder next to it (`<file>.npy-cache`), which later calls read in
+    blocks instead of parsing the text again. The cache is used only if it is
+    complete and was made from a file of the same size and modification time.
+
+    Example:
+        >>> shape, entries = iterate_mtx_entries(path)
+        >>> for rows, cols, values in entries:
+        ...     ...
+
+    Args:
+        path (str | Path): The .mtx file, or the zip file containing it.
+        block_size (int, optional): Bytes of text per block when parsing. Defaults to
+            MTX_BLOCK_SIZE.
+        member (str | None, optional): Name of the .mtx file in the zip file. Defaults
+            to None.
+
+    Returns:
+        tuple: The shape as (rows, cols), and an iterator of (rows, cols, values)
+        blocks as yielded by `parse_mtx_entries()`.
+    """
+    path = Path(path)
+    cache_dir = path.with_name(Path(member or path).name + MTX_CACHE_SUFFIX)
+    stat = path.stat()
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "member": member}
+
+    manifest_path = cache_dir / "manifest.json"
+    if manifest_path.exists():
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["source"] == source:
+            return tuple(manifest["shape"]), read_cached_mtx_entries(
+                cache_dir, manifest["entries"], block_size
+            )
+
+    with open_mtx(path, member) as f:
+        shape, entries, field = read_mtx_header(f)
+    return shape, parse_and_cache_mtx_entries(
+        path, member, cache_dir, shape, entries, field, source, block_size
+    )
+
+
+def read_cached_mtx_entries(cache_dir: Path, entries: int, block_size: int):
+    """Yield the entries of an .npy cache in blocks of about as many entries as a text block holds."""
+    rows, cols, values = (
+        np.load(cache_dir / f"{name}.npy", mmap_mode="r")
+        for name in ("rows", "cols", "values")
+    )
+    # About 20 bytes of text per entry
+    step = max(block_size // 20, 1)
+    for start in range(0, entries, step):
+        yield (
+            np.asarray(rows[start : start + step]),
+            np.asarray(cols[start : start + step]),
+            np.asarray(values[start : start + step]),
+        )
+
+
+def parse_and_cache_mtx_entries(
+    path: Path,
+    member: str | None,
+    cache_dir: Path,
+    shape: tuple[int, int],
+    entries: int,
+    field: str,
+    source: dict,
+    block_size: int,
+):
+    """
+    Parse a Matrix Market file block by block, yield each block and write it to the .npy cache.
+
+    The cache's manifest is written last, so a cache interrupted part way is ignored
+    and rebuilt.
+    """
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    cache_dir.mkdir(parents=True)
+    cache = {
+        name: np.lib.format.open_memmap(
+            cache_dir / f"{name}.npy", mode="w+", dtype=dtype, shape=(entries,)
+        )
+        for name, dtype in (
+            ("rows", np.int32),
+            ("cols", np.int32),
+            ("values", np.float32),
+        )
+    }
+
+    written = 0
+    with open_mtx(path, member) as f:
+        read_mtx_header(f)
+        for rows, cols, values in parse_mtx_entries(f, field, block_size):
+            if written + len(rows) > entries:
+                raise ValueError(
+                    f"{path} has more than the {entries} entries in its header"
+                )
+            for name, block in zip(cache, (rows, cols, values)):
+                cache[name][written : written + len(rows)] = block
+            written += len(rows)
+            yield rows, cols, values
+
+    if written != entries:
+        raise ValueError(f"{path} has {written} entries, its header says {entries}")
+    for array in cache.values():
+        array.flush()
+    del cache
+
+    with open(cache_dir / "manifest.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {"source": source, "shape": list(shape), "entries": entries}, f, indent=4
+        )
+
+
+def resource_snapshot() -> dict:
+    """
+    Read the wall clock, CPU time (including reaped child processes) and I/O counters of this process.
+
+    Bytes read and written are the `rchar`/`wchar` counters of /proc/self/io, so they
+    include reads served from the page cache; they are None where /proc is not available.
+
+    Returns:
+        dict: With 'wall', 'cpu', 'bytes_read' and 'bytes_written'.
+    """
+    times = os.times()
+    snapshot = {
+        "wall": time.perf_counter(),
+        "cpu": times.user + times.system + times.children_user + times.children_system,
+        "bytes_read": None,
+        "bytes_written": None,
+    }
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":") for line in f)
+        snapshot["bytes_read"] = int(counters["rchar"])
+        snapshot["bytes_written"] = int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return snapshot
+
+
+def peak_rss_mb() -> float | None:
+    """Return the peak resident set size of this process so far in MB, or None if unknown."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+class PerfSection(contextlib.ContextDecorator):
+    """
+    Wall time, CPU time, peak RSS, bytes read and written, and records of a named
+    section of code. Create sections with `track_performance()`.
+
+    A section that is entered several times (e.g. once per record) adds up its time,
+    I/O and records; nested entries of the same section count once. Not thread-safe.
+
+    Args:
+        name (str): Name of the section.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.records = 0
+        self.totals = {
+            "wall": 0.0,
+            "cpu": 0.0,
+            "bytes_read": None,
+            "bytes_written": None,
+        }
+        self.peak_rss_mb = None
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.start = resource_snapshot()
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.depth -= 1
+        if self.depth:
+            return False
+
+        end = resource_snapshot()
+        self.calls += 1
+        for key, total in self.totals.items():
+            if end[key] is not None and self.start[key] is not None:
+                self.totals[key] = (total or 0) + end[key] - self.start[key]
+        self.peak_rss_mb = peak_rss_mb()
+        return False
+
+    def as_dict(self) -> dict:
+        wall = self.totals["wall"]
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(self.totals["cpu"], 6),
+            "peak_rss_mb": self.peak_rss_mb,
+            "bytes_read": self.totals["bytes_read"],
+            "bytes_written": self.totals["bytes_written"],
+            "records": self.records,
+            "records_per_second": round(self.records / wall, 3) if wall else None,
+        }
+
+
+perf_sections = {}
+
+
+def track_performance(name: str) -> PerfSection:
+    """
+    Return the performance section of the given name, creating it on first use.
+
+    Use it as a context manager, or as a decorator for a whole function. Set
+    `records` on the section to count what it processed. All sections are written
+    to PERF_FILE at exit, if it is set.
+
+    Example:
+        with track_performance("filter_raw_data: line loop") as perf:
+            for line in lines:
+                ...
+            perf.records = lines.n
+
+    Args:
+        name (str): Name of the section, unique within a script.
+
+    Returns:
+        PerfSection: The section.
+    """
+    if name not in perf_sections:
+        perf_sections[name] = PerfSection(name)
+    return perf_sections[name]
+
+
+def save_performance(path: str | Path):
+    """
+    Write all performance sections that ran as JSON.
+
+    Args:
+        path (str | Path): Path of the JSON file.
+    """
+    sections = [s.as_dict() for s in perf_sections.values() if s.calls]
+    if not sections:
         return
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "script": Path(sys.argv[0]).name,
+                "finished_at": datetime.now().isoformat(timespec="seconds"),
+                "sections": sections,
+            },
+            f,
+            indent=4,
+        )
+
+
+def save_performance_at_exit():
+    """Write all sections to PERF_FILE, in the main process only."""
+    if multiprocessing.parent_process() is not None:
+        return
+    if PERF_FILE:
+        save_performance(PERF_FILE)
+
 
-    # Otherwise, unzip
-    shutil.unpack_archive(file_path, target)
-    print(f"Unzipped {file_path} → {target}")
+atexit.register(save_performance_at_exit)
+
+
+def stage_graph() -> dict:
+    """
+    Return STAGES with every path as a string and duplicates removed, and the value of
+    each config setting, for set_up_and_run.py.
+
+    Returns:
+        dict: Stage script name → {"inputs": [...], "outputs": [...], "config": {...}}.
+    """
+    return {
+        stage: {
+            **{
+                kind: list(dict.fromkeys(str(path) for path in files[kind]))
+                for kind in ("inputs", "outputs")
+            },
+            "config": {key: config.get(key) for key in files["config"]},
+        }
+        for stage, files in STAGES.items()
+    }
@@ -1,39 +1,517 @@
 #!/usr/bin/env python3
+"""
+Set up the virtual environment and run the numbered scripts in `scripts/`.
+
+Stages whose outputs are up to date are skipped, and stages that do not depend
+on each other run in parallel. The inputs, outputs and config.yaml settings of each
+stage are declared in `shared.STAGES`. A stage is up to date if its settings are
+unchanged since its last successful run, and all its outputs exist and are newer
+than its inputs (including its script, and shared.py if it imports it) or the
+content of its inputs is unchanged since then.
+
+Usage:
+    python set_up_and_run.py [--force] [--jobs N] [--dry-run] [STAGE ...]
+"""
+
+import argparse
+import hashlib
+import json
 import os
 import platform
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 # Project root (where setup_and_run.py lives)
 ROOT = Path(__file__).parent
 VENV = ROOT / ".venv"
+BIN_DIR = VENV / ("Scripts" if platform.system() == "Windows" else "bin")
+
+# Folder containing scripts
+SCRIPTS_DIR = ROOT / "scripts"
 
-# Step 1: create venv if it doesn’t exist
-if not VENV.exists():
-    print("🔧 Creating virtual environment...")
-    subprocess.check_call([sys.executable, "-m", "venv", str(VENV)])
+# Hashes of each stage's inputs and settings at its last successful run, and of requirements.txt
+STATE_FILE = ROOT / ".pipeline-state.json"
+REQUIREMENTS_HASH_FILE = VENV / "requirements.sha256"
 
-# Step 2: install dependencies
-pip_path = VENV / ("Scripts" if platform.system() == "Windows" else "bin") / "pip"
-print("📦 Installing dependencies...")
-subprocess.check_call([str(pip_path), "install", "-r", str(ROOT / "requirements.txt")])
+# Folder the scripts write their per-host HTTP stats to (see shared.get_http_session)
+HTTP_STATS_DIR = ROOT / "reports" / "http-stats"
 
-# Step 3: run scripts sequentially
-python_path = VENV / ("Scripts" if platform.system() == "Windows" else "bin") / "python"
+# Folder of the performance record of each run, reports/perf-<start time>.json, with the
+# per-section records each stage wrote (see shared.track_performance)
+PERF_REPORTS_DIR = ROOT / "reports"
 
-# Folder containing scripts
-SCRIPTS_DIR = ROOT / "scripts"
+# Output of each stage when stages run in parallel
+LOGS_DIR = ROOT / "reports" / "logs"
+
+
+def file_hash(path: Path, known: dict) -> str | None:
+    """
+    Return the SHA-256 of a file, reusing the hash in `known` if its size and mtime are unchanged.
+
+    Args:
+        path (Path): The file.
+        known (dict): Path → {"size", "mtime_ns", "sha256"}, updated in place.
+
+    Returns:
+        str | None: The hex digest, or None if the file does not exist.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+
+    entry = known.get(str(path))
+    if (
+        entry
+        and entry["size"] == stat.st_size
+        and entry["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(8 * 1024 * 1024):
+            digest.update(block)
+    known[str(path)] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest.hexdigest(),
+    }
+    return known[str(path)]["sha256"]
+
+
+def set_up_venv() -> Path:
+    """
+    Create the virtual environment if needed and install the requirements,
+    unless requirements.txt is unchanged since the last install.
+
+    Returns:
+        Path: The venv's python.
+    """
+    # Step 1: create venv if it doesn't exist
+    if not VENV.exists():
+        print("🔧 Creating virtual environment...")
+        subprocess.check_call([sys.executable, "-m", "venv", str(VENV)])
+
+    # Step 2: install dependencies
+    requirements = ROOT / "requirements.txt"
+    requirements_hash = hashlib.sha256(requirements.read_bytes()).hexdigest()
+    if (
+        REQUIREMENTS_HASH_FILE.exists()
+        and REQUIREMENTS_HASH_FILE.read_text().strip() == requirements_hash
+    ):
+        print("📦 Dependencies are up to date.")
+    else:
+        print("📦 Installing dependencies...")
+        subprocess.check_call(
+            [str(BIN_DIR / "pip"), "install", "-r", str(requirements)]
+        )
+        REQUIREMENTS_HASH_FILE.write_text(requirements_hash)
+
+    return BIN_DIR / "python"
+
+
+def load_stages(python_path: Path) -> dict:
+    """
+    Find the numbered scripts and look up their declared inputs, outputs and settings
+    in shared.STAGES.
+
+    Scripts without a declaration depend on every earlier script, and every later
+    script depends on them.
+
+    Args:
+        python_path (Path): The venv's python, used to import shared.py.
+
+    Returns:
+        dict: Script name → {"inputs", "outputs", "config", "deps"}, in run order.
+    """
+    scripts = sorted(
+        file
+        for file in os.listdir(SCRIPTS_DIR)
+        if file.split(".")[-1] == "py" and file.split(".")[-2] != "shared"
+    )
+
+    output = subprocess.check_output(
+        [
+            str(python_path),
+            "-c",
+            "import json, shared; print(json.dumps(shared.stage_graph()))",
+        ],
+        cwd=SCRIPTS_DIR,
+        text=True,
+    )
+    declared = json.loads(output.strip().splitlines()[-1])
+
+    stages = {}
+    for script in scripts:
+        files = declared.get(script)
+        inputs = None if files is None else [Path(p) for p in files["inputs"]]
+        outputs = None if files is None else [Path(p) for p in files["outputs"]]
+        stages[script] = {
+            "inputs": inputs,
+            "outputs": outputs,
+            "config": None if files is None else files["config"],
+            "deps": {
+                earlier
+                for earlier, stage in stages.items()
+                if inputs is None
+                or stage["outputs"] is None
+                or set(stage["outputs"]) & set(inputs)
+            },
+        }
+    return stages
+
+
+def stage_inputs(script: str, stage: dict) -> list[Path]:
+    """
+    Return the files a stage depends on: its script, shared.py if the script imports
+    it, and its declared inputs.
+    """
+    script_path = SCRIPTS_DIR / script
+    source = script_path.read_text(encoding="utf-8") if script_path.exists() else ""
+    if re.search(r"^(from shared import|import shared\b)", source, re.MULTILINE):
+        return [script_path, SCRIPTS_DIR / "shared.py", *stage["inputs"]]
+    return [script_path, *stage["inputs"]]
+
+
+def config_hashes(stage: dict) -> dict:
+    """Return the SHA-256 of the value of each setting of a stage, by "config.yaml:<key>"."""
+    return {
+        f"config.yaml:{key}": hashlib.sha256(
+            json.dumps(value, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        for key, value in stage["config"].items()
+    }
+
+
+def is_up_to_date(script: str, stage: dict, state: dict) -> tuple[bool, str]:
+    """
+    Check whether a stage can be skipped.
+
+    Args:
+        script (str): The stage's script name.
+        stage (dict): From `load_stages()`.
+        state (dict): The runner state, see STATE_FILE.
+
+    Returns:
+        tuple[bool, str]: Whether it is up to date, and why (not).
+    """
+    if stage["outputs"] is None:
+        return False, "no declared outputs"
+
+    missing = [p for p in stage["outputs"] if not p.exists()]
+    if missing:
+        return False, f"missing {missing[0].name}"
+
+    inputs = stage_inputs(script, stage)
+    missing = [p for p in inputs if not p.exists()]
+    if missing:
+        return False, f"missing input {missing[0].name}"
 
-scripts_to_run = sorted([
-    file
-    for file in os.listdir(SCRIPTS_DIR)
-    if file.split(".")[-1] == "py" and file.split(".")[-2] != 'shared'
-])
+    # Settings first, since file times say nothing about them. Runs recorded before a
+    # setting was declared did not hash it, so it counts as unchanged.
+    last_run = state["stages"].get(script)
+    if last_run is not None:
+        for key, digest in config_hashes(stage).items():
+            if last_run.get(key, digest) != digest:
+                return False, f"{key} changed"
 
-for script in scripts_to_run:
+    # Fast path: outputs newer than inputs
+    oldest_output = min(p.stat().st_mtime_ns for p in stage["outputs"])
+    newest_input = max(p.stat().st_mtime_ns for p in inputs)
+    if oldest_output >= newest_input:
+        return True, "outputs are newer than inputs"
+
+    # Fallback: input contents unchanged since the last successful run (files it
+    # recorded that are no longer inputs do not count)
+    if last_run is None:
+        return False, "no previous run"
+    hashes = {str(p): file_hash(p, state["files"]) for p in inputs}
+    changed = next((p for p in hashes if hashes[p] != last_run.get(p)), None)
+    if changed is None:
+        return True, "inputs unchanged"
+    return False, f"{Path(changed).name} changed"
+
+
+def print_http_stats(stats_file: Path):
+    """Print the per-host HTTP stats a script wrote at exit, if it made any requests."""
+    if not stats_file.exists():
+        return
+    with open(stats_file, "r", encoding="utf-8") as f:
+        stats = json.load(f)
+    print("🌐 HTTP requests by host:")
+    for host, s in sorted(stats.items(), key=lambda item: -item[1]["seconds"]):
+        mean = s["seconds"] / s["requests"] if s["requests"] else 0
+        print(
+            f"   {host}: {s['requests']} requests, {s['errors']} errors, {s['retries']} retries, "
+            f"{mean:.2f} s mean / {s['max_seconds']:.2f} s max latency, {s['bytes'] / 1e6:.1f} MB"
+        )
+
+
+def print_performance(perf_file: Path):
+    """Print the performance sections a script wrote at exit, slowest first."""
+    if not perf_file.exists():
+        return
+    with open(perf_file, "r", encoding="utf-8") as f:
+        perf = json.load(f)
+    print("⏱️ Performance by section:")
+    for s in sorted(perf["sections"], key=lambda s: -s["wall_seconds"]):
+        line = (
+            f"   {s['name']}: {s['wall_seconds']:.2f} s wall, {s['cpu_seconds']:.2f} s CPU, "
+            f"{s['peak_rss_mb'] or 0:.0f} MB peak RSS"
+        )
+        if s["bytes_read"] is not None:
+            line += f", {s['bytes_read'] / 1e6:.1f} MB read, {s['bytes_written'] / 1e6:.1f} MB written"
+        if s["records"]:
+            line += f", {s['records']} records ({s['records_per_second']:.0f}/s)"
+        print(line)
+
+
+def run_stage(
+    python_path: Path, script: str, log_file: Path | None, perf_dir: Path
+) -> int:
+    """
+    Run one script, with its output going to the console or (in parallel runs) to a log file.
+
+    Args:
+        python_path (Path): The venv's python.
+        script (str): The script name.
+        log_file (Path | None): Log file, or None for the console.
+        perf_dir (Path): Folder the script writes its performance sections to.
+
+    Returns:
+        int: The exit code.
+    """
     script_path = SCRIPTS_DIR / script
-    print(f"\n🚀 Running {script_path.relative_to(ROOT)}...")
-    subprocess.check_call([str(python_path), str(script_path)])
+    stats_file = HTTP_STATS_DIR / f"{script_path.stem}.json"
+    perf_file = perf_dir / f"{script_path.stem}.json"
+    for f in (stats_file, perf_file):
+        f.unlink(missing_ok=True)
+    env = {
+        **os.environ,
+        "HTTP_STATS_FILE": str(stats_file),
+        "PERF_FILE": str(perf_file),
+    }
+
+    if log_file is None:
+        returncode = subprocess.call([str(python_path), str(script_path)], env=env)
+    else:
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_file, "w", encoding="utf-8") as log:
+            returncode = subprocess.call(
+                [str(python_path), str(script_path)],
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+    print_http_stats(stats_file)
+    print_performance(perf_file)
+    return returncode
+
+
+def save_pipeline_performance(timings: dict, perf_dir: Path, started: time.struct_time):
+    """
+    Write the status and wall time of each stage of this run, with the sections each
+    stage that ran recorded, to PERF_REPORTS_DIR/perf-<start time>.json, so that every
+    run keeps its own record.
+
+    Args:
+        timings (dict): Script → {"status", "wall_seconds"}.
+        perf_dir (Path): Folder the stages wrote their performance sections to.
+        started (time.struct_time): Local time the run started.
+    """
+    stages = []
+    for script, timing in timings.items():
+        perf_file = perf_dir / f"{Path(script).stem}.json"
+        sections = []
+        if timing["status"] != "skipped" and perf_file.exists():
+            with open(perf_file, "r", encoding="utf-8") as f:
+                sections = json.load(f)["sections"]
+        stages.append({"stage": script, **timing, "sections": sections})
+
+    report = PERF_REPORTS_DIR / f"perf-{time.strftime('%Y%m%d-%H%M%S', started)}.json"
+    PERF_REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(report, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", started),
+                "stages": stages,
+            },
+            f,
+            indent=4,
+        )
+    print(f"\n⏱️ Stage timings saved to {report.relative_to(ROOT)}")
+
+
+def run_pipeline(
+    python_path: Path,
+    stages: dict,
+    force: set[str],
+    jobs: int,
+    dry_run: bool = False,
+) -> bool:
+    """
+    Run the stages that are out of date, each as soon as the stages it depends on are done.
+
+    Whether a stage is up to date is decided only once its dependencies have
+    finished, so a stage whose upstream rerun did not change its inputs is skipped.
+
+    Args:
+        python_path (Path): The venv's python.
+        stages (dict): From `load_stages()`.
+        force (set[str]): Scripts to run even if they are up to date.
+        jobs (int): Maximum number of stages running at the same time.
+        dry_run (bool, optional): Only print what would run. Defaults to False.
+
+    Returns:
+        bool: True if every stage succeeded or was skipped.
+    """
+    state = {"stages": {}, "files": {}}
+    if STATE_FILE.exists():
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    lock = threading.Lock()
+    timings = {}
+    started = time.localtime()
+
+    # The stages write their performance sections here, to be saved with the timings
+    perf_dir = tempfile.TemporaryDirectory(prefix="pipeline-perf-")
+
+    def save_state():
+        with lock:
+            tmp_path = STATE_FILE.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, STATE_FILE)
+
+    def execute(script: str) -> bool:
+        stage = stages[script]
+        log_file = LOGS_DIR / f"{Path(script).stem}.log" if jobs > 1 else None
+        message = f"\n🚀 Running scripts/{script}..."
+        if log_file:
+            message += f"\n   📄 Output in {log_file.relative_to(ROOT)}"
+        print(message)
+
+        start = time.perf_counter()
+        returncode = run_stage(python_path, script, log_file, Path(perf_dir.name))
+        with lock:
+            timings[script] = {
+                "status": "failed" if returncode else "ran",
+                "wall_seconds": round(time.perf_counter() - start, 3),
+            }
+        if returncode != 0:
+            print(f"❌ scripts/{script} failed with exit code {returncode}")
+            if log_file:
+                print(
+                    "".join(log_file.read_text(encoding="utf-8").splitlines(True)[-20:])
+                )
+            return False
+
+        print(f"✅ scripts/{script} done")
+        if stage["inputs"] is not None:
+            with lock:
+                state["stages"][script] = {
+                    **{
+                        str(p): file_hash(p, state["files"])
+                        for p in stage_inputs(script, stage)
+                    },
+                    **config_hashes(stage),
+                }
+            save_state()
+        return True
+
+    pending = dict(stages)
+    done, failed = set(), set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            # Start every stage whose dependencies are done
+            for script, stage in list(pending.items()):
+                if stage["deps"] & failed:
+                    print(
+                        f"⏭️ Not running scripts/{script}, a stage it depends on failed"
+                    )
+                    failed.add(script)
+                    del pending[script]
+                elif stage["deps"] <= done and len(running) < jobs:
+                    del pending[script]
+                    with lock:
+                        up_to_date, reason = is_up_to_date(script, stage, state)
+                    if script in force:
+                        up_to_date, reason = False, "forced"
+                    if up_to_date:
+                        print(f"⏭️ Skipping scripts/{script} ({reason})")
+                        timings[script] = {"status": "skipped", "wall_seconds": 0}
+                        done.add(script)
+                    elif dry_run:
+                        print(f"📝 Would run scripts/{script} ({reason})")
+                        done.add(script)
+                    else:
+                        print(f"ℹ️ scripts/{script}: {reason}")
+                        running[pool.submit(execute, script)] = script
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                script = running.pop(future)
+                (done if future.result() else failed).add(script)
+
+    save_state()
+    if timings and not dry_run:
+        save_pipeline_performance(timings, Path(perf_dir.name), started)
+    perf_dir.cleanup()
+    return not failed
+
+
+def main():
+    # Driver code
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        help="Stages to run even if up to date, by script name or number (e.g. 41)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Run every stage, even if up to date"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=2,
+        help="Maximum number of stages running in parallel (default: 2)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only print which stages would run"
+    )
+    args = parser.parse_args()
+
+    python_path = set_up_venv()
+    stages = load_stages(python_path)
+
+    force = {
+        script
+        for script in stages
+        if args.force
+        or any(script.split("-")[0] == s or script == s for s in args.stages)
+    }
+
+    if not run_pipeline(python_path, stages, force, max(args.jobs, 1), args.dry_run):
+        print("\n❌ Some scripts failed.")
+        sys.exit(1)
+
+    if not args.dry_run:
+        print("\n✅ All scripts completed successfully!")
+
 
-print("\n✅ All scripts completed successfully!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Shared helpers of the tests of the pipeline scripts.
+
+The scripts import each other by name from scripts/, as when they are run from there.
+"""
+
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+import yaml
+
+DATA_PREPROCESSOR_DIR = Path(__file__).parent.parent
+SCRIPTS_DIR = DATA_PREPROCESSOR_DIR / "scripts"
+BENCHMARKS_DIR = DATA_PREPROCESSOR_DIR / "benchmarks"
+
+sys.path.insert(0, str(SCRIPTS_DIR))
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+
+def load_stage(filename: str):
+    """
+    Load a stage script as a module (their names start with a number).
+
+    The module is registered, so worker processes can unpickle its functions.
+    """
+    name = Path(filename).stem.replace("-", "_")
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, SCRIPTS_DIR / filename)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+@pytest.fixture
+def stage10(tmp_path, monkeypatch):
+    """Stage 10, saving its CTs per FTU to a temporary file."""
+    module = load_stage("10-identify-cell-types-ftu-only.py")
+    monkeypatch.setattr(
+        module, "CELL_TYPES_IN_FTUS", tmp_path / "cell-types-in-ftus.json"
+    )
+    return module
+
+
+@pytest.fixture
+def pipeline_copy(tmp_path):
+    """
+    Return a function that copies the scripts to a throwaway pipeline folder.
+
+    The paths of shared.py are fixed on import, so stages are run in the copy with
+    `run_python()` rather than imported. Keyword arguments override config.yaml settings.
+    """
+
+    def copy(**settings) -> Path:
+        preprocessor_dir = tmp_path / "data-preprocessor"
+        scripts_dir = preprocessor_dir / "scripts"
+        shutil.copytree(
+            SCRIPTS_DIR, scripts_dir, ignore=shutil.ignore_patterns("__pycache__")
+        )
+        (tmp_path / "docs" / "iftu-testing" / "assets").mkdir(parents=True)
+
+        with open(scripts_dir / "config.yaml", "r", encoding="utf-8") as f:
+            config = yaml.safe_load(f)
+        config.update(settings)
+        with open(scripts_dir / "config.yaml", "w", encoding="utf-8") as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+        return preprocessor_dir
+
+    return copy
+
+
+def run_python(preprocessor_dir: Path, source: str) -> str:
+    """Run Python code in the scripts folder of a pipeline copy and return its output."""
+    result = subprocess.run(
+        [sys.executable, "-c", source],
+        cwd=preprocessor_dir / "scripts",
+        env={**os.environ, "HTTP_OFFLINE": "1"},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout + result.stderr
+
+
+# Runs stage 20 without its downloads, on the inputs already in a pipeline copy
+FILTER_SOURCE = """
+import importlib.util
+import json
+import sys
+
+# Registered, so the worker processes can unpickle its functions
+spec = importlib.util.spec_from_file_location("stage20", "20-preprocess-hra-pop.py")
+stage20 = importlib.util.module_from_spec(spec)
+sys.modules["stage20"] = stage20
+spec.loader.exec_module(stage20)
+
+from shared import *
+
+with open(CELL_TYPES_IN_FTUS, "r", encoding="utf-8") as f:
+    cell_types_in_ftus = json.load(f)
+metadata = pd.read_csv(UNIVERSE_METADATA_FILENAME)
+datasets_of_interest = stage20.identify_datasets_of_interest(cell_types_in_ftus, metadata)
+index = FtuIndex(cell_types_in_ftus, datasets_of_interest)
+
+if "{backend}" == "duckdb":
+    stage20.filter_raw_data_duckdb(index)
+else:
+    stage20.filter_raw_data(index, workers={workers}, batch_size=4)
+"""
+
+
+def filter_universe(
+    preprocessor_dir: Path, backend: str = "python", workers: int = 1
+) -> str:
+    """
+    Filter the universe of a pipeline copy with a backend of stage 20, return its output.
+
+    The Python backend sends small batches of lines to its `workers`, so that a few
+    datasets already make several batches.
+    """
+    return run_python(
+        preprocessor_dir, FILTER_SOURCE.format(backend=backend, workers=workers)
+    )
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves the files of its `StandInServer`, see there."""
+
+    def do_HEAD(self):
+        self.reply(body=False)
+
+    def do_GET(self):
+        self.reply(body=True)
+
+    def reply(self, body: bool):
+        server = self.server.stand_in
+        path = self.path.split("?")[0]
+        with server.lock:
+            server.requests.append((self.command, self.path, dict(self.headers)))
+            status = server.failures.pop(0) if server.failures else None
+
+        if status is not None or path not in server.files:
+            self.send_response(status or 404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = server.files[path]
+        headers = server.headers.get(path, {})
+        if (
+            "ETag" in headers
+            and self.headers.get("If-None-Match") == headers["ETag"]
+            or "Last-Modified" in headers
+            and self.headers.get("If-Modified-Since") == headers["Last-Modified"]
+        ):
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        status = 200
+        byte_range = self.headers.get("Range")
+        if server.ranges and byte_range:
+            start, _, end = byte_range.removeprefix("bytes=").partition("-")
+            start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+            content_range = f"bytes {start}-{end}/{len(data)}"
+            data = data[start : end + 1]
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", content_range)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer:
+    """
+    A local HTTP server standing in for the remote ones in the tests of the HTTP helpers.
+
+    Serves `files` (path → bytes) with the extra `headers` of each path, answers
+    If-None-Match / If-Modified-Since with 304 Not Modified when they match its ETag
+    or Last-Modified, and serves byte ranges unless `ranges` is False. The next
+    requests get the statuses queued in `failures` instead. All requests are kept in
+    `requests` as (method, path, headers).
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.headers = {}
+        self.ranges = True
+        self.failures = []
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stand_in = self
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}{path}"
+
+    def requests_of(self, method: str) -> list:
+        return [request for request in self.requests if request[0] == method]
+
+
+@pytest.fixture
+def stand_in_server():
+    server = StandInServer()
+    thread = threading.Thread(
+        target=server.httpd.serve_forever, args=(0.05,), daemon=True
+    )
+    thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+@pytest.fixture
+def http(tmp_path, monkeypatch):
+    """
+    The HTTP helpers of shared.py with a fresh session, stats and cache, without
+    backoff between retries and online.
+    """
+    import shared
+
+    monkeypatch.setattr(shared, "HTTP_OFFLINE", False)
+    monkeypatch.setattr(shared, "HTTP_BACKOFF_FACTOR", 0)
+    monkeypatch.setattr(shared, "HTTP_BACKOFF_JITTER", 0)
+    monkeypatch.setattr(shared, "_http_session", None)
+    monkeypatch.setattr(shared, "http_stats", shared.HttpStats())
+    monkeypatch.setattr(shared, "http_cache", shared.HttpCache(tmp_path / "http-cache"))
+    return shared
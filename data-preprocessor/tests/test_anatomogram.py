@@ -0,0 +1,313 @@
+"""
+Tests of the aggregation of SCEA experiments into CellSummaries by stage 30, on small
+synthetic experiments checked against dense numpy computations.
+"""
+
+import gzip
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import shared
+from conftest import load_stage, run_python
+
+STAGE = "30-preprocess-anatomogram-cell-type-populations.py"
+MATRIX_SUFFIX = ".aggregated_filtered_normalised_counts.mtx"
+CL = "http://purl.obolibrary.org/obo/CL_"
+
+# Ontology term and label of the cells, by type code
+CELL_TYPES = [
+    (f"{CL}0000084", "T cell"),
+    (f"{CL}0000236", "B cell"),
+    ("http://www.ebi.ac.uk/efo/EFO_0000001", "not a cell type"),
+    (None, None),
+]
+
+ORGAN = {
+    "name": "kidney",
+    "experiment_id": "E-TEST-1",
+    "paper_doi": "https://doi.org/10.0000/test",
+}
+
+
+def write_experiment(organ_dir, organ: dict, seed: int = 0, genes: int = 9):
+    """
+    Write the files of a small SCEA experiment of 60 cells from 2 donors: the
+    extracted matrix files, the zip file they come from and the experiment design.
+
+    Gene 0 is the most expressed one in every cell and gene 1 is a copy of it, so
+    that their means tie at the top. The last gene is not expressed. The last 5 cells
+    have no design row, and the first cell has two.
+
+    Returns:
+        tuple[np.ndarray, pd.DataFrame]: The genes × cells matrix, and the design.
+    """
+    rng = np.random.default_rng(seed)
+    cells = 60
+    dense = np.round(rng.gamma(1.5, 2.0, (genes, cells)), 2)
+    dense[rng.random((genes, cells)) < 0.5] = 0
+    dense[0] = 100 + np.round(rng.random(cells), 2)
+    dense[1] = dense[0]
+    dense[-1] = 0
+
+    organ_dir.mkdir(parents=True, exist_ok=True)
+    base = organ_dir / f"{organ['experiment_id']}{MATRIX_SUFFIX}"
+    rows, cols = np.nonzero(dense)
+    lines = [
+        "%%MatrixMarket matrix coordinate real general",
+        f"{genes} {cells} {len(rows)}",
+        *(f"{r + 1} {c + 1} {dense[r, c]:g}" for r, c in zip(rows, cols)),
+    ]
+    base.write_text("\n".join(lines) + "\n")
+    pd.DataFrame(
+        {
+            "id": [f"ENSG{i:011d}" for i in range(genes)],
+            "label": list("ABCDEFGHIJ")[:genes],
+        }
+    ).to_csv(f"{base}_rows", sep="\t", header=False, index=False)
+    assays = [f"{organ['name']}-cell{i}" for i in range(cells)]
+    pd.Series(assays).to_csv(f"{base}_cols", header=False, index=False)
+
+    codes = rng.integers(0, len(CELL_TYPES), cells)
+    design = pd.DataFrame(
+        {
+            "Assay": assays,
+            "Sample Characteristic[individual]": rng.integers(1, 3, cells),
+            "Sample Characteristic[organism part]": "renal cortex",
+            "Factor Value[inferred cell type - ontology labels]": [
+                CELL_TYPES[c][1] for c in codes
+            ],
+            "Factor Value Ontology Term[inferred cell type - ontology labels]": [
+                CELL_TYPES[c][0] for c in codes
+            ],
+        }
+    ).iloc[:-5]
+    design = pd.concat([design.iloc[:1], design])
+    design.to_csv(organ_dir / f"{organ['experiment_id']}.tsv", sep="\t", index=False)
+
+    zip_experiment(organ_dir, organ)
+    return dense, design
+
+
+def zip_experiment(organ_dir, organ: dict):
+    """Write the zip file of the matrix files of an experiment, as SCEA serves it."""
+    base = organ_dir / f"{organ['experiment_id']}{MATRIX_SUFFIX}"
+    with zipfile.ZipFile(organ_dir / f"{organ['name']}.zip", "w") as archive:
+        for suffix in ("", "_rows", "_cols"):
+            archive.write(f"{base}{suffix}", f"{base.name}{suffix}")
+
+
+def expected_cell_summaries(organ: dict, dense: np.ndarray, design, top_n: int):
+    """Compute the CellSummaries of an experiment with dense numpy arrays."""
+    design = design.drop_duplicates("Assay")
+    term = design["Factor Value Ontology Term[inferred cell type - ontology labels]"]
+    design = design[term.str.startswith(CL, na=False)]
+    cell_index = design["Assay"].str.rsplit("cell", n=1).str[-1].astype(int).to_numpy()
+
+    summaries = {}
+    groups = design.assign(column=cell_index).groupby(
+        [
+            "Sample Characteristic[individual]",
+            "Factor Value Ontology Term[inferred cell type - ontology labels]",
+        ]
+    )
+    for (donor, iri), group in groups:
+        means = dense[:, group["column"].to_numpy()].mean(axis=1)
+        genes = [g for g in np.argsort(-means, kind="stable") if means[g] != 0]
+        dataset = f"{organ['paper_doi']}#{donor}$renal-cortex"
+        summaries.setdefault(dataset, []).append(
+            {
+                "cell_id": f"CL:{iri.removeprefix(CL)}",
+                "count": len(group),
+                "genes": [(f"ENSG{g:011d}", means[g]) for g in genes[:top_n]],
+            }
+        )
+    return summaries
+
+
+def actual_cell_summaries(cell_summaries: list) -> dict:
+    return {
+        cs["cell_source"]: [
+            {
+                "cell_id": row["cell_id"],
+                "count": row["count"],
+                "genes": [
+                    (g["ensembl_id"], g["mean_gene_expr_value"])
+                    for g in row["gene_expr"]
+                ],
+            }
+            for row in cs["summary"]
+        ]
+        for cs in cell_summaries
+    }
+
+
+def assert_same_summaries(actual: dict, expected: dict):
+    assert actual.keys() == expected.keys()
+    for dataset, rows in expected.items():
+        assert [(r["cell_id"], r["count"]) for r in actual[dataset]] == [
+            (r["cell_id"], r["count"]) for r in rows
+        ]
+        for actual_row, row in zip(actual[dataset], rows):
+            assert [g for g, _ in actual_row["genes"]] == [g for g, _ in row["genes"]]
+            np.testing.assert_allclose(
+                [v for _, v in actual_row["genes"]],
+                [v for _, v in row["genes"]],
+                rtol=1e-6,
+            )
+
+
+@pytest.fixture
+def stage30(tmp_path, monkeypatch):
+    """Stage 30, reading the experiments from a temporary folder."""
+    module = load_stage(STAGE)
+    monkeypatch.setattr(module, "ANATOMOGRAMN_RAW_DATA", tmp_path)
+    monkeypatch.setattr(module, "ANATOMOGRAM_MTX_FROM_ZIP", False)
+    return module
+
+
+def test_read_cell_annotations(stage30, tmp_path):
+    _, design = write_experiment(tmp_path / ORGAN["name"], ORGAN)
+
+    annotations = stage30.read_cell_annotations(ORGAN)
+
+    term = design["Factor Value Ontology Term[inferred cell type - ontology labels]"]
+    expected = design[term.str.startswith(CL, na=False)].drop_duplicates("Assay")
+    assert list(annotations.index) == list(expected["Assay"])
+    assert set(annotations["cell_id"]) == {"CL:0000084", "CL:0000236"}
+    assert set(annotations["cell_label"]) == {"T cell", "B cell"}
+    assert set(annotations["dataset_id"]) == {
+        f"{ORGAN['paper_doi']}#{donor}$renal-cortex" for donor in (1, 2)
+    }
+
+
+def test_read_cell_annotations_needs_cell_type_columns(stage30, tmp_path):
+    (tmp_path / ORGAN["name"]).mkdir()
+    pd.DataFrame({"Assay": ["a"]}).to_csv(
+        tmp_path / ORGAN["name"] / f"{ORGAN['experiment_id']}.tsv",
+        sep="\t",
+        index=False,
+    )
+
+    with pytest.raises(ValueError, match="No inferred cell type columns"):
+        stage30.read_cell_annotations(ORGAN)
+
+
+@pytest.mark.parametrize("top_n", [3, 100])
+@pytest.mark.parametrize("from_zip", [False, True])
+def test_build_cell_summaries_matches_numpy(
+    stage30, tmp_path, monkeypatch, top_n, from_zip
+):
+    dense, design = write_experiment(tmp_path / ORGAN["name"], ORGAN)
+    monkeypatch.setattr(stage30, "ANATOMOGRAM_MTX_FROM_ZIP", from_zip)
+
+    cell_summaries = stage30.build_cell_summaries(ORGAN, top_n)
+
+    expected = expected_cell_summaries(ORGAN, dense, design, top_n)
+    assert_same_summaries(actual_cell_summaries(cell_summaries), expected)
+    for cs in cell_summaries:
+        assert cs["annotation_method"] == "sc_experiment_atlas"
+        assert sum(row["percentage"] for row in cs["summary"]) == pytest.approx(1)
+    # Genes 0 and 1 tie, and stay in gene order
+    for cs in cell_summaries:
+        for row in cs["summary"]:
+            assert [g["ensembl_id"] for g in row["gene_expr"][:2]] == [
+                "ENSG00000000000",
+                "ENSG00000000001",
+            ]
+
+
+def test_stage_exits_non_zero_if_an_organ_fails(pipeline_copy):
+    preprocessor_dir = pipeline_copy()
+
+    # Offline and with nothing downloaded, every organ fails
+    result = subprocess.run(
+        [sys.executable, STAGE],
+        cwd=preprocessor_dir / "scripts",
+        env={**os.environ, "HTTP_OFFLINE": "1"},
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 1, result.stderr
+    assert "Not saving" in result.stdout
+    assert not (
+        preprocessor_dir / "raw-data" / "anatomogram-cell-summaries.jsonl.gz"
+    ).exists()
+
+
+def test_failed_organs_do_not_stop_the_others(pipeline_copy):
+    preprocessor_dir = pipeline_copy()
+    raw_dir = preprocessor_dir / "raw-data" / "anatomogram-raw"
+    kidney, liver, lung, pancreas = shared.anatomogram_files_json
+    experiments = {
+        organ["name"]: write_experiment(raw_dir / organ["name"], organ, seed)
+        for seed, organ in enumerate((kidney, liver, pancreas))
+    }
+    # The lung is not downloaded (and cannot be, offline); the pancreas matrix has
+    # a gene more than its gene list
+    genes = raw_dir / "pancreas" / f"{pancreas['experiment_id']}{MATRIX_SUFFIX}_rows"
+    genes.write_text("".join(genes.read_text().splitlines(keepends=True)[:-1]))
+    zip_experiment(raw_dir / "pancreas", pancreas)
+
+    result = subprocess.run(
+        [sys.executable, STAGE],
+        cwd=preprocessor_dir / "scripts",
+        env={**os.environ, "HTTP_OFFLINE": "1"},
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 1, result.stderr
+    assert "❌ lung: download failed" in result.stdout
+    assert "❌ pancreas: aggregation failed" in result.stdout
+    assert "failed: " in result.stdout
+    assert not (
+        preprocessor_dir / "raw-data" / "anatomogram-cell-summaries.jsonl.gz"
+    ).exists()
+    for organ in (kidney, liver):
+        path = (
+            raw_dir
+            / organ["name"]
+            / f"{organ['experiment_id']}.cell-summaries.jsonl.gz"
+        )
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            cell_summaries = [json.loads(line) for line in f]
+        expected = expected_cell_summaries(
+            organ, *experiments[organ["name"]], shared.ANATOMOGRAM_TOP_N_GENES
+        )
+        assert_same_summaries(actual_cell_summaries(cell_summaries), expected)
+    assert not list((raw_dir / "pancreas").glob("*.cell-summaries.jsonl.gz*"))
+
+    # Without the failed organs, the CellSummaries are combined in organ order
+    run_python(
+        preprocessor_dir,
+        f"""
+import importlib.util
+import sys
+
+spec = importlib.util.spec_from_file_location("stage30", "{STAGE}")
+stage30 = importlib.util.module_from_spec(spec)
+sys.modules["stage30"] = stage30
+spec.loader.exec_module(stage30)
+
+from shared import *
+
+assert stage30.extract_cell_type_populations(
+    anatomogram_files_json[:2], ANATOMOGRAM_CELL_SUMMARIES
+) == {{}}
+""",
+    )
+    with gzip.open(
+        preprocessor_dir / "raw-data" / "anatomogram-cell-summaries.jsonl.gz",
+        "rt",
+        encoding="utf-8",
+    ) as f:
+        papers = [json.loads(line)["cell_source"].split("#")[0] for line in f]
+    assert papers == [kidney["paper_doi"]] * 2 + [liver["paper_doi"]] * 2
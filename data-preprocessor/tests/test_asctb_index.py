@@ -0,0 +1,52 @@
+"""
+Tests of the (FTU, CT) flag lookups of AsctbIndex.
+"""
+
+from io import StringIO
+
+import pandas as pd
+
+from shared import AsctbIndex, get_in_asctb
+
+# As FTU_QUERY reads it: blank flag cells make object columns of bools and NaN
+FTU_QUERY_CSV = """ftu_iri,ct_iri,in_2d_ftu,in_asctb,exclusive_ct_in_ftu
+https://purl.humanatlas.io/2d-ftu/kidney-nephron,http://purl.obolibrary.org/obo/CL_1000768,TRUE,TRUE,
+https://purl.humanatlas.io/2d-ftu/kidney-nephron,http://purl.obolibrary.org/obo/CL_1000849,TRUE,,FALSE
+https://purl.humanatlas.io/2d-ftu/lung-alveolus,http://purl.obolibrary.org/obo/CL_0002062,,true,TRUE
+"""
+
+
+def read_ftu_query() -> pd.DataFrame:
+    return pd.read_csv(StringIO(FTU_QUERY_CSV))
+
+
+def test_blank_flag_cells_are_false():
+    index = AsctbIndex(read_ftu_query())
+
+    nephron = "https://purl.humanatlas.io/2d-ftu/kidney-nephron"
+    alveolus = "https://purl.humanatlas.io/2d-ftu/lung-alveolus"
+    assert index.in_asctb(nephron, "CL:1000768")
+    assert not index.exclusive(nephron, "CL:1000768")
+    assert not index.in_asctb(nephron, "http://purl.obolibrary.org/obo/CL_1000849")
+    assert not index.in_2d_ftu(alveolus, "CL:0002062")
+    assert index.exclusive(alveolus, "CL:0002062")
+
+
+def test_get_in_asctb_with_blank_flag_cells():
+    ftu_query = read_ftu_query()
+    nephron = "https://purl.humanatlas.io/2d-ftu/kidney-nephron"
+
+    assert get_in_asctb(ftu_query, nephron, "CL:1000768")
+    assert not get_in_asctb(ftu_query, nephron, "CL:1000849")
+    assert not get_in_asctb(ftu_query, nephron, "CL:0002062")
+
+
+def test_arrays_of_pairs():
+    index = AsctbIndex(read_ftu_query())
+
+    flags = index.in_asctb(
+        ["https://purl.humanatlas.io/2d-ftu/kidney-nephron"] * 3,
+        ["CL:1000768", "CL:1000849", "CL:0000000"],
+    )
+
+    assert flags.tolist() == [True, False, False]
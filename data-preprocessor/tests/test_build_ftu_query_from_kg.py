@@ -0,0 +1,130 @@
+"""
+Tests of building the FTU query table of stage 10 from (faked) HRA KG digital objects.
+"""
+
+import shared
+
+KIDNEY = "http://purl.obolibrary.org/obo/UBERON_0002113"
+NEPHRON = "http://purl.obolibrary.org/obo/UBERON_0001285"
+NEPHRON_FTU = "https://purl.humanatlas.io/2d-ftu/kidney-nephron"
+
+
+def asctb_table(iri: str, structures: list, cell_types: list, ftu_cts: list) -> dict:
+    return {
+        "iri": iri,
+        "data": {
+            "anatomical_structures": structures,
+            "cell_types": cell_types,
+            "asctb_record": [
+                {
+                    "ftu_list": [{"source_concept": "UBERON:0001285"}],
+                    "cell_type_list": [
+                        {"source_concept": ct, "ccf_pref_label": label}
+                        for ct, label in ftu_cts
+                    ],
+                }
+            ],
+        },
+    }
+
+
+KIDNEY_STRUCTURES = [
+    {"id": "UBERON:0002113", "ccf_pref_label": "kidney"},
+    {"id": "UBERON:0001285", "ccf_pref_label": "nephron"},
+]
+
+DIGITAL_OBJECTS = {
+    shared.HRA_DIGITAL_OBJECTS: {
+        "@graph": [
+            {
+                "@id": "https://lod.humanatlas.io/asct-b/kidney",
+                "doType": "asct-b",
+                "organIds": [KIDNEY],
+            },
+            # Lists the kidney as an AS, but is not a kidney table
+            {
+                "@id": "https://lod.humanatlas.io/asct-b/blood-vasculature",
+                "doType": "asct-b",
+                "organIds": ["UBERON:0004537"],
+            },
+            {
+                "@id": "https://lod.humanatlas.io/asct-b/kidney-extra",
+                "doType": "asct-b",
+                "organIds": ["UBERON:0002113"],
+            },
+            {
+                "@id": "https://lod.humanatlas.io/asct-b/anatomical-systems",
+                "doType": "asct-b",
+                "organIds": [KIDNEY],
+            },
+        ]
+    },
+    NEPHRON_FTU: {
+        "iri": NEPHRON_FTU,
+        "data": [
+            {
+                "representation_of": NEPHRON,
+                "illustration_node": [
+                    {"representation_of": f"http://purl.obolibrary.org/obo/CL_{i}"}
+                    for i in (1, 2, 3)
+                ],
+            }
+        ],
+    },
+    "https://purl.humanatlas.io/asct-b/kidney": asctb_table(
+        "https://purl.humanatlas.io/asct-b/kidney",
+        KIDNEY_STRUCTURES,
+        [{"id": "CL:1", "ccf_located_in": ["UBERON:0001285"]}, {"id": "CL:2"}],
+        [("CL:1", "ct one"), ("CL:4", "ct four")],
+    ),
+    "https://purl.humanatlas.io/asct-b/kidney-extra": asctb_table(
+        "https://purl.humanatlas.io/asct-b/kidney-extra",
+        KIDNEY_STRUCTURES,
+        [{"id": "CL:2", "ccf_located_in": ["UBERON:0009999"]}],
+        [("CL:5", "ct five"), ("CL:1", "ct one")],
+    ),
+    "https://purl.humanatlas.io/asct-b/blood-vasculature": asctb_table(
+        "https://purl.humanatlas.io/asct-b/blood-vasculature",
+        [{"id": "UBERON:0002113", "ccf_pref_label": "kidney"}],
+        [{"id": "CL:1", "ccf_located_in": ["UBERON:0009999"]}],
+        [("CL:6", "ct six")],
+    ),
+}
+
+
+class Response:
+    def __init__(self, content: dict):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.content
+
+
+def test_tables_of_the_organ_are_merged(stage10, monkeypatch):
+    requested = []
+
+    def cached_get(url, **kwargs):
+        requested.append(url)
+        return Response(DIGITAL_OBJECTS[url])
+
+    monkeypatch.setattr(shared, "cached_get", cached_get)
+    organs = [
+        {
+            "organ_label": "kidney",
+            "organ_id": KIDNEY,
+            "ftu": [{"ftu_digital_object": NEPHRON_FTU}],
+        }
+    ]
+
+    query = stage10.build_ftu_query_from_kg(organs, workers=1).set_index("ct_iri")
+
+    assert "https://purl.humanatlas.io/asct-b/blood-vasculature" not in requested
+    assert "https://purl.humanatlas.io/asct-b/anatomical-systems" not in requested
+    assert set(query["ftu_label"]) == {"nephron"}
+    assert query.index.tolist() == ["CL:1", "CL:2", "CL:3", "CL:4", "CL:5"]
+    assert query["in_asctb"].tolist() == [True, False, False, True, True]
+    # CL:2 is located in another AS in the second table only
+    assert query["exclusive_ct_in_ftu"].tolist() == [True, False, True, False, False]
@@ -0,0 +1,99 @@
+"""
+Tests of the intermediary shards: stage 41 leaves no part files behind when it builds
+from them, and they are read back like the JSONL intermediary.
+"""
+
+import json
+
+import pytest
+
+from conftest import filter_universe, run_python
+from shared import (
+    ShardedJsonlWriter,
+    iterate_intermediary_shards,
+    iterate_through_json_lines,
+)
+from synthetic_universe import generate_universe
+
+# Runs stage 41, optionally failing on the second record of a shard
+BUILD_SOURCE = """
+import importlib.util
+import sys
+
+spec = importlib.util.spec_from_file_location(
+    "stage41", "41-build-ftu-cell-summaries-jsonld.py"
+)
+stage41 = importlib.util.module_from_spec(spec)
+sys.modules["stage41"] = stage41
+spec.loader.exec_module(stage41)
+
+from shared import *
+
+build_cell_summaries = stage41.build_cell_summaries
+
+
+def fail_on_second_record(obj, obj_number, *args, **kwargs):
+    if obj_number == 2:
+        raise RuntimeError("failed on purpose")
+    return build_cell_summaries(obj, obj_number, *args, **kwargs)
+
+
+if {fail}:
+    stage41.build_cell_summaries = fail_on_second_record
+
+index = FtuIndex.from_files(
+    filtered_dataset_metadata_path=FILTERED_DATASET_METADATA_FILENAME
+)
+try:
+    stage41.build_ftu_cell_summaries_jsonld(index)
+except RuntimeError as e:
+    print(e)
+"""
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("fail", [False, True], ids=["built", "failed"])
+def test_part_files_are_removed(pipeline_copy, tmp_path, workers, fail):
+    preprocessor_dir = pipeline_copy(
+        INTERMEDIARY_FORMAT="shards",
+        INTERMEDIARY_SHARDS=3,
+        INTERMEDIARY_SHARD_WORKERS=workers,
+    )
+    generate_universe(preprocessor_dir, datasets=20, rows=4, genes=5, seed=2)
+    filter_universe(preprocessor_dir)
+
+    log = run_python(preprocessor_dir, BUILD_SOURCE.format(fail=fail))
+
+    assert ("failed on purpose" in log) == fail
+    assert not [path for path in tmp_path.rglob("*") if ".part" in path.name]
+    assert not list((preprocessor_dir / "raw-data").glob("ftu-cell-summaries-parts-*"))
+
+
+# Values a JSON parser may read back differently: float precision, integers beyond 64
+# bits, non-finite numbers, escapes and duplicate keys
+EDGE_CASE_LINES = [
+    '{"cell_source": "d1", "value": 0.30000000000000004, "tiny": 1e-321}',
+    '{"cell_source": "d1", "value": 1.7976931348623157e308, "big": 18446744073709551616}',
+    '{"cell_source": "d1", "value": NaN, "inf": Infinity, "zero": -0.0}',
+    '{"cell_source": "d1", "label": "\\u00e9\\ud83d\\ude00 \\u0000", "raw": "\u00e9"}',
+    '{"cell_source": "d1", "a": 1, "a": 2, "genes": [{"value": 1.0}, {"value": 1}]}',
+]
+
+
+def test_shards_are_read_like_jsonl(tmp_path):
+    jsonl_path = tmp_path / "records.jsonl"
+    jsonl_path.write_text("\n".join(EDGE_CASE_LINES) + "\n", encoding="utf-8")
+    with ShardedJsonlWriter(
+        tmp_path / "shards", shards=1, compression="gzip"
+    ) as writer:
+        for line in EDGE_CASE_LINES:
+            writer.write(line, "d1")
+
+    from_jsonl = list(iterate_through_json_lines(jsonl_path))
+    from_shards = list(iterate_intermediary_shards(writer.manifest_path))
+
+    # NaN is not equal to itself, so the records are compared serialized
+    assert [json.dumps(r) for r in from_shards] == [json.dumps(r) for r in from_jsonl]
+    assert [[type(v) for v in r.values()] for r in from_shards] == [
+        [type(v) for v in r.values()] for r in from_jsonl
+    ]
@@ -0,0 +1,158 @@
+"""
+Tests of the resumable, checksummed downloads of shared.py against a local stand-in server.
+"""
+
+import hashlib
+import json
+
+import pytest
+
+from shared import check_download
+
+DATA = bytes(range(256)) * 1000
+MD5 = f"md5:{hashlib.md5(DATA).hexdigest()}"
+
+
+@pytest.fixture
+def server(stand_in_server):
+    stand_in_server.files["/data.bin"] = DATA
+    return stand_in_server
+
+
+def range_requests(server) -> list:
+    return [headers.get("Range") for _, _, headers in server.requests_of("GET")]
+
+
+def test_download(http, server, tmp_path):
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", checksum=MD5
+    )
+
+    assert path.read_bytes() == DATA
+    assert not (tmp_path / "data.bin.part").exists()
+    assert range_requests(server) == [None]
+
+
+def test_partial_file_is_resumed(http, server, tmp_path):
+    (tmp_path / "data.bin.part").write_bytes(DATA[:1000])
+
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", checksum=MD5
+    )
+
+    assert path.read_bytes() == DATA
+    assert not (tmp_path / "data.bin.part").exists()
+    assert range_requests(server) == ["bytes=1000-"]
+
+
+def test_download_restarts_if_the_server_ignores_ranges(http, server, tmp_path):
+    server.ranges = False
+    (tmp_path / "data.bin.part").write_bytes(DATA[:1000])
+
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", checksum=MD5
+    )
+
+    assert path.read_bytes() == DATA
+    assert range_requests(server) == ["bytes=1000-"]
+
+
+def test_stream_to_file_rejects_an_ignored_segment_range(http, server, tmp_path):
+    server.ranges = False
+
+    with pytest.raises(RuntimeError, match="ignored the byte range"):
+        http.stream_to_file(server.url("/data.bin"), tmp_path / "data.bin", 0, 99)
+
+
+def test_segmented_download(http, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(http, "DOWNLOAD_SEGMENT_MIN_SIZE", 1)
+
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", checksum=MD5, segments=3
+    )
+
+    assert path.read_bytes() == DATA
+    assert sorted(range_requests(server)) == sorted(
+        [
+            f"bytes=0-{len(DATA) // 3 - 1}",
+            f"bytes={len(DATA) // 3}-{2 * len(DATA) // 3 - 1}",
+            f"bytes={2 * len(DATA) // 3}-{len(DATA) - 1}",
+        ]
+    )
+    assert not (tmp_path / "data.bin.part").exists()
+    assert not (tmp_path / "data.bin.part.json").exists()
+
+
+def test_segmented_download_is_resumed(http, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(http, "DOWNLOAD_SEGMENT_MIN_SIZE", 1)
+    half = len(DATA) // 2
+    part = bytearray(len(DATA))
+    part[:1000] = DATA[:1000]
+    part[half : half + 500] = DATA[half : half + 500]
+    (tmp_path / "data.bin.part").write_bytes(part)
+    (tmp_path / "data.bin.part.json").write_text(
+        json.dumps(
+            {
+                "url": server.url("/data.bin"),
+                "size": len(DATA),
+                "segments": [
+                    {"start": 0, "end": half - 1, "done": 1000},
+                    {"start": half, "end": len(DATA) - 1, "done": 500},
+                ],
+            }
+        )
+    )
+
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", checksum=MD5, segments=2
+    )
+
+    assert path.read_bytes() == DATA
+    assert sorted(range_requests(server)) == [
+        f"bytes=1000-{half - 1}",
+        f"bytes={half + 500}-{len(DATA) - 1}",
+    ]
+
+
+def test_checksum_mismatch_leaves_no_file(http, server, tmp_path):
+    with pytest.raises(ValueError, match="checksum"):
+        http.download_from_url(
+            server.url("/data.bin"), tmp_path, "data.bin", checksum="md5:" + "0" * 32
+        )
+
+    assert not (tmp_path / "data.bin").exists()
+    assert not (tmp_path / "data.bin.part").exists()
+
+
+def test_complete_file_is_skipped(http, server, tmp_path):
+    (tmp_path / "data.bin").write_bytes(DATA)
+
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", expected_size=len(DATA)
+    )
+
+    assert path.read_bytes() == DATA
+    assert server.requests == []
+
+
+def test_file_of_the_wrong_size_is_downloaded_again(http, server, tmp_path):
+    (tmp_path / "data.bin").write_bytes(DATA[:1000])
+
+    path = http.download_from_url(
+        server.url("/data.bin"), tmp_path, "data.bin", expected_size=len(DATA)
+    )
+
+    assert path.read_bytes() == DATA
+    assert range_requests(server) == [None]
+
+
+def test_check_download(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(DATA)
+
+    check_download(path, len(DATA), MD5)
+    check_download(path, checksum=MD5.removeprefix("md5:").upper())
+    with pytest.raises(ValueError, match="bytes"):
+        check_download(path, len(DATA) + 1)
+    with pytest.raises(ValueError, match="sha256"):
+        check_download(path, checksum="sha256:" + hashlib.md5(DATA).hexdigest())
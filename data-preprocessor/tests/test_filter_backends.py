@@ -0,0 +1,101 @@
+"""
+Tests that the Python backend of stage 20, serial or with a process pool, and its
+DuckDB backend write the same files.
+"""
+
+import csv
+import gzip
+import json
+import shutil
+
+import pytest
+
+from conftest import filter_universe
+from synthetic_universe import (
+    NON_FTU_ORGAN,
+    UNIVERSE_10K_FILENAME,
+    UNIVERSE_METADATA_FILENAME,
+    generate_universe,
+)
+
+pytest.importorskip("duckdb")
+
+# The files stage 20 writes with INTERMEDIARY_FORMAT jsonl
+OUTPUTS = (
+    "raw-data/cell_type_populations_intermediary.jsonl",
+    "output/filtered-dataset-metadata.json",
+)
+
+
+def add_edge_cases(universe_path, ftu_datasets: set):
+    """
+    Give some CTs int-valued numbers and a null, and add a corrupt line of a dataset
+    that is of interest.
+    """
+    with gzip.open(universe_path, "rt", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+
+    for record in records[::3]:
+        for row in record["summary"][::2]:
+            row["percentage"] = 1
+            row["count"] = None
+            row["gene_expr"][0]["mean_gene_expr_value"] = 0
+
+    lines = [json.dumps(record) for record in records]
+    of_interest = next(
+        i for i, record in enumerate(records) if record["cell_source"] in ftu_datasets
+    )
+    lines.insert(of_interest + 1, lines[of_interest][: len(lines[of_interest]) // 2])
+
+    with gzip.open(universe_path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def universe_with_edge_cases(pipeline_copy):
+    """Make a pipeline copy with a small universe and its edge cases, see `add_edge_cases()`."""
+    preprocessor_dir = pipeline_copy(INTERMEDIARY_FORMAT="jsonl")
+    generate_universe(preprocessor_dir, datasets=30, rows=6, genes=5, seed=1)
+    with open(preprocessor_dir / "input" / UNIVERSE_METADATA_FILENAME) as f:
+        ftu_datasets = {
+            row["dataset_id"]
+            for row in csv.DictReader(f)
+            if row["organ"] != NON_FTU_ORGAN
+        }
+    add_edge_cases(preprocessor_dir / "raw-data" / UNIVERSE_10K_FILENAME, ftu_datasets)
+    return preprocessor_dir
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_duckdb_backend_matches_python_backend(pipeline_copy, workers):
+    preprocessor_dir = universe_with_edge_cases(pipeline_copy)
+
+    outputs = {}
+    for backend in ("python", "duckdb"):
+        log = filter_universe(preprocessor_dir, backend, workers)
+        if backend == "python":
+            assert "Skipping invalid JSON line" in log
+        outputs[backend] = {
+            name: (preprocessor_dir / name).read_bytes() for name in OUTPUTS
+        }
+        shutil.rmtree(preprocessor_dir / "raw-data" / "duckdb-tmp", ignore_errors=True)
+
+    assert outputs["python"] and outputs["python"] == outputs["duckdb"]
+    intermediary = outputs["duckdb"][OUTPUTS[0]]
+    assert b'"percentage": 1,' in intermediary
+    assert b'"mean_gene_expr_value": 0}' in intermediary
+    assert b'"count": null' in intermediary
+
+
+def test_parallel_filter_matches_serial_filter(pipeline_copy):
+    preprocessor_dir = universe_with_edge_cases(pipeline_copy)
+
+    outputs = {}
+    for workers in (1, 2):
+        log = filter_universe(preprocessor_dir, "python", workers)
+        assert "Skipping invalid JSON line" in log
+        outputs[workers] = {
+            name: (preprocessor_dir / name).read_bytes() for name in OUTPUTS
+        }
+
+    assert outputs[1][OUTPUTS[0]]
+    assert outputs[1] == outputs[2]
@@ -0,0 +1,72 @@
+"""
+Tests of the reading of the flag columns of the FTU query tables.
+"""
+
+import json
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from shared import as_bool, as_bool_series
+
+FLAG_COLUMNS = {
+    "bool": [True, False, True],
+    "blank bool": [True, None, False],
+    "string": ["TRUE", "false", " Yes "],
+    "blank string": ["TRUE", None, "0"],
+    "mixed": [True, "false", "t", None, 1, 0.0, "no"],
+    "float": [1.0, np.nan, 0.0],
+    "empty": [],
+    "all blank": [None, None],
+}
+
+
+@pytest.mark.filterwarnings("error::FutureWarning")
+@pytest.mark.parametrize("values", FLAG_COLUMNS.values(), ids=FLAG_COLUMNS.keys())
+def test_as_bool_series_matches_as_bool(values):
+    column = pd.Series(values, dtype=object, index=range(10, 10 + len(values)))
+
+    flags = as_bool_series(column)
+
+    assert flags.dtype == bool
+    assert flags.index.equals(column.index)
+    assert flags.tolist() == [as_bool(v) for v in values]
+
+
+@pytest.mark.parametrize(
+    "csv", ['flag\nTRUE\n""\nFALSE\n', 'flag\ntrue\n""\nno\n', 'flag\n1\n""\n0\n']
+)
+def test_as_bool_series_reads_blank_csv_cells(csv):
+    column = pd.read_csv(StringIO(csv), skip_blank_lines=False)["flag"]
+
+    assert as_bool_series(column).tolist() == [True, False, False]
+
+
+def test_compile_cell_types_per_ftu_groups_rows_without_label(stage10):
+    query = pd.DataFrame(
+        {
+            "ftu_purl": ["p1", "p2", "p2", "p1"],
+            "ftu_label": ["alveolus", np.nan, np.nan, "alveolus"],
+            "ct_label": ["a", "b", "c", "d"],
+            "ct_iri": [f"http://purl.obolibrary.org/obo/CL_{i}" for i in range(4)],
+            "organ_iri": ["http://purl.obolibrary.org/obo/UBERON_0002048"] * 4,
+            "organ_label": ["lung"] * 4,
+            "in_2d_ftu": [True, None, "TRUE", False],
+        }
+    )
+
+    result = stage10.compile_cell_types_per_ftu(query)
+
+    labelled, unlabelled = result
+    assert labelled == "alveolus" and pd.isna(unlabelled)
+    unlabelled = result[unlabelled]
+    assert unlabelled["ftu_purl"] == "p2"
+    assert [ct["ct_label"] for ct in unlabelled["cts_in_2d_ftu"]] == ["c"]
+    assert [ct["ct_label"] for ct in unlabelled["cts_in_asctb"]] == ["b", "c"]
+    assert result["alveolus"]["cts_in_2d_ftu"] == [{"ct_label": "a", "ct_iri": "CL:0"}]
+    assert list(json.loads(stage10.CELL_TYPES_IN_FTUS.read_text())) == [
+        "alveolus",
+        "NaN",
+    ]
@@ -0,0 +1,104 @@
+"""
+Tests of the gene rankings of stage 41, on a dataset whose rankings are worked out by hand.
+"""
+
+import pytest
+
+from conftest import load_stage
+
+stage41 = load_stage("41-build-ftu-cell-summaries-jsonld.py")
+
+
+def genes(**values) -> list:
+    return [
+        {"ensembl_id": gene, "gene_label": gene.upper(), "mean_gene_expr_value": value}
+        for gene, value in values.items()
+    ]
+
+
+# Totals: g1 = 5 + 4 = 9, g2 = 3 + 0 + 3 = 6, g3 = 5 + 1 = 6, g5 = 1 + 2 = 3; g4 has
+# no value. With 3 rows, the specificity of a gene is its value minus the mean of
+# the 2 other rows: value - (total - value) / 2.
+SUMMARIES = [
+    {"cell_label": "a", "gene_expr": genes(g1=5, g2=3, g3=5, g4=None, g5=1)},
+    {"cell_label": "b", "gene_expr": genes(g1=4, g2=0, g5=2)},
+    {"cell_label": "c", "gene_expr": genes(g3=1, g2=3)},
+]
+
+EXPECTED = {
+    # Ties keep their input order, missing values go last
+    ("mean_expression", 0): ["g1", "g3", "g2", "g5", "g4"],
+    ("mean_expression", 1): ["g1", "g5", "g2"],
+    ("mean_expression", 2): ["g2", "g3"],
+    # a: g1 5 - 4/2 = 3, g2 3 - 3/2 = 1.5, g3 5 - 1/2 = 4.5, g4 last, g5 1 - 2/2 = 0
+    ("specificity", 0): ["g3", "g1", "g2", "g5", "g4"],
+    # b: g1 4 - 5/2 = 1.5, g2 0 - 6/2 = -3, g5 2 - 1/2 = 1.5 (tie, input order)
+    ("specificity", 1): ["g1", "g5", "g2"],
+    # c: g3 1 - 5/2 = -1.5, g2 3 - 3/2 = 1.5
+    ("specificity", 2): ["g2", "g3"],
+    ("input_order", 0): ["g1", "g2", "g3", "g4", "g5"],
+    ("input_order", 1): ["g1", "g2", "g5"],
+    ("input_order", 2): ["g3", "g2"],
+}
+
+
+def test_sum_gene_expression():
+    rows = SUMMARIES + [{"cell_label": "d", "gene_expr": ["not a gene"]}, {}]
+
+    assert stage41.sum_gene_expression(rows) == {"g1": 9, "g2": 6, "g3": 6, "g5": 3}
+
+
+@pytest.mark.parametrize("top_n", [2, 5, 100])
+@pytest.mark.parametrize("ranking, row", EXPECTED.keys())
+def test_select_top_genes(ranking, row, top_n):
+    gene_expr = SUMMARIES[row]["gene_expr"]
+
+    selected = stage41.select_top_genes(
+        gene_expr,
+        top_n,
+        ranking,
+        stage41.sum_gene_expression(SUMMARIES),
+        len(SUMMARIES),
+    )
+
+    assert [g["ensembl_id"] for g in selected] == EXPECTED[ranking, row][:top_n]
+    # The genes are selected, not copied
+    assert all(any(g is input for input in gene_expr) for g in selected)
+
+
+def test_specificity_of_a_single_row_is_its_mean_expression():
+    gene_expr = SUMMARIES[0]["gene_expr"]
+    totals = stage41.sum_gene_expression(SUMMARIES[:1])
+
+    assert stage41.select_top_genes(
+        gene_expr, 3, "specificity", totals, 1
+    ) == stage41.select_top_genes(gene_expr, 3, "mean_expression")
+
+
+def test_unknown_ranking_is_rejected():
+    with pytest.raises(ValueError, match="Unknown GENE_RANKING 'alphabetical'"):
+        stage41.select_top_genes(SUMMARIES[0]["gene_expr"], 3, "alphabetical")
+
+
+def test_transform_cell_summaries_ranks_within_the_dataset():
+    summaries = [
+        {**summary, "cell_id": f"http://purl.obolibrary.org/obo/CL_000000{i}"}
+        for i, summary in enumerate(SUMMARIES)
+    ]
+
+    rows = stage41.transform_cell_summaries(
+        summaries,
+        {"CL:0000000", "CL:0000002"},
+        2,
+        "specificity",
+        stage41.sum_gene_expression(summaries),
+    )
+
+    assert [row["cell_id"] for row in rows] == [
+        "http://purl.obolibrary.org/obo/CL_0000000",
+        "http://purl.obolibrary.org/obo/CL_0000002",
+    ]
+    assert [[g["ensemble_id"] for g in row["genes"]] for row in rows] == [
+        EXPECTED["specificity", 0][:2],
+        EXPECTED["specificity", 2][:2],
+    ]
@@ -0,0 +1,160 @@
+"""
+Tests of the on-disk HTTP cache of shared.py against a local stand-in server.
+"""
+
+import time
+
+import pytest
+import requests
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+@pytest.fixture
+def server(stand_in_server):
+    stand_in_server.files["/etag.json"] = b'{"version": 1}'
+    stand_in_server.headers["/etag.json"] = {
+        "Content-Type": "application/json",
+        "ETag": ETAG,
+    }
+    stand_in_server.files["/dated.csv"] = b"a,b\n1,2\n"
+    stand_in_server.headers["/dated.csv"] = {
+        "Content-Type": "text/csv",
+        "Last-Modified": LAST_MODIFIED,
+    }
+    return stand_in_server
+
+
+def gets(server) -> list:
+    return server.requests_of("GET")
+
+
+def test_fresh_response_is_served_from_the_cache(http, server):
+    first = http.cached_get(server.url("/etag.json"))
+    second = http.cached_get(server.url("/etag.json"))
+
+    assert first.json() == second.json() == {"version": 1}
+    assert second.headers["Content-Type"] == "application/json"
+    assert len(gets(server)) == 1
+
+
+@pytest.mark.parametrize(
+    "path, header, value",
+    [
+        ("/etag.json", "If-None-Match", ETAG),
+        ("/dated.csv", "If-Modified-Since", LAST_MODIFIED),
+    ],
+)
+def test_stale_response_is_revalidated(http, server, path, header, value):
+    first = http.cached_get(server.url(path), ttl=0)
+    entry = http.http_cache.load(http.http_cache.key(server.url(path)))
+
+    second = http.cached_get(server.url(path), ttl=0)
+
+    assert second.status_code == 200
+    assert second.content == first.content
+    _, _, headers = gets(server)[-1]
+    assert headers[header] == value
+    # The 304 refreshed the entry
+    revalidated = http.http_cache.load(http.http_cache.key(server.url(path)))
+    assert revalidated["fetched_at"] > entry["fetched_at"]
+
+
+def test_changed_response_replaces_the_cached_one(http, server):
+    http.cached_get(server.url("/etag.json"), ttl=0)
+    server.files["/etag.json"] = b'{"version": 2}'
+    server.headers["/etag.json"]["ETag"] = '"v2"'
+
+    assert http.cached_get(server.url("/etag.json"), ttl=0).json() == {"version": 2}
+    assert http.cached_get(server.url("/etag.json")).json() == {"version": 2}
+    assert len(gets(server)) == 2
+
+
+def test_requests_are_cached_by_params_and_accept_header(http, server):
+    http.cached_get(server.url("/etag.json"))
+    http.cached_get(server.url("/etag.json"), params={"q": "1"})
+    http.cached_get(server.url("/etag.json"), headers={"Accept": "text/csv"})
+    http.cached_get(server.url("/etag.json"), headers={"User-Agent": "tests"})
+
+    assert len(gets(server)) == 3
+
+
+def test_errors_are_not_cached(http, server):
+    assert http.cached_get(server.url("/missing")).status_code == 404
+    assert http.cached_get(server.url("/missing")).status_code == 404
+
+    assert len(gets(server)) == 2
+
+
+def test_offline_mode_uses_only_the_cache(http, server, monkeypatch):
+    http.cached_get(server.url("/etag.json"))
+    monkeypatch.setattr(http, "HTTP_OFFLINE", True)
+
+    assert http.cached_get(server.url("/etag.json"), ttl=0).json() == {"version": 1}
+    with pytest.raises(requests.exceptions.ConnectionError, match="HTTP_OFFLINE"):
+        http.cached_get(server.url("/dated.csv"))
+    assert len(gets(server)) == 1
+
+
+def test_stale_response_is_used_if_the_server_is_down(http, server):
+    http.cached_get(server.url("/etag.json"))
+    url = server.url("/etag.json")
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+    assert http.cached_get(url, ttl=0).json() == {"version": 1}
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http.cached_get(server.url("/dated.csv"))
+
+
+def test_unused_entries_expire(http, server, tmp_path, monkeypatch):
+    cache = http.HttpCache(tmp_path / "expiring", expire=60)
+    monkeypatch.setattr(http, "http_cache", cache)
+    http.cached_get(server.url("/etag.json"))
+    old_key = cache.key(server.url("/etag.json"))
+    entry = cache.load(old_key)
+    entry["used_at"] = time.time() - 61
+    cache.save(old_key, entry)
+
+    # Storing another response evicts the expired entry and its body
+    http.cached_get(server.url("/dated.csv"))
+
+    assert cache.load(old_key) is None
+    assert [p.name for p in cache.bodies_dir.iterdir()] == [
+        cache.load(cache.key(server.url("/dated.csv")))["body"]
+    ]
+
+
+def test_least_recently_used_entries_are_evicted_above_the_size_cap(
+    http, server, tmp_path, monkeypatch
+):
+    for i in range(3):
+        server.files[f"/{i}.bin"] = bytes([i]) * 100
+    cache = http.HttpCache(tmp_path / "capped", max_size=250)
+    monkeypatch.setattr(http, "http_cache", cache)
+
+    http.cached_get(server.url("/0.bin"))
+    http.cached_get(server.url("/1.bin"))
+    # Using the first entry makes the second the least recently used one
+    time.sleep(0.01)
+    http.cached_get(server.url("/0.bin"))
+    http.cached_get(server.url("/2.bin"))
+
+    cached = {
+        i
+        for i in range(3)
+        if cache.load(cache.key(server.url(f"/{i}.bin"))) is not None
+    }
+    assert cached == {0, 2}
+    assert sum(p.stat().st_size for p in cache.bodies_dir.iterdir()) == 200
+
+
+def test_identical_bodies_are_stored_once(http, server):
+    server.files["/copy.json"] = server.files["/etag.json"]
+
+    http.cached_get(server.url("/etag.json"))
+    http.cached_get(server.url("/copy.json"))
+
+    assert len(list(http.http_cache.bodies_dir.iterdir())) == 1
+    assert len(list(http.http_cache.entries_dir.iterdir())) == 2
@@ -0,0 +1,119 @@
+"""
+Tests of the pooled HTTP session of shared.py and its stats against a local stand-in server.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import requests
+
+from conftest import SCRIPTS_DIR
+
+BODY = b'{"ok": true}'
+
+
+@pytest.fixture
+def server(stand_in_server):
+    stand_in_server.files["/data.json"] = BODY
+    return stand_in_server
+
+
+def host(server) -> str:
+    return f"127.0.0.1:{server.httpd.server_port}"
+
+
+def test_unavailable_server_is_retried(http, server):
+    server.failures = [503, 503]
+
+    response = http.get_http_session().get(server.url("/data.json"))
+
+    assert response.status_code == 200
+    assert response.content == BODY
+    assert len(server.requests_of("GET")) == 3
+    stats = http.http_stats.as_dict()[host(server)]
+    assert stats["requests"] == 1
+    assert stats["retries"] == 2
+    assert stats["errors"] == 0
+    assert stats["bytes"] == len(BODY)
+    assert stats["max_seconds"] <= stats["seconds"]
+
+
+def test_retries_give_up_after_http_retries(http, server):
+    server.failures = [503] * (http.HTTP_RETRIES + 1)
+
+    response = http.get_http_session().get(server.url("/data.json"))
+
+    assert response.status_code == 503
+    assert len(server.requests_of("GET")) == http.HTTP_RETRIES + 1
+    stats = http.http_stats.as_dict()[host(server)]
+    assert stats["requests"] == 1
+    assert stats["retries"] == http.HTTP_RETRIES
+    assert stats["errors"] == 1
+
+
+def test_client_errors_are_not_retried(http, server):
+    response = http.get_http_session().get(server.url("/missing"))
+
+    assert response.status_code == 404
+    assert len(server.requests) == 1
+    assert http.http_stats.as_dict()[host(server)]["retries"] == 0
+
+
+def test_failed_connections_are_counted(http, server):
+    url = server.url("/data.json")
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http.get_http_session().get(url)
+
+    stats = http.http_stats.as_dict()[host(server)]
+    assert stats["requests"] == 1
+    assert stats["errors"] == 1
+
+
+def test_session_is_shared_within_a_process(http):
+    assert http.get_http_session() is http.get_http_session()
+
+
+def test_stats_are_written_at_exit(server, tmp_path):
+    stats_file = tmp_path / "http-stats" / "stage.json"
+    source = f"""
+import shared
+
+shared.HTTP_BACKOFF_FACTOR = 0
+shared.HTTP_BACKOFF_JITTER = 0
+shared.HTTP_OFFLINE = False
+response = shared.get_http_session().get("{server.url("/data.json")}")
+assert response.status_code == 200, response.status_code
+"""
+    server.failures = [503]
+    subprocess.run(
+        [sys.executable, "-c", source],
+        cwd=SCRIPTS_DIR,
+        env={**os.environ, "HTTP_STATS_FILE": str(stats_file)},
+        check=True,
+    )
+
+    with open(stats_file, "r", encoding="utf-8") as f:
+        stats = json.load(f)
+    assert stats.keys() == {host(server)}
+    assert stats[host(server)]["requests"] == 1
+    assert stats[host(server)]["retries"] == 1
+    assert stats[host(server)]["errors"] == 0
+    assert stats[host(server)]["bytes"] == len(BODY)
+
+
+def test_no_stats_are_written_without_requests(tmp_path):
+    stats_file = tmp_path / "stage.json"
+    subprocess.run(
+        [sys.executable, "-c", "import shared"],
+        cwd=SCRIPTS_DIR,
+        env={**os.environ, "HTTP_STATS_FILE": str(stats_file)},
+        check=True,
+    )
+
+    assert not stats_file.exists()
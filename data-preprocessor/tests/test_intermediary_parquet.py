@@ -0,0 +1,100 @@
+"""
+Tests that CellSummary records come back unchanged from the Parquet intermediary.
+"""
+
+import json
+
+from shared import (
+    CellTypePopulationsParquetWriter,
+    flatten_cell_type_population,
+    iterate_cell_type_populations_parquet,
+)
+
+
+def gene(number: int, value) -> dict:
+    return {
+        "@type": "GeneExpression",
+        "ensembl_id": f"ENSG{number:011d}",
+        "gene_id": f"HGNC:{number}",
+        "gene_label": f"GENE{number}",
+        "mean_gene_expr_value": value,
+    }
+
+
+RECORDS = [
+    {
+        "@type": "CellSummary",
+        "cell_source": "https://example.org/dataset-1",
+        "annotation_method": "celltypist",
+        "modality": "sc_transcriptomics",
+        "summary": [
+            {
+                "@type": "CellSummaryRow",
+                "cell_id": "CL:0000001",
+                "cell_label": "cell type 1",
+                "count": 10,
+                "percentage": 1,
+                "gene_expr": [gene(1, 0), gene(2, 0.5), gene(3, 2)],
+            },
+            {
+                "@type": "CellSummaryRow",
+                "cell_id": "CL:0000002",
+                "cell_label": "cell type 2",
+                "count": None,
+                "percentage": 0.25,
+                "gene_expr": [gene(4, 1.0)],
+            },
+        ],
+    },
+    {
+        "@type": "CellSummary",
+        "cell_source": "https://example.org/dataset-2",
+        "annotation_method": "azimuth",
+        "modality": "sc_transcriptomics",
+        "sex": "Female",
+        "summary": [
+            {
+                "@type": "CellSummaryRow",
+                "cell_id": "CL:0000003",
+                "cell_label": "cell type 3",
+                "count": 2.5,
+                "percentage": 0,
+                "note": "no genes",
+                "gene_expr": [],
+            }
+        ],
+    },
+]
+
+
+def write_parquet(path):
+    with CellTypePopulationsParquetWriter(path) as writer:
+        for record in RECORDS:
+            writer.write_rows(flatten_cell_type_population(record))
+
+
+def test_records_round_trip_exactly(tmp_path):
+    path = tmp_path / "intermediary.parquet"
+    write_parquet(path)
+
+    records = list(iterate_cell_type_populations_parquet(path))
+
+    assert [json.dumps(record) for record in records] == [
+        json.dumps(record) for record in RECORDS
+    ]
+
+
+def test_number_columns_stay_numeric(tmp_path):
+    path = tmp_path / "intermediary.parquet"
+    write_parquet(path)
+
+    records = list(
+        iterate_cell_type_populations_parquet(
+            path, columns=["cell_id", "percentage", "mean_gene_expr_value"]
+        )
+    )
+
+    first_row = records[0]["summary"][0]
+    assert first_row["percentage"] == 1.0
+    assert [g["mean_gene_expr_value"] for g in first_row["gene_expr"]] == [0, 0.5, 2]
+    assert records[1]["summary"][0]["percentage"] == 0.0
@@ -0,0 +1,39 @@
+"""
+Tests of the IRI and CURIE conversions, scalar and column-wise.
+"""
+
+import pandas as pd
+
+from shared import (
+    get_id_from_iri,
+    get_id_from_iri_series,
+    iri_to_curie,
+    iri_to_curie_series,
+    ontology_id_short_to_url,
+    ontology_id_short_to_url_series,
+)
+
+IRIS = [
+    "http://purl.obolibrary.org/obo/CL_0000084",
+    "CL:0000084",
+    "http://purl.obolibrary.org/obo/UBERON_0002113",
+    "https://purl.humanatlas.io/2d-ftu/kidney-nephron",
+]
+
+
+def test_ontology_id_short_to_url():
+    assert (
+        ontology_id_short_to_url("UBERON:0002113")
+        == "http://purl.obolibrary.org/obo/UBERON_0002113"
+    )
+
+
+def test_series_match_scalars():
+    iris = pd.Series(IRIS * 2, index=range(5, 5 + 2 * len(IRIS)))
+    curies = pd.Series(["CL:0000084", "UBERON:0002113"] * 2)
+
+    assert iri_to_curie_series(iris).tolist() == [iri_to_curie(i) for i in iris]
+    assert get_id_from_iri_series(iris).tolist() == [get_id_from_iri(i) for i in iris]
+    assert ontology_id_short_to_url_series(curies).tolist() == [
+        ontology_id_short_to_url(c) for c in curies
+    ]
@@ -0,0 +1,80 @@
+"""
+Tests that JsonLdGraphWriter streams the same bytes json.dumps writes for the whole document.
+"""
+
+import json
+
+import pytest
+
+from shared import JsonLdGraphWriter, context_template
+
+NODES = [
+    {
+        "@id": "https://example.org/ftu/1",
+        "@type": "CellSummary",
+        "summary": [
+            {"cell_id": "CL:0000084", "percentage": 0.25, "genes": []},
+            {"cell_label": "T cell, αβ", "count": None, "nested": {"a": [1, 2.5]}},
+        ],
+    },
+    {"@id": "https://example.org/ftu/2", "empty": {}, "text": 'line\nbreak "quoted"'},
+    {"@id": "https://example.org/ftu/3", "values": [True, False, 0, -1e-9]},
+]
+
+GRAPHS = {"empty": [], "single": NODES[:1], "multi": NODES}
+
+
+@pytest.mark.parametrize("indent", [None, 0, 2, 4])
+@pytest.mark.parametrize("nodes", GRAPHS.values(), ids=GRAPHS.keys())
+def test_output_matches_json_dumps(tmp_path, indent, nodes):
+    path = tmp_path / "graph.jsonld"
+
+    with JsonLdGraphWriter(path, indent=indent) as writer:
+        for node in nodes:
+            writer.write(node)
+
+    document = {**context_template, "@graph": nodes}
+    expected = json.dumps(document, ensure_ascii=False, indent=indent)
+    assert path.read_text(encoding="utf-8") == expected
+    assert json.loads(path.read_text(encoding="utf-8")) == document
+    assert not (tmp_path / "graph.jsonld.tmp").exists()
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_serialized_nodes_match_nodes(tmp_path, indent):
+    with JsonLdGraphWriter(tmp_path / "nodes.jsonld", indent=indent) as writer:
+        for node in NODES:
+            writer.write(node)
+    with JsonLdGraphWriter(tmp_path / "serialized.jsonld", indent=indent) as writer:
+        for node in NODES:
+            writer.write_serialized(writer.dumps(node))
+
+    assert (tmp_path / "serialized.jsonld").read_bytes() == (
+        tmp_path / "nodes.jsonld"
+    ).read_bytes()
+
+
+def test_custom_template_and_ascii(tmp_path):
+    template = {"@context": {"@vocab": "https://example.org/"}, "@graph": []}
+    path = tmp_path / "graph.jsonld"
+
+    with JsonLdGraphWriter(path, template, indent=2, ensure_ascii=True) as writer:
+        for node in NODES:
+            writer.write(node)
+
+    assert path.read_text(encoding="ascii") == json.dumps(
+        {**template, "@graph": NODES}, indent=2
+    )
+
+
+def test_failed_write_leaves_the_previous_file(tmp_path):
+    path = tmp_path / "graph.jsonld"
+    path.write_text("previous")
+
+    with pytest.raises(RuntimeError):
+        with JsonLdGraphWriter(path) as writer:
+            writer.write(NODES[0])
+            raise RuntimeError("failed")
+
+    assert path.read_text() == "previous"
+    assert not (tmp_path / "graph.jsonld.tmp").exists()
@@ -0,0 +1,183 @@
+"""
+Tests of the block-wise Matrix Market parser of shared.py, its .npy cache, and the
+aggregation of stage 30 built on them.
+"""
+
+import os
+import zipfile
+
+import numpy as np
+import pytest
+
+import shared
+from conftest import load_stage
+
+scipy_io = pytest.importorskip("scipy.io")
+
+pytestmark = pytest.mark.filterwarnings(
+    "ignore:The default value for `spmatrix`:DeprecationWarning"
+)
+
+SHAPE = (13, 29)
+
+
+def random_matrix(seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    dense = np.round(rng.gamma(2.0, 1.5, SHAPE), 3)
+    dense[rng.random(SHAPE) < 0.6] = 0
+    return dense
+
+
+def write_mtx(path, dense: np.ndarray, field: str = "real", trailing_newline=True):
+    """Write a matrix as MTX text with comments and blank lines in its header."""
+    rows, cols = np.nonzero(dense)
+    lines = [
+        f"%%MatrixMarket matrix coordinate {field} general",
+        "% written by the tests",
+        "",
+        "%",
+        f"{dense.shape[0]} {dense.shape[1]} {len(rows)}",
+    ]
+    for row, col in zip(rows, cols):
+        value = "" if field == "pattern" else f" {dense[row, col]:g}"
+        lines.append(f"{row + 1} {col + 1}{value}")
+    path.write_text("\n".join(lines) + ("\n" if trailing_newline else ""))
+    return path
+
+
+def to_dense(shape, entries) -> tuple[np.ndarray, int]:
+    """Add up blocks of entries into a dense matrix, and count the blocks."""
+    dense = np.zeros(shape)
+    blocks = 0
+    for rows, cols, values in entries:
+        assert rows.dtype == np.int32 and cols.dtype == np.int32
+        assert values.dtype == np.float32
+        np.add.at(dense, (rows, cols), values)
+        blocks += 1
+    return dense, blocks
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64, 1_000_000])
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_parse_mtx_entries_matches_scipy(tmp_path, block_size, trailing_newline):
+    path = write_mtx(
+        tmp_path / "m.mtx", random_matrix(), trailing_newline=trailing_newline
+    )
+    expected = scipy_io.mmread(path).toarray()
+
+    with open(path, "rb") as f:
+        shape, entries, field = shared.read_mtx_header(f)
+        dense, blocks = to_dense(shape, shared.parse_mtx_entries(f, field, block_size))
+
+    assert shape == SHAPE
+    assert entries == np.count_nonzero(expected)
+    np.testing.assert_allclose(dense, expected, rtol=1e-6)
+    if block_size < 1000:
+        assert blocks > 1
+
+
+@pytest.mark.parametrize("field", ["integer", "pattern"])
+def test_parse_mtx_entries_of_other_fields(tmp_path, field):
+    path = write_mtx(tmp_path / "m.mtx", np.ceil(random_matrix()), field)
+    expected = scipy_io.mmread(path).toarray()
+
+    with open(path, "rb") as f:
+        shape, _, header_field = shared.read_mtx_header(f)
+        dense, _ = to_dense(shape, shared.parse_mtx_entries(f, header_field, 50))
+
+    assert header_field == field
+    np.testing.assert_array_equal(dense, expected)
+
+
+def test_read_mtx_header_rejects_other_formats(tmp_path):
+    path = tmp_path / "m.mtx"
+    path.write_text("%%MatrixMarket matrix array real general\n2 2\n1\n2\n3\n4\n")
+
+    with open(path, "rb") as f, pytest.raises(ValueError, match="coordinate"):
+        shared.read_mtx_header(f)
+
+
+def test_iterate_mtx_entries_uses_its_cache(tmp_path, monkeypatch):
+    path = write_mtx(tmp_path / "m.mtx", random_matrix())
+    expected = scipy_io.mmread(path).toarray()
+
+    shape, entries = shared.iterate_mtx_entries(path, block_size=40)
+    dense, _ = to_dense(shape, entries)
+    np.testing.assert_allclose(dense, expected, rtol=1e-6)
+    assert (tmp_path / "m.mtx.npy-cache" / "manifest.json").exists()
+
+    # Cache hit: the text is not parsed again
+    def parse(*args):
+        raise AssertionError("parsed a cached matrix")
+
+    monkeypatch.setattr(shared, "parse_and_cache_mtx_entries", parse)
+    shape, entries = shared.iterate_mtx_entries(path, block_size=40)
+    cached, blocks = to_dense(shape, entries)
+    assert shape == SHAPE
+    np.testing.assert_array_equal(cached, dense)
+    assert blocks > 1
+
+
+def test_iterate_mtx_entries_ignores_a_stale_cache(tmp_path):
+    path = write_mtx(tmp_path / "m.mtx", random_matrix(0))
+    shape, entries = shared.iterate_mtx_entries(path)
+    to_dense(shape, entries)
+
+    write_mtx(path, random_matrix(1))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    shape, entries = shared.iterate_mtx_entries(path)
+    dense, _ = to_dense(shape, entries)
+    np.testing.assert_allclose(dense, scipy_io.mmread(path).toarray(), rtol=1e-6)
+
+    # The rebuilt cache holds the new matrix
+    shape, entries = shared.iterate_mtx_entries(path)
+    np.testing.assert_array_equal(to_dense(shape, entries)[0], dense)
+
+
+def test_interrupted_cache_is_rebuilt(tmp_path):
+    path = write_mtx(tmp_path / "m.mtx", random_matrix())
+    shape, entries = shared.iterate_mtx_entries(path, block_size=40)
+    next(entries)
+    entries.close()
+    assert not (tmp_path / "m.mtx.npy-cache" / "manifest.json").exists()
+
+    shape, entries = shared.iterate_mtx_entries(path, block_size=40)
+    dense, _ = to_dense(shape, entries)
+    np.testing.assert_allclose(dense, scipy_io.mmread(path).toarray(), rtol=1e-6)
+    assert (tmp_path / "m.mtx.npy-cache" / "manifest.json").exists()
+
+
+def test_iterate_mtx_entries_from_zip(tmp_path):
+    path = write_mtx(tmp_path / "m.mtx", random_matrix())
+    with zipfile.ZipFile(tmp_path / "m.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(path, "experiment/m.mtx")
+
+    shape, entries = shared.iterate_mtx_entries(
+        tmp_path / "m.zip", block_size=40, member="experiment/m.mtx"
+    )
+    dense, _ = to_dense(shape, entries)
+
+    np.testing.assert_allclose(dense, scipy_io.mmread(path).toarray(), rtol=1e-6)
+
+
+def test_aggregate_cell_types_matches_numpy(tmp_path):
+    stage30 = load_stage("30-preprocess-anatomogram-cell-type-populations.py")
+    dense = random_matrix()
+    path = write_mtx(tmp_path / "m.mtx", dense)
+    group_codes = np.random.default_rng(2).integers(-1, 4, SHAPE[1])
+
+    cell_counts, sums, sums_of_squares = stage30.aggregate_cell_types(
+        path, group_codes, 4, SHAPE[0]
+    )
+
+    values = dense.astype(np.float32).astype(np.float64)
+    for g in range(4):
+        members = values[:, group_codes == g]
+        assert cell_counts[g] == members.shape[1]
+        np.testing.assert_allclose(sums[g], members.sum(axis=1))
+        np.testing.assert_allclose(sums_of_squares[g], (members**2).sum(axis=1))
+
+    with pytest.raises(ValueError, match="expected 12 genes"):
+        stage30.aggregate_cell_types(path, group_codes, 4, SHAPE[0] - 1)
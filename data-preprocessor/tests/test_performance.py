@@ -0,0 +1,39 @@
+"""
+Tests of the performance sections of shared.py.
+"""
+
+import json
+import subprocess
+import sys
+
+from conftest import SCRIPTS_DIR
+
+
+def test_importing_shared_starts_no_section(tmp_path):
+    perf_file = tmp_path / "perf.json"
+    source = f"""
+import shared
+
+assert not shared.perf_sections, shared.perf_sections
+
+@shared.track_performance("main")
+def main():
+    with shared.track_performance("loop") as perf:
+        for _ in range(3):
+            perf.records += 1
+
+main()
+main()
+"""
+    subprocess.run(
+        [sys.executable, "-c", source],
+        cwd=SCRIPTS_DIR,
+        env={"PERF_FILE": str(perf_file), "HTTP_OFFLINE": "1"},
+        check=True,
+    )
+
+    with open(perf_file, "r", encoding="utf-8") as f:
+        sections = {s["name"]: s for s in json.load(f)["sections"]}
+    assert sections.keys() == {"main", "loop"}
+    assert sections["main"]["calls"] == sections["loop"]["calls"] == 2
+    assert sections["loop"]["records"] == 6
@@ -0,0 +1,105 @@
+"""
+Tests of how set_up_and_run.py decides that a stage is up to date.
+"""
+
+import importlib.util
+import os
+
+import pytest
+
+from conftest import DATA_PREPROCESSOR_DIR
+
+spec = importlib.util.spec_from_file_location(
+    "set_up_and_run", DATA_PREPROCESSOR_DIR / "set_up_and_run.py"
+)
+runner = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(runner)
+
+SCRIPT = "41-build-ftu-cell-summaries-jsonld.py"
+
+
+@pytest.fixture
+def stage(tmp_path, monkeypatch):
+    """
+    A stage importing shared.py with one input, one output (newer than the input)
+    and one setting.
+    """
+    monkeypatch.setattr(runner, "SCRIPTS_DIR", tmp_path)
+    (tmp_path / SCRIPT).write_text("from shared import *\n\nprint('stage')\n")
+    (tmp_path / "shared.py").write_text("TOP_N_GENES = 100\n")
+    (tmp_path / "input.json").write_text("{}")
+    (tmp_path / "output.jsonld").write_text("{}")
+    for name in (SCRIPT, "shared.py", "input.json"):
+        os.utime(tmp_path / name, ns=(1, 1))
+    return {
+        "inputs": [tmp_path / "input.json"],
+        "outputs": [tmp_path / "output.jsonld"],
+        "config": {"TOP_N_GENES": 100},
+    }
+
+
+def record_run(stage: dict) -> dict:
+    state = {"stages": {}, "files": {}}
+    state["stages"][SCRIPT] = {
+        **{
+            str(p): runner.file_hash(p, state["files"])
+            for p in runner.stage_inputs(SCRIPT, stage)
+        },
+        **runner.config_hashes(stage),
+    }
+    return state
+
+
+def test_changed_setting_reruns_stage(stage):
+    state = record_run(stage)
+    stage["config"]["TOP_N_GENES"] = 10
+
+    assert runner.is_up_to_date(SCRIPT, stage, state) == (
+        False,
+        "config.yaml:TOP_N_GENES changed",
+    )
+
+
+def test_unchanged_setting_keeps_stage(stage):
+    state = record_run(stage)
+
+    assert runner.is_up_to_date(SCRIPT, stage, state)[0]
+
+
+def test_state_of_older_runs_is_tolerated(stage, tmp_path):
+    state = record_run(stage)
+    # Older runs hashed config.yaml, and no settings
+    last_run = state["stages"][SCRIPT]
+    last_run[str(tmp_path / "config.yaml")] = "0" * 64
+    del last_run["config.yaml:TOP_N_GENES"]
+    # The output is older than the input, but the input is unchanged
+    os.utime(tmp_path / "input.json", ns=(2 * 10**18, 2 * 10**18))
+
+    assert runner.is_up_to_date(SCRIPT, stage, state) == (True, "inputs unchanged")
+
+
+def test_changed_shared_py_reruns_stage(stage, tmp_path):
+    state = record_run(stage)
+    (tmp_path / "shared.py").write_text("TOP_N_GENES = 10\n")
+
+    assert runner.is_up_to_date(SCRIPT, stage, state) == (False, "shared.py changed")
+
+
+def test_touched_shared_py_keeps_stage(stage, tmp_path):
+    state = record_run(stage)
+    os.utime(tmp_path / "shared.py", ns=(2 * 10**18, 2 * 10**18))
+
+    assert runner.is_up_to_date(SCRIPT, stage, state) == (True, "inputs unchanged")
+
+
+def test_stage_not_importing_shared_py_ignores_it(stage, tmp_path):
+    (tmp_path / SCRIPT).write_text("print('stage')\n")
+    os.utime(tmp_path / SCRIPT, ns=(1, 1))
+    state = record_run(stage)
+    (tmp_path / "shared.py").write_text("TOP_N_GENES = 10\n")
+
+    assert runner.stage_inputs(SCRIPT, stage) == [
+        tmp_path / SCRIPT,
+        tmp_path / "input.json",
+    ]
+    assert runner.is_up_to_date(SCRIPT, stage, state)[0]
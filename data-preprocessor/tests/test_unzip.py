@@ -0,0 +1,147 @@
+"""
+Tests of the selective, resumable extraction of zip files by shared.py.
+"""
+
+import json
+import os
+import zipfile
+
+import pytest
+
+from shared import unzip_to_folder
+
+SUFFIXES = (".mtx", ".mtx_rows", ".mtx_cols")
+
+MEMBERS = {
+    "E-TEST-1/E-TEST-1.mtx": b"%%MatrixMarket matrix coordinate real general\n" * 50,
+    "E-TEST-1/E-TEST-1.mtx_rows": b"ENSG00000000001\tA\n" * 20,
+    "E-TEST-1/E-TEST-1.mtx_cols": b"cell\n" * 30,
+    "E-TEST-1/README.txt": b"not extracted\n",
+}
+
+
+def write_zip(path, members: dict = MEMBERS, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(path, "w", compression) as archive:
+        archive.writestr("E-TEST-1/", b"")
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return path
+
+
+def extracted_files(target) -> dict:
+    return {
+        path.name: path.stat().st_mtime_ns
+        for path in target.iterdir()
+        if not path.name.endswith(".manifest.json")
+    }
+
+
+def read_manifest(target) -> dict:
+    with open(target / "test.zip.manifest.json", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def unzipped(tmp_path):
+    """A zip file, and the folder its matrix files were extracted to."""
+    zip_path = write_zip(tmp_path / "test.zip")
+    target = tmp_path / "out"
+    unzip_to_folder(zip_path, target, SUFFIXES)
+    return zip_path, target
+
+
+def test_only_matching_members_are_extracted_flat(unzipped):
+    _, target = unzipped
+
+    assert extracted_files(target).keys() == {
+        "E-TEST-1.mtx",
+        "E-TEST-1.mtx_rows",
+        "E-TEST-1.mtx_cols",
+    }
+    for name, data in MEMBERS.items():
+        if name.endswith(SUFFIXES):
+            assert (target / os.path.basename(name)).read_bytes() == data
+
+    manifest = read_manifest(target)
+    assert manifest.keys() == extracted_files(target).keys()
+    for name, entry in manifest.items():
+        assert entry["size"] == (target / name).stat().st_size
+        assert entry["mtime_ns"] == (target / name).stat().st_mtime_ns
+
+
+def test_all_members_are_extracted_without_suffixes(tmp_path):
+    zip_path = write_zip(tmp_path / "test.zip")
+
+    unzip_to_folder(zip_path, tmp_path / "out")
+
+    assert len(extracted_files(tmp_path / "out")) == len(MEMBERS)
+
+
+def test_extracted_members_are_skipped(unzipped, capsys):
+    zip_path, target = unzipped
+    before = extracted_files(target)
+    capsys.readouterr()
+
+    unzip_to_folder(zip_path, target, SUFFIXES)
+
+    assert extracted_files(target) == before
+    assert "Skipped: 3 files" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("damage", ["deleted", "truncated", "overwritten"])
+def test_only_a_damaged_member_is_extracted_again(unzipped, capsys, damage):
+    zip_path, target = unzipped
+    damaged = target / "E-TEST-1.mtx_rows"
+    before = extracted_files(target)
+    manifest = read_manifest(target)
+    if damage == "deleted":
+        damaged.unlink()
+    elif damage == "truncated":
+        damaged.write_bytes(damaged.read_bytes()[:10])
+    else:
+        # Same size, so only the modification time tells
+        damaged.write_bytes(b"x" * damaged.stat().st_size)
+    capsys.readouterr()
+
+    unzip_to_folder(zip_path, target, SUFFIXES)
+
+    assert damaged.read_bytes() == MEMBERS["E-TEST-1/E-TEST-1.mtx_rows"]
+    after = extracted_files(target)
+    assert [name for name in after if after[name] != before[name]] == [damaged.name]
+    out = capsys.readouterr().out
+    assert "Unzipped 1 files" in out and "Skipped: 2 files" in out
+
+    updated = read_manifest(target)
+    assert updated[damaged.name]["mtime_ns"] == damaged.stat().st_mtime_ns
+    assert {n: e for n, e in updated.items() if n != damaged.name} == {
+        n: e for n, e in manifest.items() if n != damaged.name
+    }
+
+
+def test_member_changed_in_the_zip_is_extracted_again(unzipped):
+    zip_path, target = unzipped
+    before = extracted_files(target)
+    write_zip(zip_path, {**MEMBERS, "E-TEST-1/E-TEST-1.mtx_cols": b"other\n" * 30})
+
+    unzip_to_folder(zip_path, target, SUFFIXES)
+
+    assert (target / "E-TEST-1.mtx_cols").read_bytes() == b"other\n" * 30
+    after = extracted_files(target)
+    assert [name for name in after if after[name] != before[name]] == [
+        "E-TEST-1.mtx_cols"
+    ]
+
+
+def test_corrupt_member_leaves_no_file(tmp_path):
+    data = b"0123456789" * 100
+    zip_path = write_zip(
+        tmp_path / "test.zip", {"E-TEST-1.mtx": data}, zipfile.ZIP_STORED
+    )
+    raw = zip_path.read_bytes()
+    offset = raw.index(data)
+    zip_path.write_bytes(raw[:offset] + b"X" + raw[offset + 1 :])
+
+    with pytest.raises(zipfile.BadZipFile):
+        unzip_to_folder(zip_path, tmp_path / "out", SUFFIXES)
+
+    assert list((tmp_path / "out").iterdir()) == []